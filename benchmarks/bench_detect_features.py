@@ -0,0 +1,114 @@
+# Author: Huaxu Yu
+
+# Benchmark of feature detection (ROI tracing) on a synthetic LC-MS run.
+#
+# Usage:
+#     python benchmarks/bench_detect_features.py [--scans 3000] [--compounds 500] [--noise 50]
+#
+# The classic engine (one Feature object per ROI, full sort of open ROIs in every scan) and
+# the vectorized engine (array-based matching with intensity-priority claims) are run on
+# the same data, and the detected features are checked to be identical.
+
+# imports
+import argparse
+import time
+import numpy as np
+
+from masscube.params import Params
+from masscube.raw_data_utils import MSData, ScanTable
+from masscube.feature_detection import detect_features
+
+
+def simulate_ms_data(n_scans=3000, n_compounds=500, n_noise=50, seed=0):
+    """
+    Simulate centroided MS1 scans with Gaussian chromatographic peaks and random noise.
+
+    Parameters
+    ----------
+    n_scans: int
+        Number of MS1 scans.
+    n_compounds: int
+        Number of compounds, each with a M+1 isotope.
+    n_noise: int
+        Number of noise signals per scan.
+    seed: int
+        Random seed.
+
+    Returns
+    -------
+    d: MSData object
+        An MSData object with the simulated scans.
+    """
+
+    rng = np.random.default_rng(seed)
+    time_arr = np.linspace(0, 30, n_scans)
+    cmp_mz = rng.uniform(100, 1000, n_compounds)
+    cmp_rt = rng.uniform(0.5, 29.5, n_compounds)
+    cmp_w = rng.uniform(0.02, 0.1, n_compounds)
+    cmp_h = 10 ** rng.uniform(4, 7, n_compounds)
+
+    peaks, counts = [], []
+    for t in time_arr:
+        ints = cmp_h * np.exp(-0.5 * ((t - cmp_rt) / cmp_w) ** 2)
+        v = ints > 1000
+        mz = np.concatenate((cmp_mz[v] + rng.normal(0, 0.001, np.sum(v)), cmp_mz[v] + 1.00336,
+                             rng.uniform(100, 1000, n_noise)))
+        it = np.concatenate((ints[v], ints[v] * 0.3, rng.uniform(1000, 30000, n_noise)))
+        o = np.argsort(mz)
+        peaks.append(np.column_stack((mz[o], it[o])))
+        counts.append(len(o))
+
+    offset = np.zeros(n_scans + 1, dtype=np.int64)
+    np.cumsum(counts, out=offset[1:])
+
+    d = MSData()
+    d.params = Params()
+    d.scans = ScanTable(level=np.ones(n_scans, dtype=np.int8), time=time_arr,
+                        peaks=np.concatenate(peaks).astype(np.float32), offset=offset)
+    d.index_scans()
+
+    return d
+
+
+def run(d, engine):
+    """
+    Run feature detection with the given engine and return the features and the time in seconds.
+    """
+
+    d.params.roi_engine = engine
+    t0 = time.perf_counter()
+    features = detect_features(d)
+    return features, time.perf_counter() - t0
+
+
+def is_same(features_a, features_b):
+    """
+    Check if two lists of features have the same traces.
+    """
+
+    if len(features_a) != len(features_b):
+        return False
+    for a, b in zip(features_a, features_b):
+        if not (np.array_equal(a.signals, b.signals) and list(a.rt_seq) == list(b.rt_seq)):
+            return False
+    return True
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Benchmark of feature detection.")
+    parser.add_argument("--scans", type=int, default=3000, help="number of MS1 scans")
+    parser.add_argument("--compounds", type=int, default=500, help="number of compounds")
+    parser.add_argument("--noise", type=int, default=50, help="number of noise signals per scan")
+    args = parser.parse_args()
+
+    d = simulate_ms_data(args.scans, args.compounds, args.noise)
+    print("{} MS1 scans, {} signals".format(len(d.ms1_idx_arr), len(d.scans.peaks)))
+
+    features_classic, t_classic = run(d, "classic")
+    print("classic:    {:8.2f} s, {} features".format(t_classic, len(features_classic)))
+    features_vec, t_vec = run(d, "vectorized")
+    print("vectorized: {:8.2f} s, {} features".format(t_vec, len(features_vec)))
+
+    print("identical features: {}".format(is_same(features_classic, features_vec)))
+    print("speedup: {:.1f}x".format(t_classic / t_vec))
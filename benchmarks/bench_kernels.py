@@ -0,0 +1,132 @@
+# Author: Huaxu Yu
+
+# Benchmark and parity check of the optional numba kernels (Params.use_numba).
+#
+# Usage:
+#     python benchmarks/bench_kernels.py [--scans 2000] [--compounds 400] [--noise 50]
+#
+# Each hot loop is run with the NumPy code and with the numba kernel on the same data, and
+# the results are checked to be identical (the scan-to-scan correlation up to rounding).
+# The first call of a kernel compiles it, so every kernel is warmed up before timing.
+
+# imports
+import argparse
+import time
+import numpy as np
+
+from masscube.kernels import HAS_NUMBA
+from masscube.feature_detection import detect_features
+from masscube.feature_grouping import scan_to_scan_cor_intensity
+from masscube.utils_functions import centroid_signals
+from bench_detect_features import simulate_ms_data, is_same
+
+
+def timed(func, *args, **kwargs):
+    """
+    Run a function and return the result and the time in seconds.
+    """
+
+    t0 = time.perf_counter()
+    res = func(*args, **kwargs)
+    return res, time.perf_counter() - t0
+
+
+def report(name, same, t_numpy, t_numba):
+    print("{:<22} identical: {:<5}  numpy: {:8.3f} s  numba: {:8.3f} s  speedup: {:.1f}x".format(
+        name, str(same), t_numpy, t_numba, t_numpy / t_numba))
+
+
+def bench_detection(d, engine):
+    """
+    Detect features with and without the numba kernels.
+    """
+
+    d.params.roi_engine = engine
+    d.params.use_numba = True
+    detect_features(d)
+    features_numba, t_numba = timed(detect_features, d)
+    d.params.use_numba = False
+    features_numpy, t_numpy = timed(detect_features, d)
+    report("detect ({})".format(engine), is_same(features_numpy, features_numba), t_numpy, t_numba)
+
+
+def bench_eic(d, n_targets=2000, seed=0):
+    """
+    Extract EICs of random features with and without the numba kernel.
+    """
+
+    rng = np.random.default_rng(seed)
+    mz_arr = d.scans.mz[rng.integers(0, len(d.scans.peaks), n_targets)]
+    rt_arr = rng.uniform(0, 30, n_targets)
+
+    def run():
+        return [d.get_eic_data(mz, rt, mz_tol=0.01, rt_tol=0.5) for mz, rt in zip(mz_arr, rt_arr)]
+
+    d.params.use_numba = True
+    run()
+    eics_numba, t_numba = timed(run)
+    d.params.use_numba = False
+    eics_numpy, t_numpy = timed(run)
+    same = all(np.array_equal(a[0], b[0]) and np.array_equal(a[1], b[1], equal_nan=True) and np.array_equal(a[2], b[2])
+               for a, b in zip(eics_numpy, eics_numba))
+    report("get_eic_data", same, t_numpy, t_numba)
+
+
+def bench_centroid(n_scans=5000, seed=0):
+    """
+    Centroid random profile-like scans with and without the numba kernel.
+    """
+
+    rng = np.random.default_rng(seed)
+    scans = []
+    for _ in range(n_scans):
+        n = rng.integers(50, 500)
+        mz = np.sort(rng.uniform(100, 100 + n * 0.003, n))
+        scans.append(np.column_stack((mz, rng.uniform(1e3, 1e6, n))).astype(np.float32))
+
+    centroid_signals(scans[0], 0.005, use_numba=True)
+    res_numba, t_numba = timed(lambda: [centroid_signals(s, 0.005, use_numba=True) for s in scans])
+    res_numpy, t_numpy = timed(lambda: [centroid_signals(s, 0.005) for s in scans])
+    same = all(np.array_equal(a, b) for a, b in zip(res_numpy, res_numba))
+    report("centroid_signals", same, t_numpy, t_numba)
+
+
+def bench_correlation(n_pairs=20000, seed=0):
+    """
+    Calculate scan-to-scan correlations of random EIC pairs with and without the numba kernel.
+    """
+
+    rng = np.random.default_rng(seed)
+    pairs = []
+    for _ in range(n_pairs):
+        n = rng.integers(5, 60)
+        a = rng.uniform(0, 1e6, n).astype(np.float32) * (rng.random(n) > 0.2)
+        b = (a * rng.uniform(0.2, 0.4) + rng.normal(0, 1e4, n)).astype(np.float32) * (rng.random(n) > 0.2)
+        pairs.append((a, b))
+
+    scan_to_scan_cor_intensity(*pairs[0], use_numba=True)
+    res_numba, t_numba = timed(lambda: [scan_to_scan_cor_intensity(a, b, use_numba=True) for a, b in pairs])
+    res_numpy, t_numpy = timed(lambda: [scan_to_scan_cor_intensity(a, b) for a, b in pairs])
+    same = np.allclose(res_numpy, res_numba, rtol=1e-12, atol=1e-12, equal_nan=True)
+    report("scan_to_scan_cor", same, t_numpy, t_numba)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Benchmark of the numba kernels.")
+    parser.add_argument("--scans", type=int, default=2000, help="number of MS1 scans")
+    parser.add_argument("--compounds", type=int, default=400, help="number of compounds")
+    parser.add_argument("--noise", type=int, default=50, help="number of noise signals per scan")
+    args = parser.parse_args()
+
+    if not HAS_NUMBA:
+        raise SystemExit("numba is not installed.")
+
+    d = simulate_ms_data(args.scans, args.compounds, args.noise)
+    print("{} MS1 scans, {} signals".format(len(d.ms1_idx_arr), len(d.scans.peaks)))
+
+    bench_detection(d, "classic")
+    bench_detection(d, "vectorized")
+    bench_eic(d)
+    bench_centroid()
+    bench_correlation()
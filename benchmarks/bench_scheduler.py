@@ -0,0 +1,64 @@
+# Author: Huaxu Yu
+
+# Benchmark of the per-file scheduling: batches with a barrier vs. long-lived workers.
+#
+# Usage:
+#     python benchmarks/bench_scheduler.py [--files 400] [--workers 8] [--batch 100] [--scale 0.02]
+#
+# Every task sleeps for a time drawn from a skewed (log-normal) distribution of file
+# sizes, so the benchmark shows the idle time of the scheduling itself and can be run
+# on any machine. The batch scheduling runs a new pool for every batch of files in the
+# given order, as the workflow did before; run_tasks runs the files from the largest
+# to the smallest with one pool.
+
+# imports
+import argparse
+import time
+import numpy as np
+from multiprocessing import Pool
+
+from masscube.scheduler import run_tasks
+
+
+def fake_file_processing(seconds):
+    """
+    Stand-in for process_single_file that takes a given time.
+    """
+
+    time.sleep(seconds)
+    return seconds
+
+
+def run_batches(durations, n_workers, batch_size):
+    # one pool per batch, every batch waits for its slowest file
+    for i in range(0, len(durations), batch_size):
+        with Pool(n_workers) as p:
+            p.map(fake_file_processing, durations[i:i+batch_size], chunksize=1)
+
+
+def run_queue(durations, n_workers, batch_size):
+    order = np.argsort(-durations, kind="stable")
+    tasks = [((durations[i],), {}) for i in order]
+    for _ in run_tasks(fake_file_processing, tasks, n_workers, max_tasks=batch_size):
+        pass
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Benchmark of the per-file scheduling.")
+    parser.add_argument("--files", type=int, default=400, help="number of files")
+    parser.add_argument("--workers", type=int, default=8, help="number of workers")
+    parser.add_argument("--batch", type=int, default=100, help="batch size (files per worker before restart for run_tasks)")
+    parser.add_argument("--scale", type=float, default=0.02, help="median time per file in seconds")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    durations = args.scale * rng.lognormal(0, 0.8, args.files)
+    ideal = durations.sum() / args.workers
+    print("{} files, {} workers, ideal time: {:.2f} s".format(args.files, args.workers, ideal))
+
+    for name, func in [("batches", run_batches), ("run_tasks", run_queue)]:
+        t0 = time.perf_counter()
+        func(durations, args.workers, args.batch)
+        t = time.perf_counter() - t0
+        print("{:<10} {:8.2f} s  ({:.0f}% over ideal)".format(name, t, 100 * (t / ideal - 1)))
@@ -10,6 +10,9 @@ __all__ = [
     "untargeted_metabolomics_workflow",
     "run_evaluation",
     "batch_file_processing",
+    "enqueue_single_files",
+    "run_worker",
+    "command_line",
     "convert_raw_to_mzh5",
     "batch_convert_raw_to_mzh5",
     "read_raw_file_to_obj",
@@ -19,7 +22,8 @@ __all__ = [
 ]
 
 def __getattr__(name):
-    if name in {"process_single_file", "untargeted_metabolomics_workflow", "run_evaluation", "batch_file_processing"}:
+    if name in {"process_single_file", "untargeted_metabolomics_workflow", "run_evaluation", "batch_file_processing",
+                "enqueue_single_files", "run_worker", "command_line"}:
         mod = importlib.import_module(".workflows", __name__)
         return getattr(mod, name)
 
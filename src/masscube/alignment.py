@@ -11,8 +11,9 @@ from tqdm import tqdm
 from scipy.interpolate import interp1d
 import pickle
 
-from .raw_data_utils import read_raw_file_to_obj, Scan
+from .raw_data_utils import read_raw_file_to_obj, find_reload_file, Scan
 from .params import Params
+from .profiling import StageProfiler
 from .utils_functions import convert_signals_to_string, extract_signals_from_string
 
 
@@ -100,7 +101,7 @@ Functions
 ------------------------------------------------------------------------------------------------------------------------
 """
 
-def feature_alignment(path: str, params: Params):
+def feature_alignment(path: str, params: Params, profiler: StageProfiler = None):
     """
     Align the features from multiple processed single files as .txt format.
 
@@ -110,6 +111,8 @@ def feature_alignment(path: str, params: Params):
         The path to the feature tables.
     params: Params object
         The parameters for alignment including sample names and sample groups.
+    profiler: StageProfiler object
+        Records the alignment and gap filling stages if given.
 
     Returns
     -------
@@ -118,18 +121,11 @@ def feature_alignment(path: str, params: Params):
     """
 
     # STEP 1: preparation
+    if profiler is None:
+        profiler = StageProfiler("project")
+    profiler.start("alignment")
     features = []
-    params.sample_metadata['SINGLE_FILE_PATH'] = [os.path.join(path, f + ".txt") for f in params.sample_metadata.iloc[:, 0]]
-    for i in range(len(params.sample_metadata)):
-        if not os.path.exists(params.sample_metadata['SINGLE_FILE_PATH'][i]):
-            params.sample_metadata.loc[i, "VALID"] = False
-    # remove invalid files
-    params.sample_metadata = params.sample_metadata[params.sample_metadata["VALID"]]
-    params.sample_metadata.index = np.arange(len(params.sample_metadata))
-
-    # avoid empty single files
-    if len(params.sample_metadata) == 0:
-        raise ValueError("No valid single files for alignment.")
+    select_valid_single_files(path, params)
     
     # find anchors for retention time correction
     if params.correct_rt:
@@ -223,10 +219,14 @@ def feature_alignment(path: str, params: Params):
     if params.merge_features:
         features = merge_features(features, params)
 
+    profiler.stop(samples=len(params.sample_metadata), features=len(features))
+
     # STEP 5: gap filling
     if params.fill_gaps:
         print("\tFilling gaps...")
+        profiler.start("gap_filling")
         features = gap_filling(features, params)
+        profiler.stop(features=len(features))
     
     # STEP 6: index the features
     features.sort(key=lambda x: x.highest_intensity, reverse=True)
@@ -236,6 +236,32 @@ def feature_alignment(path: str, params: Params):
     return features
 
 
+def select_valid_single_files(path: str, params: Params):
+    """
+    Find the processed single files of the samples and remove the samples without
+    a single file from the sample metadata.
+
+    Parameters
+    ----------
+    path: str
+        The path to the feature tables.
+    params: Params object
+        The parameters with the sample metadata.
+    """
+
+    params.sample_metadata['SINGLE_FILE_PATH'] = [os.path.join(path, f + ".txt") for f in params.sample_metadata.iloc[:, 0]]
+    for i in range(len(params.sample_metadata)):
+        if not os.path.exists(params.sample_metadata['SINGLE_FILE_PATH'][i]):
+            params.sample_metadata.loc[i, "VALID"] = False
+    # remove invalid files
+    params.sample_metadata = params.sample_metadata[params.sample_metadata["VALID"]]
+    params.sample_metadata.index = np.arange(len(params.sample_metadata))
+
+    # avoid empty single files
+    if len(params.sample_metadata) == 0:
+        raise ValueError("No valid single files for alignment.")
+
+
 def gap_filling(features, params: Params):
     """
     Fill the gaps for aligned features.
@@ -263,24 +289,34 @@ def gap_filling(features, params: Params):
         else:
             rt_cor_functions = None
 
+        not_found = []
         for i in tqdm(range(len(params.sample_metadata))):
             file_name = params.sample_metadata.iloc[i, 0]
-            fn = os.path.join(params.tmp_file_dir, file_name + ".mzpkl")
-            if os.path.exists(fn):
-                d = read_raw_file_to_obj(fn, ms1_abs_int_tol=params.ms1_abs_int_tol, centroid_mz_tol=None)
+            fn = find_reload_file(params.tmp_file_dir, file_name)
+            if fn is None:
+                not_found.append(file_name)
+            else:
+                d = read_raw_file_to_obj(fn, ms1_abs_int_tol=params.ms1_abs_int_tol, centroid_mz_tol=None, mmap=True,
+                                         write_sidecar=True)
                 # correct retention time if model is available
                 if rt_cor_functions is not None and file_name in rt_cor_functions.keys():
                     f = rt_cor_functions[file_name]
                     if f is not None:
                         d.correct_retention_time(f)
 
-                for f in features:
-                    if f.feature_id_arr[i] == -1:
-                        eic_time_arr, eic_signals, _ = d.get_eic_data(f.mz, f.rt, params.mz_tol_alignment, params.gap_filling_rt_window)
-                        if len(eic_signals) > 0:
-                            f.peak_height_arr[i] = np.max(eic_signals[:, 1])
-                            f.peak_area_arr[i] = int(np.trapz(y=eic_signals[:, 1], x=eic_time_arr))
-                            f.top_average_arr[i] = np.mean(np.sort(eic_signals[:, 1])[-3:])
+                # extract the EICs of all missing features in a batch
+                missing = [f for f in features if f.feature_id_arr[i] == -1]
+                eics = d.get_eics(np.array([f.mz for f in missing]), np.array([f.rt for f in missing]),
+                                  params.mz_tol_alignment, params.gap_filling_rt_window)
+                for f, (eic_time_arr, eic_signals, _) in zip(missing, eics):
+                    if len(eic_signals) > 0:
+                        f.peak_height_arr[i] = np.max(eic_signals[:, 1])
+                        f.peak_area_arr[i] = int(np.trapz(y=eic_signals[:, 1], x=eic_time_arr))
+                        f.top_average_arr[i] = np.mean(np.sort(eic_signals[:, 1])[-3:])
+
+        if len(not_found) > 0:
+            print("\tGaps of {} samples are not filled, as their intermediate files are not found in {}.".format(
+                  len(not_found), params.tmp_file_dir))
 
     # calculate the detection rate after gap filling (blank samples are not included)
     v = ~params.sample_metadata['is_blank']
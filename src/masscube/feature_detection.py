@@ -6,10 +6,12 @@
 import numpy as np
 from scipy.signal import find_peaks
 from scipy.ndimage import gaussian_filter1d
-from copy import deepcopy
+from copy import copy
 import bisect
+from joblib import Parallel, delayed, cpu_count
 
-from .feature_evaluation import calculate_noise_score, calculate_gaussian_similarity, calculate_asymmetry_factor
+from .feature_evaluation import calculate_noise_score, calculate_gaussian_similarity, calculate_asymmetry_factor, summarize_peaks
+from .kernels import is_enabled, claim_signals
 
 
 """
@@ -20,21 +22,51 @@ Classes
 class Feature:
     """
     A class to store a feature characterized by a unique pair of m/z and retention time.
+
+    Attributes of the chromatographic peak and its summary are stored in slots. Grouping 
+    and annotation attributes are rarely set for most features (noise), so their defaults 
+    are class attributes and values are only stored in the instance dictionary once set.
     """
 
+    __slots__ = ("rt_seq", "signals", "scan_idx_seq", "_ms2_seq", "gap_counter", "id", "mz", "rt", "scan_idx",
+                 "peak_height", "peak_area", "top_average", "ms2", "length", "gaussian_similarity", "noise_score",
+                 "asymmetry_factor", "peak_quality", "is_segmented", "__dict__")
+
+    # grouping
+    feature_group_id = None                  # peak group id
+    sse = 0.0                                # squared error to the smoothed curve
+    is_isotope = False                       # whether the feature is an isotope
+    charge_state = 1                         # charge state of the feature
+    isotope_signals = None                   # isotope signals [[mz, intensity], ...]
+    is_in_source_fragment = False            # whether the feature is an in-source fragment
+    adduct_type = None                       # adduct type
+    isotope_state = "M+0"                    # isotope state, e.g., M+0, M+1, M+2, etc.
+    scan_scan_cor = None                     # scan-scan correlation to the most abundant ion in the same feature group
+
+    # annotation
+    annotation_algorithm = None              # annotation algorithm. Not used now.
+    search_mode = None                       # 'identity search', 'fuzzy search', or 'mzrt_search'
+    similarity = None                        # similarity score (0-1)
+    annotation = None                        # name of annotated compound
+    formula = None                           # molecular formula
+    matched_peak_number = None               # number of matched peaks
+    smiles = None                            # SMILES
+    inchikey = None                          # InChIKey
+    matched_precursor_mz = None              # matched precursor m/z
+    matched_ms2 = None                       # matched ms2 spectra
+    matched_adduct_type = None               # matched adduct type
+
     def __init__(self):
 
         # chromatographic peak
         self.rt_seq = []                     # retention time sequence
         self.signals = []                    # signal sequence (m/z, intensity)
         self.scan_idx_seq = []               # scan index sequence
-        self.ms2_seq = []                    # MS2 spectra
+        self._ms2_seq = None                 # MS2 spectra, the list is created on first use
         self.gap_counter = 0                 # count the number of consecutive zeros in the end of the peak
-        self.peak_shape = None               # peak shape ([[rt, intensity], ...]) 
 
         # summary
         self.id = None                       # feature id
-        self.feature_group_id = None         # peak group id
         self.mz = None                       # m/z
         self.rt = None                       # retention time
         self.scan_idx = None                 # scan index of the peak apex
@@ -46,27 +78,31 @@ class Feature:
         self.gaussian_similarity = 0.0       # Gaussian similarity
         self.noise_score = 0.0               # noise score
         self.asymmetry_factor = 0.0          # asymmetry factor
-        self.sse = 0.0                       # squared error to the smoothed curve
+        self.peak_quality = None             # peak quality score (0-1) by the neural network, see peak_quality.py
         self.is_segmented = False            # whether the feature is segmented from a larger feature
-        self.is_isotope = False              # whether the feature is an isotope
-        self.charge_state = 1                # charge state of the feature
-        self.isotope_signals = None          # isotope signals [[mz, intensity], ...]
-        self.is_in_source_fragment = False   # whether the feature is an in-source fragment
-        self.adduct_type = None              # adduct type
-        self.isotope_state = "M+0"           # isotope state, e.g., M+0, M+1, M+2, etc.
-        self.scan_scan_cor = None            # scan-scan correlation to the most abundant ion in the same feature group
-
-        self.annotation_algorithm = None     # annotation algorithm. Not used now.
-        self.search_mode = None              # 'identity search', 'fuzzy search', or 'mzrt_search'
-        self.similarity = None               # similarity score (0-1)
-        self.annotation = None               # name of annotated compound
-        self.formula = None                  # molecular formula
-        self.matched_peak_number = None      # number of matched peaks
-        self.smiles = None                   # SMILES
-        self.inchikey = None                 # InChIKey
-        self.matched_precursor_mz = None     # matched precursor m/z
-        self.matched_ms2 = None              # matched ms2 spectra
-        self.matched_adduct_type = None      # matched adduct type
+
+
+    @property
+    def ms2_seq(self):
+        if self._ms2_seq is None:
+            self._ms2_seq = []
+        return self._ms2_seq
+
+
+    @ms2_seq.setter
+    def ms2_seq(self, value):
+        self._ms2_seq = value
+
+
+    @property
+    def peak_shape(self):
+        """
+        Peak shape ([[rt, intensity], ...]) of a summarized feature, None otherwise.
+        """
+
+        if self.mz is None:
+            return None
+        return np.column_stack((np.asarray(self.rt_seq, dtype=np.float64), self.signals[:, 1]))
 
 
     def extend(self, rt, signal, scan_idx):
@@ -135,7 +171,10 @@ class Feature:
             Whether to calculate the asymmetry factor.
         """
 
-        self.signals = np.array(self.signals, dtype=np.float32)
+        # traces may be views of arrays shared by all features of a file, they are not copied
+        self.signals = np.asarray(self.signals, dtype=np.float32)
+        self.rt_seq = np.asarray(self.rt_seq, dtype=np.float64)
+        self.scan_idx_seq = np.asarray(self.scan_idx_seq, dtype=np.int64)
         first,last = _trim_signals(self.signals)
         self.signals = self.signals[first:last]
         self.rt_seq = self.rt_seq[first:last]
@@ -146,7 +185,6 @@ class Feature:
         self.rt = self.rt_seq[apx]
         self.scan_idx = self.scan_idx_seq[apx]
         self.length = np.sum(self.signals[:, 1] > 0)
-        self.peak_shape = np.array([[self.rt_seq[i], self.signals[i, 1]] for i in range(len(self.signals))])
 
         if ph:
             self.peak_height = int(self.signals[apx, 1])
@@ -180,18 +218,383 @@ class Feature:
         self.rt_seq = self.rt_seq[start:end]
         self.signals = self.signals[start:end]
         self.scan_idx_seq = self.scan_idx_seq[start:end]
-        self.ms2_seq = [ms2 for ms2 in self.ms2_seq if ms2.id > self.scan_idx_seq[0] and ms2.id < self.scan_idx_seq[-1]]
+        if self._ms2_seq is not None:
+            self._ms2_seq = [ms2 for ms2 in self._ms2_seq if ms2.id > self.scan_idx_seq[0] and ms2.id < self.scan_idx_seq[-1]]
 
         if summarize:
             self.summarize(pa=False, ta=False, g_score=False, a_score=False)
 
 
+    def segment(self, start, end):
+        """
+        Create a feature from a part of this feature, see subset for the parameters. The 
+        trace of the new feature is a view of this trace and MS2 spectra are shared, so the 
+        cost does not depend on the size of the feature.
+
+        Returns
+        -------
+        Feature
+            The segmented feature.
+        """
+
+        child = copy(self)
+        child.subset(start=start, end=end)
+        child.is_segmented = True
+        return child
+
+
+class ROITracer:
+    """
+    Trace ROIs over MS1 scans that are added one at a time in time order.
+
+    The last m/z, last intensity and gap counter of the open ROIs are kept in arrays 
+    ordered like the feature list of detect_features, so that a scan is matched to 
+    all ROIs with one searchsorted. The traces are collected as per-scan chunks of 
+    (ROI id, MS1 ordinal, m/z, intensity). Once enough trace points are collected, the 
+    traces of closed ROIs are turned into Feature objects and removed from the chunks 
+    with the traces of pruned ROIs. The scans are not kept, so the memory only depends 
+    on the open ROIs and the features.
+    """
+
+    def __init__(self, mz_tol, gap_tol, min_length=0, min_height=0.0, compact_size=2**22, use_numba=False):
+        """
+        Parameters
+        ----------
+        mz_tol: float
+            m/z tolerance for MS1.
+        gap_tol: int
+            Gap tolerance within a feature.
+        min_length, min_height: int, float
+            ROIs with fewer non-zero scans or a lower highest intensity are dropped when closed.
+        compact_size: int
+            Closed and dropped ROIs are removed from the chunks when this many trace points 
+            have been collected since the last removal.
+        use_numba: bool
+            Whether to match the ROIs to the signals with the numba kernel if numba is installed.
+        """
+
+        self.mz_tol = mz_tol
+        self.gap_tol = gap_tol
+        self.min_length = min_length
+        self.min_height = min_height
+        self.compact_size = compact_size
+        self.use_numba = is_enabled(use_numba)
+        self.n_pruned = 0                                   # number of dropped ROIs
+
+        # open ROIs
+        self._roi_id = np.empty(0, dtype=np.int64)
+        self._last_mz = np.empty(0, dtype=np.float32)
+        self._last_int = np.empty(0, dtype=np.float32)
+        self._gap = np.empty(0, dtype=np.int64)
+        self._n_hit = np.empty(0, dtype=np.int64)          # number of non-zero scans
+        self._top = np.empty(0, dtype=np.float32)          # highest intensity
+        self._n_roi = 0
+
+        # retention times and scan indexes of the added scans, by MS1 ordinal
+        self._time = []
+        self._scan_idx = []
+
+        # trace chunks, ROIs closed or dropped since the last compaction, and features of closed ROIs
+        self._chunk_id, self._chunk_ord, self._chunk_mz, self._chunk_int = [], [], [], []
+        self._closed = []
+        self._pruned = []
+        self._n_collected = 0
+        self._features = []
+
+
+    @property
+    def is_pruning(self):
+        return self.min_length > 0 or self.min_height > 0
+
+
+    def add_scan(self, mz_arr, int_arr, scan_time, scan_idx):
+        """
+        Match the signals of the next MS1 scan to the open ROIs.
+
+        Parameters
+        ----------
+        mz_arr, int_arr: numpy array
+            m/z (in ascending order) and intensity of the signals. The arrays are not kept.
+        scan_time: float
+            Retention time of the scan.
+        scan_idx: int
+            Scan index of the scan.
+        """
+
+        k = len(self._time)
+        self._time.append(scan_time)
+        self._scan_idx.append(scan_idx)
+
+        # the first scan initiates the ROIs without sorting
+        if k == 0:
+            n = len(mz_arr)
+            self._roi_id = np.arange(n, dtype=np.int64)
+            self._last_mz = np.array(mz_arr, dtype=np.float32)
+            self._last_int = np.array(int_arr, dtype=np.float32)
+            self._gap = np.zeros(n, dtype=np.int64)
+            self._n_hit = (self._last_int > 0).astype(np.int64)
+            self._top = self._last_int.copy()
+            self._n_roi = n
+            self._collect(self._roi_id, k, self._last_mz, self._last_int)
+            return None
+
+        roi_id, last_mz, gap, n_hit, top = self._roi_id, self._last_mz, self._gap, self._n_hit, self._top
+
+        # match all ROIs to the scan, the first ROI in order claims a signal
+        if self.use_numba:
+            matched = claim_signals(mz_arr, last_mz, self.mz_tol)
+            claimed = matched >= 0
+        else:
+            if len(mz_arr) > 0:
+                matched = _find_closest_indices_ordered(mz_arr, last_mz, self.mz_tol)
+            else:
+                matched = np.full(len(roi_id), -1, dtype=np.int64)
+            claimed = np.zeros(len(roi_id), dtype=bool)
+            hit = np.where(matched >= 0)[0]
+            _, first = np.unique(matched[hit], return_index=True)
+            claimed[hit[first]] = True
+
+        avlb_signals = np.ones(len(mz_arr), dtype=bool)
+        avlb_signals[matched[claimed]] = False
+
+        # the chunks keep the previous arrays
+        last_mz = last_mz.copy()
+        last_mz[claimed] = mz_arr[matched[claimed]]
+        last_int = np.zeros(len(roi_id), dtype=np.float32)
+        last_int[claimed] = int_arr[matched[claimed]]
+        gap = np.where(claimed, 0, gap + 1)
+        n_hit = n_hit + (last_int > 0)
+        top = np.maximum(top, last_int)
+        self._collect(roi_id, k, last_mz, last_int)
+
+        # move the ROIs that have not been visited for a long time, in the order of detect_features
+        to_be_moved = gap > self.gap_tol
+        if np.any(to_be_moved):
+            moved = roi_id[to_be_moved][::-1]
+            if self.is_pruning:
+                is_short = ((n_hit < self.min_length) | (top < self.min_height))[to_be_moved][::-1]
+                self._pruned.append(moved[is_short])
+                self.n_pruned += int(np.sum(is_short))
+                moved = moved[~is_short]
+            self._closed.append(moved)
+            keep = ~to_be_moved
+            roi_id, last_mz, last_int, gap = roi_id[keep], last_mz[keep], last_int[keep], gap[keep]
+            n_hit, top = n_hit[keep], top[keep]
+
+        # remove the traces of closed and dropped ROIs to bound the memory
+        if self._n_collected > self.compact_size and (len(self._closed) > 0 or len(self._pruned) > 0):
+            self._compact()
+
+        # create new ROIs for the remaining signals
+        new_n = int(np.sum(avlb_signals))
+        if new_n > 0:
+            new_id = np.arange(self._n_roi, self._n_roi + new_n, dtype=np.int64)
+            new_mz = mz_arr[avlb_signals]
+            new_int = int_arr[avlb_signals]
+            self._n_roi += new_n
+            self._collect(new_id, k, new_mz, new_int)
+            roi_id = np.concatenate((roi_id, new_id))
+            last_mz = np.concatenate((last_mz, new_mz))
+            last_int = np.concatenate((last_int, new_int))
+            gap = np.concatenate((gap, np.zeros(new_n, dtype=np.int64)))
+            n_hit = np.concatenate((n_hit, (new_int > 0).astype(np.int64)))
+            top = np.concatenate((top, new_int))
+
+        # more intense ROIs claim signals first in the next scan
+        order = _priority_order(last_int)
+        self._roi_id, self._last_mz, self._last_int, self._gap = roi_id[order], last_mz[order], last_int[order], gap[order]
+        self._n_hit, self._top = n_hit[order], top[order]
+
+
+    def pop_features(self):
+        """
+        Get the features of the ROIs closed so far that were removed from the chunks.
+
+        Returns
+        -------
+        features: list
+            A list of Feature objects in the order they are closed, not summarized.
+        """
+
+        features = self._features
+        self._features = []
+        return features
+
+
+    def close(self):
+        """
+        Close all open ROIs.
+
+        Returns
+        -------
+        features: list
+            The features that were not popped, in the order they are closed, not summarized.
+        """
+
+        roi_id = self._roi_id
+        if self.is_pruning:
+            is_short = (self._n_hit < self.min_length) | (self._top < self.min_height)
+            self.n_pruned += int(np.sum(is_short))
+            self._pruned.append(roi_id[is_short])
+            roi_id = roi_id[~is_short]
+        self._closed.append(roi_id)
+
+        self._roi_id = np.empty(0, dtype=np.int64)
+        self._last_mz = np.empty(0, dtype=np.float32)
+        self._last_int = np.empty(0, dtype=np.float32)
+        self._gap = np.empty(0, dtype=np.int64)
+        self._n_hit = np.empty(0, dtype=np.int64)
+        self._top = np.empty(0, dtype=np.float32)
+        self._compact()
+
+        return self.pop_features()
+
+
+    def _collect(self, roi_id, k, mz, intensity):
+        """
+        Add the trace points of ROIs in the MS1 scan of ordinal k.
+        """
+
+        self._chunk_id.append(roi_id)
+        self._chunk_ord.append(np.full(len(roi_id), k, dtype=np.int32))
+        self._chunk_mz.append(mz)
+        self._chunk_int.append(intensity)
+        self._n_collected += len(roi_id)
+
+
+    def _compact(self):
+        """
+        Merge the trace chunks into one, create the features of the closed ROIs and remove 
+        the trace points of the closed and dropped ROIs.
+        """
+
+        closed = np.concatenate(self._closed) if len(self._closed) > 0 else np.empty(0, dtype=np.int64)
+        pruned = np.concatenate(self._pruned) if len(self._pruned) > 0 else np.empty(0, dtype=np.int64)
+        self._closed, self._pruned = [], []
+        self._n_collected = 0
+        if len(self._chunk_id) == 0:
+            return None
+
+        trace_id = np.concatenate(self._chunk_id)
+        trace_ord = np.concatenate(self._chunk_ord)
+        trace_mz = np.concatenate(self._chunk_mz)
+        trace_int = np.concatenate(self._chunk_int)
+        is_closed = np.isin(trace_id, closed)
+        keep = ~is_closed
+        if len(pruned) > 0:
+            keep &= ~np.isin(trace_id, pruned)
+        self._chunk_id, self._chunk_ord = [trace_id[keep]], [trace_ord[keep]]
+        self._chunk_mz, self._chunk_int = [trace_mz[keep]], [trace_int[keep]]
+        if len(closed) == 0:
+            return None
+
+        # group the traces by ROI, chunks are in scan order so a stable sort keeps it
+        closed_id = trace_id[is_closed]
+        order = np.argsort(closed_id, kind="stable")
+        closed_id = closed_id[order]
+        closed_ord = trace_ord[is_closed][order]
+        trace_signals = np.column_stack((trace_mz[is_closed][order], trace_int[is_closed][order]))
+        del trace_id, trace_ord, trace_mz, trace_int
+        uniq, bounds = np.unique(closed_id, return_index=True)
+        bounds = np.append(bounds, len(closed_id))
+        pos = np.searchsorted(uniq, closed)
+
+        # traces of the features are views of these arrays
+        trace_rt = np.asarray(self._time, dtype=np.float64)[closed_ord]
+        trace_scan_idx = np.asarray(self._scan_idx, dtype=np.int64)[closed_ord]
+
+        for i in pos:
+            t0, t1 = bounds[i], bounds[i + 1]
+            feature = Feature()
+            feature.rt_seq = trace_rt[t0:t1]
+            feature.signals = trace_signals[t0:t1]
+            feature.scan_idx_seq = trace_scan_idx[t0:t1]
+            self._features.append(feature)
+
+
 """
 Functions
 ------------------------------------------------------------------------------------------------------------------------
 """
 
-def detect_features(d):
+def summarize_features(features, ph=True, pa=True, ta=True, g_score=True, n_score=True, a_score=True):
+    """
+    Summarize a list of features in a batch, the results are the same as calling 
+    Feature.summarize for each feature. Features that cannot be summarized (no signal 
+    in the trace) are left out.
+
+    Parameters
+    ----------
+    features: list
+        A list of Feature objects.
+    ph, pa, ta, g_score, n_score, a_score: bool
+        See Feature.summarize.
+
+    Returns
+    -------
+    features: list
+        The summarized features.
+    """
+
+    signals = [np.asarray(f.signals, dtype=np.float32) for f in features]
+    is_2d = np.array([s.ndim == 2 and len(s) > 0 for s in signals], dtype=bool)
+    features = [f for f, v in zip(features, is_2d) if v]
+    signals = [s for s, v in zip(signals, is_2d) if v]
+    if len(features) == 0:
+        return []
+
+    # trim the leading and trailing zeros of the traces
+    counts = np.array([len(s) for s in signals], dtype=np.int64)
+    starts = np.cumsum(counts) - counts
+    all_ints = np.concatenate([s[:, 1] for s in signals])
+    seg = np.repeat(np.arange(len(counts)), counts)
+    local = np.arange(len(all_ints)) - starts[seg]
+    is_nonzero = all_ints != 0
+    first = np.minimum.reduceat(np.where(is_nonzero, local, len(all_ints)), starts)
+    last = np.maximum.reduceat(np.where(is_nonzero, local, -1), starts) + 1
+    is_valid = last > 0
+
+    valid_features = []
+    x, y = [], []
+    for i in np.flatnonzero(is_valid):
+        f = features[i]
+        f.signals = signals[i][first[i]:last[i]]
+        f.rt_seq = np.asarray(f.rt_seq, dtype=np.float64)[first[i]:last[i]]
+        f.scan_idx_seq = np.asarray(f.scan_idx_seq, dtype=np.int64)[first[i]:last[i]]
+        x.append(f.rt_seq)
+        y.append(f.signals[:, 1])
+        valid_features.append(f)
+    if len(valid_features) == 0:
+        return []
+
+    offset = np.zeros(len(valid_features) + 1, dtype=np.int64)
+    np.cumsum([len(v) for v in y], out=offset[1:])
+    results = summarize_peaks(np.concatenate(x), np.concatenate(y), offset, g_score=g_score, n_score=n_score, a_score=a_score)
+
+    apex = results["apex"] - offset[:-1]
+    for i, f in enumerate(valid_features):
+        j = apex[i]
+        f.mz = f.signals[j, 0]
+        f.rt = f.rt_seq[j]
+        f.scan_idx = f.scan_idx_seq[j]
+        f.length = results["length"][i]
+        if ph:
+            f.peak_height = int(results["height"][i])
+        if pa:
+            f.peak_area = int(results["area"][i])
+        if ta:
+            f.top_average = int(results["top_average"][i])
+        if n_score:
+            f.noise_score = results["noise_score"][i]
+        if g_score:
+            f.gaussian_similarity = results["gaussian_similarity"][i]
+        if a_score:
+            f.asymmetry_factor = results["asymmetry_factor"][i]
+
+    return valid_features
+
+
+def detect_features(d, n_jobs=1):
     """
     Detect features in the MS data.
 
@@ -199,6 +602,9 @@ def detect_features(d):
     ----------
     d: MSData object
         An MSData object that contains the MS data.
+    n_jobs: int
+        Number of workers to trace m/z slabs in parallel, -1 to use all CPUs. Only used 
+        by the vectorized engine (Params.roi_engine).
 
     Returns
     -------
@@ -206,62 +612,92 @@ def detect_features(d):
         A list of detected features.
     """
 
+    if d.params.roi_engine == "vectorized":
+        return _detect_features_vectorized(d, n_jobs=n_jobs)
+    if d.params.roi_engine != "classic":
+        raise ValueError("Unknown ROI engine: {}. Use \"vectorized\" or \"classic\".".format(d.params.roi_engine))
+
+    min_length = d.params.roi_min_length
+    min_height = d.params.roi_min_height
+    prune = min_length > 0 or min_height > 0    # the intensities are only gathered when pruning
+    use_numba = is_enabled(d.params.use_numba)
+
     # A list to store the rois in progress
     features = []
     # A list for the finally detected ROIs
     final_features = []
+    # number of ROIs dropped by early pruning
+    n_pruned = 0
 
     # Initiate a set of rois using the first MS1 scan
     s = d.scans[d.ms1_idx_arr[0]]    # The first scan
+    signals = s.signals
 
-    for i in range(len(s.signals)):
+    for i in range(len(signals)):
         feature = Feature()
-        feature.extend(rt=s.time, signal=s.signals[i], scan_idx=d.ms1_idx_arr[0])
+        feature.extend(rt=s.time, signal=signals[i], scan_idx=d.ms1_idx_arr[0])
         features.append(feature)
 
     # Loop over all MS1 scans
     for ms1_idx in d.ms1_idx_arr[1:]:
         s = d.scans[ms1_idx]                                  # The current MS1 scan
-        if len(s.signals) == 0:
+        signals = s.signals                                   # bind once, scans are views of the ScanTable
+        if len(signals) == 0:
             continue
-        avlb_signals = np.ones(len(s.signals), dtype=bool)    # available signals to assign to features
+        scan_time = s.time
+        mz_arr = signals[:, 0]
+        avlb_signals = np.ones(len(signals), dtype=bool)      # available signals to assign to features
         avlb_features = np.ones(len(features), dtype=bool)    # available features to take new signals
         to_be_moved = []                                      # features to be moved to final_features
+        if use_numba:
+            # signals claimed by all features at once, in the order of the features
+            claimed = claim_signals(mz_arr, np.array([f.signals[-1][0] for f in features], dtype=mz_arr.dtype), 
+                                    d.params.mz_tol_ms1)
         
         for i, feature in enumerate(features):
-            min_idx = _find_closest_index_ordered(array=s.signals[:,0], target=feature.signals[-1][0], 
-                                                  tol=d.params.mz_tol_ms1)
+            if use_numba:
+                min_idx = claimed[i] if claimed[i] >= 0 else None
+            else:
+                min_idx = _find_closest_index_ordered(array=mz_arr, target=feature.signals[-1][0], 
+                                                      tol=d.params.mz_tol_ms1)
             if min_idx is not None and avlb_signals[min_idx]:
-                feature.extend(rt=s.time, signal=s.signals[min_idx], scan_idx=ms1_idx)
+                feature.extend(rt=scan_time, signal=signals[min_idx], scan_idx=ms1_idx)
                 feature.gap_counter = 0
                 avlb_signals[min_idx] = False
                 avlb_features[i] = False
             else:
-                feature.extend(rt=s.time, signal=[feature.signals[-1][0], 0], scan_idx=ms1_idx)
+                feature.extend(rt=scan_time, signal=[feature.signals[-1][0], 0], scan_idx=ms1_idx)
                 feature.gap_counter = feature.gap_counter + 1
                 if feature.gap_counter > d.params.feature_gap_tol:
                     to_be_moved.append(i)
 
         # Move the features that have not been visited for a long time to final_features
         for i in to_be_moved[::-1]:
-            final_features.append(features.pop(i))
+            feature = features.pop(i)
+            if prune and _is_short_roi([sig[1] for sig in feature.signals], min_length, min_height):
+                n_pruned += 1
+            else:
+                final_features.append(feature)
         
         # Create new rois for the remaining signals
-        for i, signal in enumerate(s.signals):
+        for i, signal in enumerate(signals):
             if avlb_signals[i]:
                 feature = Feature()
-                feature.extend(rt=s.time, signal=signal, scan_idx=ms1_idx)
+                feature.extend(rt=scan_time, signal=signal, scan_idx=ms1_idx)
                 features.append(feature)
 
         features.sort(key=lambda x: x.signals[-1][1], reverse=True)
 
     # Move all features to final_features
     for feature in features:
-        final_features.append(feature)
+        if prune and _is_short_roi([sig[1] for sig in feature.signals], min_length, min_height):
+            n_pruned += 1
+        else:
+            final_features.append(feature)
+    _report_pruned_rois(d, n_pruned)
     
     # summarize features
-    for feature in final_features:
-        feature.summarize(pa=False, g_score=False, a_score=False)
+    final_features = summarize_features(final_features, pa=False, g_score=False, a_score=False)
     
     # sort by m/z
     final_features.sort(key=lambda x: x.mz)
@@ -269,6 +705,189 @@ def detect_features(d):
     return final_features
 
 
+def _detect_features_vectorized(d, n_jobs=1):
+    """
+    Array-based implementation of detect_features that gives the same features.
+
+    With n_jobs other than 1, the m/z axis is split into slabs at m/z gaps without any 
+    MS1 signal over a width of mz_tol_ms1. No ROI can reach across such a gap, so the 
+    slabs are traced independently in parallel and the features are the same as tracing 
+    the whole file.
+
+    Parameters
+    ----------
+    d: MSData object
+        An MSData object that contains the MS data.
+    n_jobs: int
+        Number of workers. -1 to use all CPUs.
+
+    Returns
+    -------
+    final_features: list
+        A list of detected features.
+    """
+
+    table = d.scans
+    ms1_idx_arr = np.asarray(d.ms1_idx_arr)
+    starts = table.offset[ms1_idx_arr]
+    ends = table.offset[ms1_idx_arr + 1]
+    # scans without signals are skipped, also by the slabs that don't have signals in them
+    is_empty = ends <= starts
+    ms1_time_arr = table.time[ms1_idx_arr]
+    mz_tol = d.params.mz_tol_ms1
+    # tracing settings: m/z tolerance, gap tolerance, minimum length and height of ROIs to keep, numba kernels
+    settings = (mz_tol, d.params.feature_gap_tol, d.params.roi_min_length, d.params.roi_min_height, d.params.use_numba)
+
+    n_workers = cpu_count() if n_jobs < 0 else max(1, n_jobs)
+    seams = None
+    if n_workers > 1:
+        counts = ends - starts
+        pos = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(int(np.sum(counts)))
+        mzs = table.mz[pos]
+        # more slabs than workers to balance the work
+        seams = _find_mz_seams(mzs, mz_tol, n_workers * 2)
+
+    if seams is None or len(seams) == 0:
+        final_features, n_pruned = _detect_features_slab(table.mz, table.intensity, starts, ends, is_empty, 
+                                                         ms1_time_arr, ms1_idx_arr, settings)
+    else:
+        ints = table.intensity[pos]
+        ordinal = np.repeat(np.arange(len(ms1_idx_arr)), counts)
+        slab = np.searchsorted(seams, mzs, side="right")
+        tasks = []
+        for i in range(len(seams) + 1):
+            v = slab == i
+            slab_bounds = np.zeros(len(ms1_idx_arr) + 1, dtype=np.int64)
+            np.cumsum(np.bincount(ordinal[v], minlength=len(ms1_idx_arr)), out=slab_bounds[1:])
+            tasks.append((mzs[v], ints[v], slab_bounds[:-1], slab_bounds[1:]))
+        del pos, mzs, ints, ordinal, slab
+
+        results = Parallel(n_jobs=n_workers, backend="loky")(
+            delayed(_detect_features_slab)(*task, is_empty, ms1_time_arr, ms1_idx_arr, settings)
+            for task in tasks
+        )
+        final_features = [f for r in results for f in r[0]]
+        n_pruned = sum(r[1] for r in results)
+    _report_pruned_rois(d, n_pruned)
+
+    # sort by m/z
+    final_features.sort(key=lambda x: x.mz)
+
+    return final_features
+
+
+def _detect_features_slab(mzs, ints, starts, ends, is_empty, ms1_time_arr, ms1_idx_arr, settings):
+    """
+    Trace and summarize the ROIs of an m/z slab (or the whole file), run by a worker. Returns the 
+    features and the number of pruned ROIs.
+    """
+
+    features, n_pruned = _trace_rois(mzs, ints, starts, ends, is_empty, ms1_time_arr, ms1_idx_arr, *settings)
+    return summarize_features(features, pa=False, g_score=False, a_score=False), n_pruned
+
+
+def _trace_rois(all_mzs, all_ints, starts, ends, is_empty, ms1_time_arr, ms1_idx_arr, mz_tol, gap_tol, 
+                min_length=0, min_height=0.0, use_numba=False, compact_size=2**22):
+    """
+    Trace ROIs over MS1 scans with a ROITracer.
+
+    Parameters
+    ----------
+    all_mzs, all_ints: numpy array
+        m/z and intensity of the signals, the signals of MS1 scan k are all_mzs[starts[k]:ends[k]].
+    starts, ends: numpy array
+        Bounds of the signals of each MS1 scan.
+    is_empty: numpy array
+        Whether an MS1 scan is skipped.
+    ms1_time_arr, ms1_idx_arr: numpy array
+        Retention times and scan indexes of the MS1 scans.
+    mz_tol, gap_tol, min_length, min_height, use_numba, compact_size:
+        See ROITracer.
+
+    Returns
+    -------
+    final_features: list
+        A list of Feature objects in the order they are closed, not summarized.
+    n_pruned: int
+        Number of dropped ROIs.
+    """
+
+    tracer = ROITracer(mz_tol, gap_tol, min_length=min_length, min_height=min_height, compact_size=compact_size,
+                       use_numba=use_numba)
+    for k in range(len(starts)):
+        if is_empty[k]:
+            continue
+        tracer.add_scan(all_mzs[starts[k]:ends[k]], all_ints[starts[k]:ends[k]], ms1_time_arr[k], ms1_idx_arr[k])
+
+    final_features = tracer.close()
+
+    return final_features, tracer.n_pruned
+
+
+def _is_short_roi(intensities, min_length, min_height):
+    """
+    Check if a ROI has fewer than min_length non-zero scans or a highest intensity lower 
+    than min_height.
+    """
+
+    if min_length <= 0 and min_height <= 0:
+        return False
+    intensities = np.asarray(intensities, dtype=np.float32)
+    return np.sum(intensities > 0) < min_length or np.max(intensities) < min_height
+
+
+def _report_pruned_rois(d, n_pruned):
+    """
+    Record the number of ROIs dropped by early pruning in the MSData object.
+    """
+
+    d.pruned_roi_number = n_pruned
+    if n_pruned > 0:
+        print("\t{} ROIs were pruned in feature detection (minimum length: {}, minimum height: {}).".format(
+            n_pruned, d.params.roi_min_length, d.params.roi_min_height))
+
+
+def _find_mz_seams(mzs, mz_tol, n_slabs):
+    """
+    Find m/z values to split signals into slabs of about the same size. A seam is only 
+    placed in a gap between neighboring signals of at least mz_tol, so that no ROI can 
+    take signals from both sides.
+
+    Parameters
+    ----------
+    mzs: numpy array
+        m/z values of all MS1 signals.
+    mz_tol: float
+        m/z tolerance for MS1.
+    n_slabs: int
+        The targeted number of slabs.
+
+    Returns
+    -------
+    seams: numpy array
+        Sorted seams, slab i contains the signals with seams[i-1] <= m/z < seams[i].
+    """
+
+    sorted_mzs = np.sort(mzs)
+    if len(sorted_mzs) < 2 or n_slabs < 2:
+        return np.empty(0, dtype=sorted_mzs.dtype)
+
+    # differences in the dtype of the signals, compared to tol as in _find_closest_index_ordered
+    diff = sorted_mzs[1:] - sorted_mzs[:-1]
+    cand = np.flatnonzero(diff.astype(np.float64) >= mz_tol) + 1
+    if len(cand) == 0:
+        return np.empty(0, dtype=sorted_mzs.dtype)
+
+    # the gap closest to each quantile of signals
+    ranks = np.arange(1, n_slabs) * len(sorted_mzs) / n_slabs
+    j = np.searchsorted(cand, ranks)
+    below = cand[np.clip(j - 1, 0, len(cand) - 1)]
+    above = cand[np.clip(j, 0, len(cand) - 1)]
+    picked = np.where(np.abs(below - ranks) <= np.abs(above - ranks), below, above)
+
+    return sorted_mzs[np.unique(picked)]
+
+
 def segment_feature(feature, method="gf-prominence", length_tol=5, noise_tol=3):
     """
     Function to segment a feature into multiple features based on the edge detection.
@@ -317,12 +936,7 @@ def segment_feature(feature, method="gf-prominence", length_tol=5, noise_tol=3):
         positions.append(lowest_int_idx)
     positions.append(len(feature.signals)-1)
     
-    segmented_features = []
-    for i in range(len(positions)-1):
-        tmp = deepcopy(feature)
-        tmp.subset(start=positions[i], end=positions[i+1]+1)
-        tmp.is_segmented = True
-        segmented_features.append(tmp)
+    segmented_features = [feature.segment(start=positions[i], end=positions[i+1]+1) for i in range(len(positions)-1)]
 
     return segmented_features
 
@@ -412,6 +1026,80 @@ def _find_closest_index_ordered(array, target, tol=0.01):
         return None
 
 
+def _find_closest_indices_ordered(array, targets, tol=0.01):
+    """
+    Vectorized _find_closest_index_ordered for many targets.
+
+    Parameters
+    ----------
+    array: numpy array
+        An ordered array.
+    targets: numpy array
+        The target values, same dtype as array.
+    tol: float
+        The tolerance for the closest value.
+
+    Returns
+    -------
+    idx: numpy array
+        The index of the closest value for each target, -1 if not found.
+    """
+
+    n = len(array)
+    idx = np.searchsorted(array, targets, side="left")
+    after = array[np.minimum(idx, n - 1)]
+    before = array[np.maximum(idx - 1, 0)]
+    # differences in the dtype of the array, compared to tol as scalars are in _find_closest_index_ordered
+    da = after - targets
+    db = targets - before
+    da_in = da.astype(np.float64) < tol
+    db_in = db.astype(np.float64) < tol
+
+    res = np.full(len(targets), -1, dtype=np.int64)
+    is_first = idx == 0
+    is_last = idx == n
+    is_mid = ~(is_first | is_last)
+    res[is_first & da_in] = 0
+    res[is_last & db_in] = n - 1
+    take_after = is_mid & (da < db) & da_in
+    take_before = is_mid & (da > db) & db_in
+    res[take_after] = idx[take_after]
+    res[take_before] = idx[take_before] - 1
+
+    return res
+
+
+def _priority_order(last_int):
+    """
+    Give the same order as a stable sort of the open ROIs by their last intensity from high 
+    to low, without sorting all of them.
+
+    ROIs without a signal in the current scan have an intensity of zero and already are in 
+    priority order, so only the ROIs that took a signal (about the number of signals in 
+    the scan) are sorted.
+
+    Parameters
+    ----------
+    last_int: numpy array
+        The last intensity of the open ROIs in the current priority order.
+
+    Returns
+    -------
+    order: numpy array
+        The new priority order.
+    """
+
+    is_zero = last_int == 0
+    is_pos = last_int > 0
+    pos = np.flatnonzero(is_pos)
+    pos = pos[np.argsort(-last_int[pos], kind="stable")]
+    # negative or NaN intensities go after the zeros, as in a full sort
+    rest = np.flatnonzero(~(is_pos | is_zero))
+    rest = rest[np.argsort(-last_int[rest], kind="stable")]
+
+    return np.concatenate((pos, np.flatnonzero(is_zero), rest))
+
+
 def _trim_signals(signals: np.ndarray) -> tuple:
     """
     Return a (first, last) half-open slice that removes leading/trailing zeros
@@ -169,11 +169,153 @@ def squared_error_to_smoothed_curve(original_signal, fit_signal):
     return np.sum(diff**2)
 
 
+def summarize_peaks(x, y, offset, rel_int_tol=0.05, len_tol=5, threshold_ratio=0.1, g_score=True, n_score=True, a_score=True):
+    """
+    Calculate the summary statistics and peak shape scores of many peaks in one pass. The 
+    peaks are given as a ragged array, peak i is x[offset[i]:offset[i+1]], y[offset[i]:offset[i+1]].
+    Results are the same as calculating them peak by peak (see Feature.summarize), also the 
+    order of floating point summations is kept.
+
+    Parameters
+    ----------
+    x: numpy array
+        Retention times, float64.
+    y: numpy array
+        MS1 signal intensities, float32.
+    offset: numpy array
+        Start of each peak and the end of the last peak. Peaks cannot be empty.
+    rel_int_tol, len_tol: float, int
+        Parameters of calculate_noise_score. len_tol is also used by calculate_gaussian_similarity.
+    threshold_ratio: float
+        Parameter of calculate_asymmetry_factor.
+    g_score, n_score, a_score: bool
+        Whether to calculate the Gaussian similarity, noise score and asymmetry factor.
+
+    Returns
+    -------
+    dict
+        "apex" (position of the apex in x and y), "length", "height", "area", "top_average" and 
+        "fwhm" as numpy arrays, and "gaussian_similarity", "noise_score" and "asymmetry_factor" 
+        as lists with the same values and types as the single peak functions.
+    """
+
+    offset = np.asarray(offset, dtype=np.int64)
+    starts = offset[:-1]
+    counts = np.diff(offset)
+    m = len(counts)
+    total = int(offset[-1]) if m > 0 else 0
+    seg = np.repeat(np.arange(m), counts)
+    local = np.arange(total) - starts[seg]
+    y64 = y.astype(np.float64)
+
+    results = {}
+    if m == 0:
+        for key in ["apex", "length", "height", "area", "top_average", "fwhm"]:
+            results[key] = np.empty(0)
+        for key in ["gaussian_similarity", "noise_score", "asymmetry_factor"]:
+            results[key] = []
+        return results
+
+    # apex, the first maximum
+    seg_max = np.maximum.reduceat(y, starts)
+    apex_local = np.minimum.reduceat(np.where(y == seg_max[seg], local, total), starts)
+    apex = starts + apex_local
+    results["apex"] = apex
+    results["length"] = np.add.reduceat((y > 0).astype(np.int64), starts)
+    results["height"] = y[apex].astype(np.int64)
+
+    # area by the trapezoidal rule
+    p = np.flatnonzero(local < counts[seg] - 1)
+    terms = (x[p + 1] - x[p]) * (y[p + 1] + y[p]) / 2.0
+    results["area"] = (_segment_sum(terms, starts - np.arange(m), counts - 1) * 60).astype(np.int64)
+
+    # average of the highest three intensities
+    y_sorted = y[np.lexsort((y, seg))]
+    k = np.minimum(counts, 3)
+    top_sum = _segment_sum(y_sorted, starts + counts - k, k)
+    results["top_average"] = (top_sum.astype(np.float64) / k).astype(np.float32).astype(np.int64)
+
+    # full width at half maximum, bounded by the first and last points
+    is_valid = (counts >= len_tol) & (seg_max > 0)
+    apex_rt = x[apex]
+    is_low = y < (seg_max.astype(np.float64) / 2).astype(np.float32)[seg]
+    right = np.minimum.reduceat(np.where(is_low & (local >= apex_local[seg]), local, total), starts)
+    left = np.maximum.reduceat(np.where(is_low & (local < apex_local[seg]), local, -1), starts)
+    c1 = np.where(right < total, x[np.minimum(starts + right, total - 1)], x[offset[1:] - 1]) - apex_rt
+    c2 = apex_rt - np.where(left >= 0, x[starts + np.maximum(left, 0)], x[starts])
+    fwhm = c1 + c2
+    results["fwhm"] = fwhm
+
+    if g_score:
+        c = np.where(fwhm > 0, fwhm / 2.355, 1e-6)
+        y_fit = seg_max.astype(np.float64)[seg] * np.exp(-0.5 * ((x - apex_rt[seg]) / c[seg]) ** 2)
+        g = [0.0] * m
+        # the means and dot products are left to NumPy and BLAS peak by peak, as in
+        # calculate_gaussian_similarity, a sum of all peaks at once is rounded differently
+        for i in np.flatnonzero(is_valid):
+            a, b = y64[offset[i]:offset[i+1]], y_fit[offset[i]:offset[i+1]]
+            a = a - a.mean()
+            b = b - b.mean()
+            similarity = dot(a, b) / (np.sqrt(a.dot(a)) * np.sqrt(b.dot(b)) + 1e-12)
+            g[i] = max(0, similarity)
+        results["gaussian_similarity"] = g
+
+    if n_score:
+        is_kept = y > (seg_max.astype(np.float64) * rel_int_tol).astype(np.float32)[seg]
+        kept_counts = np.bincount(seg[is_kept], minlength=m)
+        kept = y64[is_kept]
+        kept_seg = seg[is_kept]
+        kept_starts = np.cumsum(kept_counts) - kept_counts
+        # differences of [0, y..., 0], peak i has kept_counts[i] + 1 of them
+        prev = np.zeros(len(kept))
+        is_first = np.arange(len(kept)) == kept_starts[kept_seg]
+        prev[~is_first] = kept[:-1][~is_first[1:]]
+        diff_starts = kept_starts + np.arange(m)
+        diffs = np.zeros(len(kept) + m)
+        diffs[np.arange(len(kept)) + kept_seg] = kept - prev
+        last = kept_starts + kept_counts - 1
+        has_kept = kept_counts > 0
+        diffs[(diff_starts + kept_counts)[has_kept]] = 0 - kept[last[has_kept]]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            noise = _segment_sum(np.abs(diffs), diff_starts, kept_counts + 1) / seg_max.astype(np.float64) / 2 - 1
+        results["noise_score"] = [noise[i] if kept_counts[i] >= len_tol else 0 for i in range(m)]
+
+    if a_score:
+        is_low = y < (seg_max.astype(np.float64) * threshold_ratio).astype(np.float32)[seg]
+        left = np.maximum.reduceat(np.where(is_low & (local < apex_local[seg]), local, -1), starts)
+        left = np.maximum(left, 0)
+        right = np.minimum.reduceat(np.where(is_low & (local >= apex_local[seg]), local, total), starts)
+        right = np.where(right < total, right, counts - 1)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            factor = (right - apex_local) / (apex_local - left)
+        is_valid = (counts >= 5) & (seg_max > 0)
+        results["asymmetry_factor"] = [(99.0 if apex_local[i] == left[i] else factor[i]) if is_valid[i] else np.inf 
+                                       for i in range(m)]
+
+    return results
+
+
 """
 Helper functions
 ------------------------------------------------------------------------------------------------------------------------
 """
 
+def _segment_sum(values, starts, counts):
+    """
+    Sum of each segment values[starts[i]:starts[i]+counts[i]]. Segments of the same length 
+    are summed as rows of a 2D array, which gives the same result as np.sum of each segment 
+    (unlike np.add.reduceat, which sums in a different order).
+    """
+
+    out = np.zeros(len(starts), dtype=values.dtype)
+    for n in np.unique(counts):
+        if n <= 0:
+            continue
+        v = np.flatnonzero(counts == n)
+        out[v] = values[starts[v, None] + np.arange(n)].sum(axis=1)
+    return out
+
+
 # calculate the Gaussian similarity
 def _gaussian(x, a, b, c):
     """
@@ -12,8 +12,9 @@ from tqdm import tqdm
 import pickle
 
 from .params import Params
-from .raw_data_utils import read_raw_file_to_obj, MSData
+from .raw_data_utils import read_raw_file_to_obj, find_reload_file, MSData
 from .utils_functions import extract_signals_from_string, POS_ADDUCTS, NEG_ADDUCTS
+from .kernels import is_enabled, pearson_positive
 
 
 def group_features_after_alignment(features: list, params: Params):
@@ -45,6 +46,7 @@ def group_features_after_alignment(features: list, params: Params):
     # initialization
     mz_arr = np.array([f.mz for f in features])
     rt_arr = np.array([f.rt for f in features])
+    ref_file_arr = np.array([f.reference_file for f in features], dtype=object)
     is_grouped = np.zeros(len(features), dtype=bool)
     feature_group_id = 1
     default_adduct = "[M+H]+" if params.ion_mode.lower() == "positive" else "[M-H]-"
@@ -60,6 +62,8 @@ def group_features_after_alignment(features: list, params: Params):
     from collections import OrderedDict
     RAW_CACHE_MAXSIZE = 40
     raw_data_cache = OrderedDict()
+    # EICs of the features, extracted in a batch when their reference file is loaded
+    feature_eics = {}
 
     def get_raw(ref_file: str):
         # hit
@@ -69,17 +73,27 @@ def group_features_after_alignment(features: list, params: Params):
             return d
 
         # miss → load
-        fn = os.path.join(params.tmp_file_dir, ref_file + ".mzpkl")
-        if not os.path.exists(fn):
-            print(f"Reference file {fn} not found for feature grouping. Skipping...")
+        fn = find_reload_file(params.tmp_file_dir, ref_file)
+        if fn is None:
+            print(f"Reference file {ref_file} not found in {params.tmp_file_dir} for feature grouping. Skipping...")
             return None
 
-        d = read_raw_file_to_obj(fn)
+        # memory-map mzh5 peaks since many files are cached at the same time, the sidecar
+        # is written next to the intermediate file in tmp_file_dir
+        d = read_raw_file_to_obj(fn, mmap=True, write_sidecar=True)
 
         func = rt_cor_functions.get(ref_file)
         if func is not None:
             d.correct_retention_time(func)
 
+        # extract the EICs of all features from this file at once, the m/z index is 
+        # dropped afterwards to keep the memory of cached files low
+        v = np.where(ref_file_arr == ref_file)[0]
+        v = np.array([j for j in v if j not in feature_eics], dtype=int)
+        for j, eic in zip(v, d.get_eics(mz_arr[v], rt_arr[v], mz_tol=0.01, rt_tol=0.2)):
+            feature_eics[j] = eic[1]
+        d._mz_index = None
+
         # evict LRU if full
         if len(raw_data_cache) >= RAW_CACHE_MAXSIZE:
             _, old_d = raw_data_cache.popitem(last=False)
@@ -111,7 +125,7 @@ def group_features_after_alignment(features: list, params: Params):
             continue
         
         # feature EIC needs to be extracted again
-        _, eic_a, _ = d.get_eic_data(f.mz, f.rt, mz_tol=0.01, rt_tol=0.2)
+        eic_a = feature_eics[i]
 
         # in rare cases, the EIC may not be found owing to large RT shift
         if len(eic_a) == 0:
@@ -154,7 +168,7 @@ def group_features_after_alignment(features: list, params: Params):
                 v = np.where(mask)[0]
                 vi = v[np.argmin(np.abs(rt_arr[v] - f.rt))]
                 _, eic_b, _ = d.get_eic_data(mz_arr[vi], f.rt, mz_tol=0.01, rt_tol=0.2)
-                scan_scan_cor = scan_to_scan_cor_intensity(eic_a[:, 1], eic_b[:, 1])
+                scan_scan_cor = scan_to_scan_cor_intensity(eic_a[:, 1], eic_b[:, 1], use_numba=params.use_numba)
                 
                 if scan_scan_cor > params.scan_scan_cor_tol:
                     is_grouped[vi] = True
@@ -220,6 +234,8 @@ def group_features_single_file(d: MSData, rt_tol: float = 0.05) -> None:
     is_grouped = np.zeros(len(d.features), dtype=bool)
     feature_group_id = 1
     default_adduct = "[M+H]+" if d.params.ion_mode.lower() == "positive" else "[M-H]-"
+    # EICs below are extracted from the m/z index
+    d.build_mz_index()
 
     # find isotopes, adducts and in-source fragments for each feature
     for i, f in enumerate(tqdm(d.features)):
@@ -276,7 +292,7 @@ def group_features_single_file(d: MSData, rt_tol: float = 0.05) -> None:
                 v = np.where(mask)[0]
                 vi = v[np.argmin(np.abs(rt_arr[v] - f.rt))]
                 _, eic, _ = d.get_eic_data(mz_arr[vi], f.rt, rt_range=rt_range)
-                scan_scan_cor = scan_to_scan_cor_intensity(peak_main, eic[:, 1])
+                scan_scan_cor = scan_to_scan_cor_intensity(peak_main, eic[:, 1], use_numba=d.params.use_numba)
                 
                 if scan_scan_cor > d.params.scan_scan_cor_tol:
                     is_grouped[vi] = True
@@ -415,7 +431,7 @@ Helper functions and constants
 ==============================
 """
 
-def scan_to_scan_cor_intensity(a: np.array, b: np.array) -> float:
+def scan_to_scan_cor_intensity(a: np.array, b: np.array, use_numba: bool = False) -> float:
     """
     Calculate the scan-to-scan correlation (Pearson correlation) between two intensity arrays.
 
@@ -425,6 +441,9 @@ def scan_to_scan_cor_intensity(a: np.array, b: np.array) -> float:
         Intensity array of the first m/z
     b: np.array
         Intensity array of the second m/z
+    use_numba: bool
+        Whether to use the numba kernel if numba is installed. The correlation is the same 
+        up to the rounding of the sums.
     
     Returns
     -------
@@ -432,6 +451,9 @@ def scan_to_scan_cor_intensity(a: np.array, b: np.array) -> float:
         The scan-to-scan correlation (Pearson correlation) between the two intensity arrays.
     """
 
+    if is_enabled(use_numba):
+        return pearson_positive(np.asarray(a), np.asarray(b))
+
     v = (a>0) & (b>0)
 
     # if the commonly detected points are less than 3, ignore the correlation calculation and return 1.0
@@ -0,0 +1,249 @@
+# Author: Huaxu Yu
+
+# A module to share the processing of individual files among computers through a job queue in the project directory
+
+"""
+The queue is a SQLite database (project_files/job_queue.sqlite) on a file system shared
+by all computers, so no server is needed. Each job is the feature detection of one
+sample with the key of its detection stage (see stage_cache.py).
+
+The parameters are prepared once when the jobs are added and saved next to the queue
+(project_files/job_queue_params.pkl), so the workers only read them.
+
+A worker claims the largest pending job with a lease and renews the lease while the job
+is running (heartbeat). If a worker stops without finishing its job (e.g. the node is
+shut down), the lease expires and the job goes back to the queue, until a job has been
+started max_attempts times. Only the worker that holds the lease can finish a job.
+
+Claims are done in one write transaction, which relies on the file locks of SQLite. Most
+shared file systems support them (NFSv4, Lustre, GPFS). The journal is not set to WAL,
+which does not work on network file systems.
+"""
+
+import time
+import sqlite3
+
+
+JOB_QUEUE_FILE = "job_queue.sqlite"
+JOB_PARAMS_FILE = "job_queue_params.pkl"       # the prepared parameters of the jobs, loaded by the workers
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    name TEXT PRIMARY KEY,
+    file_name TEXT NOT NULL,
+    file_size INTEGER NOT NULL,
+    key TEXT NOT NULL,
+    status TEXT NOT NULL,
+    worker TEXT,
+    lease_expires REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    started REAL,
+    finished REAL,
+    output_hash TEXT,
+    peak_memory INTEGER,
+    error TEXT
+)
+"""
+
+
+class JobQueue:
+    """
+    A queue of single-file jobs stored in a SQLite database. Job status is pending, running,
+    done or failed.
+    """
+
+    def __init__(self, path, max_attempts=3, timeout=60.0):
+        """
+        Open or create a queue.
+
+        Parameters
+        ----------
+        path: str
+            Path to the SQLite database.
+        max_attempts: int
+            A job whose lease expired this many times is failed instead of queued again.
+        timeout: float
+            Seconds to wait for the lock of the database held by other workers.
+        """
+
+        self.path = path
+        self.max_attempts = max_attempts
+        self.timeout = timeout
+
+        with self._connect() as conn:
+            conn.execute(_SCHEMA)
+
+
+    def _connect(self):
+        # a new connection for every operation, so a queue can be used by threads and forked processes
+        conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+        return _Transaction(conn)
+
+
+    def add(self, jobs):
+        """
+        Add jobs to the queue. A job of a sample that is pending, running or done with the
+        same key is kept, other jobs of the sample are replaced.
+
+        Parameters
+        ----------
+        jobs: list
+            A list of (name, file_name, file_size, key). file_name is relative to the project
+            directory if the file is in it, so the computers can mount it at different paths.
+
+        Returns
+        -------
+        int
+            Number of jobs added.
+        """
+
+        n = 0
+        with self._connect() as conn:
+            for name, file_name, size, key in jobs:
+                row = conn.execute("SELECT key, status FROM jobs WHERE name = ?", (name,)).fetchone()
+                if row is not None and row[0] == key and row[1] != "failed":
+                    continue
+                conn.execute("INSERT OR REPLACE INTO jobs (name, file_name, file_size, key, status) VALUES (?, ?, ?, ?, 'pending')",
+                             (name, file_name, size, key))
+                n += 1
+        return n
+
+
+    def claim(self, worker, lease_time):
+        """
+        Claim the largest pending job. Running jobs whose lease expired are queued again first.
+
+        Parameters
+        ----------
+        worker: str
+            The name of the worker, unique among all computers.
+        lease_time: float
+            Seconds before the job is queued again if the lease is not renewed.
+
+        Returns
+        -------
+        job: dict
+            The claimed job with name, file_name and key, None if no job is pending.
+        """
+
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute("""UPDATE jobs SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END,
+                            worker = NULL, error = 'lease expired' WHERE status = 'running' AND lease_expires < ?""",
+                         (self.max_attempts, now))
+            row = conn.execute("SELECT name, file_name, key FROM jobs WHERE status = 'pending' ORDER BY file_size DESC, name LIMIT 1").fetchone()
+            if row is None:
+                return None
+            conn.execute("""UPDATE jobs SET status = 'running', worker = ?, lease_expires = ?, attempts = attempts + 1,
+                            started = ?, error = NULL WHERE name = ?""", (worker, now + lease_time, now, row[0]))
+        return {"name": row[0], "file_name": row[1], "key": row[2]}
+
+
+    def heartbeat(self, name, worker, lease_time):
+        """
+        Renew the lease of a running job.
+
+        Returns
+        -------
+        bool
+            False if the worker no longer holds the lease.
+        """
+
+        with self._connect() as conn:
+            cur = conn.execute("UPDATE jobs SET lease_expires = ? WHERE name = ? AND worker = ? AND status = 'running'",
+                               (time.time() + lease_time, name, worker))
+            return cur.rowcount == 1
+
+
+    def finish(self, name, worker, output_hash=None, peak_memory=None, error=None):
+        """
+        Finish a running job as done, or failed if an error is given.
+
+        Parameters
+        ----------
+        name: str
+            The name of the job.
+        worker: str
+            The name of the worker.
+        output_hash: str
+            Hash of the output file of the job.
+        peak_memory: int
+            The peak memory of the job in bytes.
+        error: str
+            The error if the job failed.
+
+        Returns
+        -------
+        bool
+            False if the worker no longer holds the lease, in which case nothing is changed.
+        """
+
+        with self._connect() as conn:
+            cur = conn.execute("""UPDATE jobs SET status = ?, finished = ?, output_hash = ?, peak_memory = ?, error = ?,
+                                  lease_expires = NULL WHERE name = ? AND worker = ? AND status = 'running'""",
+                               ("failed" if error else "done", time.time(), output_hash, peak_memory, error, name, worker))
+            return cur.rowcount == 1
+
+
+    def done_jobs(self):
+        """
+        The finished jobs.
+
+        Returns
+        -------
+        dict
+            {name: (key, output_hash)}
+        """
+
+        with self._connect() as conn:
+            rows = conn.execute("SELECT name, key, output_hash FROM jobs WHERE status = 'done'").fetchall()
+        return {r[0]: (r[1], r[2]) for r in rows}
+
+
+    def counts(self):
+        """
+        Number of jobs of each status.
+
+        Returns
+        -------
+        dict
+            {status: number of jobs}
+        """
+
+        with self._connect() as conn:
+            rows = conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall()
+        counts = {"pending": 0, "running": 0, "done": 0, "failed": 0}
+        counts.update(dict(rows))
+        return counts
+
+
+    def failed_jobs(self):
+        """
+        The failed jobs.
+
+        Returns
+        -------
+        list
+            A list of (name, error).
+        """
+
+        with self._connect() as conn:
+            return conn.execute("SELECT name, error FROM jobs WHERE status = 'failed' ORDER BY name").fetchall()
+
+
+class _Transaction:
+    # a connection that runs the statements of a with block in one write transaction
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        # take the write lock at the start, so a job can not be claimed by two workers
+        self.conn.execute("BEGIN IMMEDIATE")
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            self.conn.execute("ROLLBACK" if exc_type is not None else "COMMIT")
+        finally:
+            self.conn.close()
+        return False
@@ -0,0 +1,305 @@
+# Author: Huaxu Yu
+
+# A module of optional numba-compiled kernels for the hot loops of data processing
+
+"""
+The kernels give the same results as the NumPy code they replace and are only used
+when Params.use_numba is True and numba is installed (see is_enabled). numba is not a
+dependency of MassCube, so without it the NumPy code is used.
+
+Kernels:
+1. claim_signals: matching of open ROIs to the signals of a scan in feature detection.
+2. eic_max_signals: the most intense signal in an m/z window of each scan for EICs.
+3. centroid_sorted: centroiding of signals sorted by m/z.
+4. pearson_positive: scan-to-scan correlation over the points detected in both EICs.
+"""
+
+import numpy as np
+
+try:
+    import numba
+    HAS_NUMBA = True
+except ImportError:
+    numba = None
+    HAS_NUMBA = False
+
+
+_warned = False
+
+
+def is_enabled(use_numba):
+    """
+    Check if the numba kernels should be used.
+
+    Parameters
+    ----------
+    use_numba: bool
+        The setting of Params.use_numba.
+
+    Returns
+    -------
+    bool
+        True if use_numba is True and numba is installed. A warning is printed once if
+        numba is requested but not installed.
+    """
+
+    global _warned
+
+    if not use_numba:
+        return False
+    if not HAS_NUMBA and not _warned:
+        print("\tnumba is not installed, NumPy code is used instead. Install it with: pip install numba")
+        _warned = True
+    return HAS_NUMBA
+
+
+def _jit(func):
+    """
+    Compile a function with numba if it is installed, otherwise keep the Python function.
+    """
+
+    if HAS_NUMBA:
+        return numba.njit(cache=True, nogil=True)(func)
+    return func
+
+
+@_jit
+def _closest_index(array, target, tol):
+    # same as feature_detection._find_closest_index_ordered, -1 if not found
+    n = len(array)
+    lo = 0
+    hi = n
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if array[mid] < target:
+            lo = mid + 1
+        else:
+            hi = mid
+    if lo == 0:
+        # differences are in the dtype of the array and compared to tol in float64
+        if np.float64(array[0] - target) < tol:
+            return 0
+        return -1
+    if lo == n:
+        if np.float64(target - array[n - 1]) < tol:
+            return n - 1
+        return -1
+    da = array[lo] - target
+    db = target - array[lo - 1]
+    if da < db and np.float64(da) < tol:
+        return lo
+    if da > db and np.float64(db) < tol:
+        return lo - 1
+    return -1
+
+
+@_jit
+def claim_signals(array, targets, tol):
+    """
+    Match each target to the closest value of an ordered array within tol. Targets claim
+    values in order, so a value that is the closest to several targets is only taken by
+    the first one.
+
+    Parameters
+    ----------
+    array: numpy array
+        An ordered array, e.g. m/z of the signals in a scan.
+    targets: numpy array
+        The target values in priority order, same dtype as array.
+    tol: float
+        The tolerance for the closest value.
+
+    Returns
+    -------
+    claimed: numpy array
+        The index of the claimed value for each target, -1 if not found or already taken.
+    """
+
+    claimed = np.full(len(targets), -1, dtype=np.int64)
+    if len(array) == 0:
+        return claimed
+    is_available = np.ones(len(array), dtype=np.bool_)
+    for i in range(len(targets)):
+        j = _closest_index(array, targets[i], tol)
+        if j >= 0 and is_available[j]:
+            claimed[i] = j
+            is_available[j] = False
+    return claimed
+
+
+@_jit
+def eic_max_signals(offset, all_mzs, all_ints, scan_idx_arr, lo, hi):
+    """
+    Find the most intense signal with lo <= m/z <= hi in each scan, the first one in m/z
+    order on ties.
+
+    Parameters
+    ----------
+    offset: numpy array
+        Offsets of the scans, the signals of scan i are all_mzs[offset[i]:offset[i+1]].
+    all_mzs, all_ints: numpy array
+        m/z (ascending within a scan) and intensity of all signals.
+    scan_idx_arr: numpy array
+        Indexes of the scans.
+    lo, hi: float
+        The m/z window.
+
+    Returns
+    -------
+    eic_mz, eic_int: numpy array
+        m/z (NaN if not found) and intensity (0 if not found) for each scan in float32.
+    """
+
+    n = len(scan_idx_arr)
+    eic_mz = np.full(n, np.nan, dtype=np.float32)
+    eic_int = np.zeros(n, dtype=np.float32)
+    for out_i in range(n):
+        scan_i = scan_idx_arr[out_i]
+        s0 = offset[scan_i]
+        s1 = offset[scan_i + 1]
+        # first signal >= lo by binary search, signals are compared in float64 as np.searchsorted
+        a = s0
+        b = s1
+        while a < b:
+            mid = (a + b) // 2
+            if np.float64(all_mzs[mid]) < lo:
+                a = mid + 1
+            else:
+                b = mid
+        best = -1
+        j = a
+        while j < s1 and np.float64(all_mzs[j]) <= hi:
+            if best < 0 or all_ints[j] > all_ints[best]:
+                best = j
+            j += 1
+        if best >= 0:
+            eic_mz[out_i] = all_mzs[best]
+            eic_int[out_i] = all_ints[best]
+    return eic_mz, eic_int
+
+
+@_jit
+def _pairwise_sum(x, start, end):
+    # the pairwise summation of NumPy (8 partial sums in blocks of up to 128 values), end > start
+    n = end - start
+    if n < 8:
+        res = x[start]
+        for i in range(start + 1, end):
+            res += x[i]
+        return res
+    if n <= 128:
+        r0 = x[start]
+        r1 = x[start + 1]
+        r2 = x[start + 2]
+        r3 = x[start + 3]
+        r4 = x[start + 4]
+        r5 = x[start + 5]
+        r6 = x[start + 6]
+        r7 = x[start + 7]
+        i = 8
+        while i < n - (n % 8):
+            r0 += x[start + i]
+            r1 += x[start + i + 1]
+            r2 += x[start + i + 2]
+            r3 += x[start + i + 3]
+            r4 += x[start + i + 4]
+            r5 += x[start + i + 5]
+            r6 += x[start + i + 6]
+            r7 += x[start + i + 7]
+            i += 8
+        res = ((r0 + r1) + (r2 + r3)) + ((r4 + r5) + (r6 + r7))
+        while i < n:
+            res += x[start + i]
+            i += 1
+        return res
+    n2 = n // 2
+    n2 -= n2 % 8
+    return _pairwise_sum(x, start, start + n2) + _pairwise_sum(x, start + n2, end)
+
+
+@_jit
+def centroid_sorted(mz, intensity, mz_tol):
+    """
+    Centroid signals sorted by m/z. A group starts where the m/z difference to the previous
+    signal is at least mz_tol, and is merged to the intensity-weighted m/z and the summed
+    intensity. Sums are in the dtype of the signals and in the order of np.add.reduceat
+    (the first value plus the pairwise sum of the others).
+
+    Parameters
+    ----------
+    mz, intensity: numpy array
+        m/z in ascending order and intensity of the signals.
+    mz_tol: float
+        m/z tolerance in the dtype of mz.
+
+    Returns
+    -------
+    weighted_mz, sum_intensity: numpy array
+        The centroided signals.
+    """
+
+    n = len(mz)
+    weighted_mz = np.empty(n, dtype=mz.dtype)
+    sum_intensity = np.empty(n, dtype=intensity.dtype)
+    product = mz * intensity
+    k = 0
+    start = 0
+    for i in range(1, n + 1):
+        if i == n or mz[i] - mz[i - 1] >= mz_tol:
+            s_int = intensity[start]
+            s_mz = product[start]
+            if i - start > 1:
+                s_int += _pairwise_sum(intensity, start + 1, i)
+                s_mz += _pairwise_sum(product, start + 1, i)
+            weighted_mz[k] = s_mz / s_int
+            sum_intensity[k] = s_int
+            k += 1
+            start = i
+    return weighted_mz[:k], sum_intensity[:k]
+
+
+@_jit
+def pearson_positive(a, b):
+    """
+    Pearson correlation between two intensity arrays over the points that are positive
+    in both. Equal to np.corrcoef up to the rounding of the sums.
+
+    Parameters
+    ----------
+    a, b: numpy array
+        Intensity arrays of the same length.
+
+    Returns
+    -------
+    cor: float
+        The correlation, 1.0 if fewer than 3 points are positive in both.
+    """
+
+    n = 0
+    mean_a = 0.0
+    mean_b = 0.0
+    for i in range(len(a)):
+        if a[i] > 0 and b[i] > 0:
+            n += 1
+            mean_a += np.float64(a[i])
+            mean_b += np.float64(b[i])
+    if n < 3:
+        return 1.0
+    mean_a /= n
+    mean_b /= n
+
+    s_ab = 0.0
+    s_aa = 0.0
+    s_bb = 0.0
+    for i in range(len(a)):
+        if a[i] > 0 and b[i] > 0:
+            da = np.float64(a[i]) - mean_a
+            db = np.float64(b[i]) - mean_b
+            s_ab += da * db
+            s_aa += da * da
+            s_bb += db * db
+    if s_aa == 0 or s_bb == 0:
+        return np.nan
+    cor = s_ab / np.sqrt(s_aa) / np.sqrt(s_bb)
+    # clipped as np.corrcoef
+    return min(max(cor, -1.0), 1.0)
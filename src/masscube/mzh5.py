@@ -4,7 +4,7 @@
 mzh5.py - HDF5 cache utilities for MassCube
 
 This module converts mzML/mzXML files into a compact hierarchical HDF5 format
-for fast reload in downstream workflows.
+for fast reload in downstream workflows, and reads the cache back to MSData.
 
 Layout
 ------
@@ -13,27 +13,46 @@ Layout
 /scans
     scan-wise metadata arrays, including offsets into the flattened peak arrays
 /peaks
-    flattened peak arrays: mz and intensity
+    flattened peak arrays: mz and intensity, chunked in blocks of consecutive scans
 /index
     convenience indexes for MS1/MS2 scans
+/mz_bins (optional)
+    MS1 peaks sorted by m/z bin and scan, with the offset of each bin, for
+    reading narrow m/z windows (see `read_window`)
 """
 
 from __future__ import annotations
 
+import hashlib
 import os
 import time
 from typing import List, Optional, Sequence, Tuple
 
 import numpy as np
-from pyteomics import mzml, mzxml
+from pyteomics import mzxml
 
 from .params import Params, find_ms_info
-from .raw_data_utils import _preprocess_signals_to_scan, _safe_float
+from .raw_data_utils import ScanTable, _preprocess_signals_to_scan, _safe_float
+from .mzml_reader import iter_mzml_spectra
 
 
 MZH5_FORMAT = "masscube.mzh5"
-MZH5_VERSION = 1
+MZH5_VERSION = 2
 _SUPPORTED_RAW_EXT = (".mzml", ".mzxml")
+_H5PY_CODECS = ("lzf", "gzip", "szip")
+
+# preprocessing parameters stored in /meta that must match for a cache to be reused
+_PREPROCESSING_KEYS = (
+    "centroid_mz_tol",
+    "ms1_abs_int_tol",
+    "ms2_abs_int_tol",
+    "ms2_rel_int_tol",
+    "precursor_mz_offset",
+    "rt_lower_limit",
+    "rt_upper_limit",
+    "mz_lower_limit",
+    "mz_upper_limit",
+)
 
 
 def _require_h5py():
@@ -43,9 +62,60 @@ def _require_h5py():
         raise ImportError(
             "h5py is required for mzh5 conversion. Install it with: pip install h5py"
         ) from exc
+    try:
+        import hdf5plugin  # type: ignore  # noqa: F401  registers the extra codecs if installed
+    except ImportError:
+        pass
     return h5py
 
 
+def _compression_kwargs(compression: Optional[str], compression_opts: Optional[int]) -> dict:
+    """
+    Dataset keyword arguments for a codec. "lzf", "gzip" and "szip" are built
+    into h5py. "zstd", "lz4" and "blosc[:<cname>]" (e.g. "blosc:zstd") require
+    the optional hdf5plugin package, which is also needed to read such files.
+    """
+
+    if compression is None:
+        return {}
+
+    if compression in _H5PY_CODECS:
+        kwargs = {"compression": compression, "shuffle": True}
+        if compression_opts is not None:
+            kwargs["compression_opts"] = compression_opts
+        return kwargs
+
+    try:
+        import hdf5plugin  # type: ignore
+    except ImportError as exc:
+        raise ImportError(
+            f"hdf5plugin is required for {compression} compression. Install it with: pip install hdf5plugin"
+        ) from exc
+
+    if compression == "zstd":
+        return dict(hdf5plugin.Zstd(clevel=3 if compression_opts is None else compression_opts))
+    if compression == "lz4":
+        return dict(hdf5plugin.LZ4())
+    if compression.startswith("blosc"):
+        cname = compression.split(":", 1)[1] if ":" in compression else "lz4"
+        return dict(hdf5plugin.Blosc(cname=cname, clevel=5 if compression_opts is None else compression_opts,
+                                     shuffle=hdf5plugin.Blosc.SHUFFLE))
+    raise ValueError(f"Unsupported compression: {compression}")
+
+
+def _peak_chunk_size(counts: np.ndarray, chunk_scans: int) -> Optional[int]:
+    """
+    Chunk length of the peak datasets, about `chunk_scans` non-empty scans per
+    chunk, so that reading a short RT range only decompresses a few chunks.
+    """
+
+    n_peaks = int(counts.sum())
+    if n_peaks == 0:
+        return None
+    size = int(np.mean(counts[counts > 0]) * chunk_scans)
+    return int(min(max(size, 1024), 1 << 20, n_peaks))
+
+
 def _prepare_params(
     file_name: str,
     params: Optional[Params],
@@ -101,15 +171,6 @@ def _unit_info(value, default: str = "minute") -> str:
     return str(unit).lower()
 
 
-def _mzml_scan_time(spec, time_unit) -> float:
-    scan = spec.get("scanList", {}).get("scan", [{}])[0]
-    scan_time = scan.get("scan start time", scan.get("scan time", 0.0))
-    scan_time = float(scan_time)
-    if str(time_unit).lower() == "second":
-        scan_time /= 60.0
-    return scan_time
-
-
 def _mzxml_scan_time(spec, time_unit) -> float:
     scan_time = float(spec.get("retentionTime", 0.0))
     if str(time_unit).lower() == "second":
@@ -117,30 +178,6 @@ def _mzxml_scan_time(spec, time_unit) -> float:
     return scan_time
 
 
-def _get_mzml_ms2_fields(spec) -> Tuple[Optional[float], Optional[Tuple[float, float]]]:
-    precursor_mz = None
-    isolation_window = [1.5, 1.5]
-
-    precursor_list = spec.get("precursorList", {}).get("precursor", [])
-    if len(precursor_list) == 0:
-        return None, None
-
-    precursor = precursor_list[0]
-    selected = precursor.get("selectedIonList", {}).get("selectedIon", [])
-    if len(selected) > 0:
-        precursor_mz = _safe_float(selected[0].get("selected ion m/z"))
-
-    if "isolationWindow" in precursor:
-        iw = precursor["isolationWindow"]
-        if "isolation window lower offset" in iw and "isolation window upper offset" in iw:
-            isolation_window = [
-                _safe_float(iw["isolation window lower offset"], default=1.5),
-                _safe_float(iw["isolation window upper offset"], default=1.5),
-            ]
-
-    return precursor_mz, (float(isolation_window[0]), float(isolation_window[1]))
-
-
 def _get_mzxml_ms2_fields(spec) -> Tuple[Optional[float], Optional[Tuple[float, float]]]:
     precursor_mz = None
     isolation_window = [1.5, 1.5]
@@ -188,61 +225,114 @@ def _write_hdf5(
     ms1_scan_idx_arr: np.ndarray,
     ms2_scan_idx_arr: np.ndarray,
     ms1_time_arr: np.ndarray,
+    base_peak_arr: np.ndarray,
     peak_mz_arr: np.ndarray,
     peak_int_arr: np.ndarray,
     compression: Optional[str],
     compression_opts: Optional[int],
+    chunk_scans: int = 16,
+    mz_bin_width: Optional[float] = None,
 ) -> None:
     h5py = _require_h5py()
 
+    peak_counts = peak_end_arr - peak_start_arr
+    chunk_size = _peak_chunk_size(peak_counts, chunk_scans)
     peak_ds_kwargs = {}
-    if compression is not None:
-        peak_ds_kwargs["compression"] = compression
-        if compression_opts is not None:
-            peak_ds_kwargs["compression_opts"] = compression_opts
-        peak_ds_kwargs["shuffle"] = True
-
-    with h5py.File(output_path, "w") as h5:
-        h5.attrs["format"] = MZH5_FORMAT
-        h5.attrs["version"] = MZH5_VERSION
-        h5.attrs["created_utc"] = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
-
-        g_meta = h5.create_group("meta")
-        g_meta.attrs["source_file"] = os.path.abspath(source_file)
-        g_meta.attrs["source_format"] = source_format
-        g_meta.attrs["scan_levels"] = np.array(params.scan_levels, dtype=np.int8)
-        g_meta.attrs["ion_mode"] = str(params.ion_mode)
-        g_meta.attrs["ms_type"] = str(params.ms_type)
-        g_meta.attrs["is_centroid"] = bool(params.is_centroid)
-        g_meta.attrs["centroid_mz_tol"] = (
-            np.nan if params.centroid_mz_tol is None else float(params.centroid_mz_tol)
-        )
-        g_meta.attrs["ms1_abs_int_tol"] = float(params.ms1_abs_int_tol)
-        g_meta.attrs["ms2_abs_int_tol"] = float(params.ms2_abs_int_tol)
-        g_meta.attrs["ms2_rel_int_tol"] = float(params.ms2_rel_int_tol)
-        g_meta.attrs["precursor_mz_offset"] = (
-            np.nan if params.precursor_mz_offset is None else float(params.precursor_mz_offset)
-        )
-        g_meta.attrs["rt_lower_limit"] = float(params.rt_lower_limit)
-        g_meta.attrs["rt_upper_limit"] = float(params.rt_upper_limit)
+    if chunk_size is not None:
+        peak_ds_kwargs = _compression_kwargs(compression, compression_opts)
+        peak_ds_kwargs["chunks"] = (chunk_size,)
 
-        g_scans = h5.create_group("scans")
-        g_scans.create_dataset("id", data=np.arange(scan_level_arr.size, dtype=np.int32))
-        g_scans.create_dataset("level", data=scan_level_arr)
-        g_scans.create_dataset("time", data=scan_time_arr)
-        g_scans.create_dataset("precursor_mz", data=precursor_arr)
-        g_scans.create_dataset("isolation_window", data=isolation_arr)
-        g_scans.create_dataset("peak_start", data=peak_start_arr)
-        g_scans.create_dataset("peak_end", data=peak_end_arr)
+    source_stat = os.stat(source_file)
 
-        g_peaks = h5.create_group("peaks")
-        g_peaks.create_dataset("mz", data=peak_mz_arr, **peak_ds_kwargs)
-        g_peaks.create_dataset("intensity", data=peak_int_arr, **peak_ds_kwargs)
+    # write to a temporary file and rename it, so an interrupted conversion never leaves a partial cache
+    tmp_path = output_path + f".{os.getpid()}.tmp"
+    try:
+        with h5py.File(tmp_path, "w") as h5:
+            h5.attrs["format"] = MZH5_FORMAT
+            h5.attrs["version"] = MZH5_VERSION
+            h5.attrs["created_utc"] = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+
+            g_meta = h5.create_group("meta")
+            g_meta.attrs["source_file"] = os.path.abspath(source_file)
+            g_meta.attrs["source_format"] = source_format
+            g_meta.attrs["source_size"] = int(source_stat.st_size)
+            g_meta.attrs["source_mtime"] = float(source_stat.st_mtime)
+            g_meta.attrs["source_hash"] = file_hash(source_file)
+            g_meta.attrs["scan_levels"] = np.array(params.scan_levels, dtype=np.int8)
+            g_meta.attrs["ion_mode"] = str(params.ion_mode)
+            g_meta.attrs["ms_type"] = str(params.ms_type)
+            g_meta.attrs["is_centroid"] = bool(params.is_centroid)
+            g_meta.attrs["centroid_mz_tol"] = (
+                np.nan if params.centroid_mz_tol is None else float(params.centroid_mz_tol)
+            )
+            g_meta.attrs["ms1_abs_int_tol"] = float(params.ms1_abs_int_tol)
+            g_meta.attrs["ms2_abs_int_tol"] = float(params.ms2_abs_int_tol)
+            g_meta.attrs["ms2_rel_int_tol"] = float(params.ms2_rel_int_tol)
+            g_meta.attrs["precursor_mz_offset"] = (
+                np.nan if params.precursor_mz_offset is None else float(params.precursor_mz_offset)
+            )
+            g_meta.attrs["rt_lower_limit"] = float(params.rt_lower_limit)
+            g_meta.attrs["rt_upper_limit"] = float(params.rt_upper_limit)
+            g_meta.attrs["mz_lower_limit"] = float(params.mz_lower_limit)
+            g_meta.attrs["mz_upper_limit"] = float(params.mz_upper_limit)
+
+            g_scans = h5.create_group("scans")
+            g_scans.create_dataset("id", data=np.arange(scan_level_arr.size, dtype=np.int32))
+            g_scans.create_dataset("level", data=scan_level_arr)
+            g_scans.create_dataset("time", data=scan_time_arr)
+            g_scans.create_dataset("precursor_mz", data=precursor_arr)
+            g_scans.create_dataset("isolation_window", data=isolation_arr)
+            g_scans.create_dataset("peak_start", data=peak_start_arr)
+            g_scans.create_dataset("peak_end", data=peak_end_arr)
+
+            g_peaks = h5.create_group("peaks")
+            g_peaks.create_dataset("mz", data=peak_mz_arr, **peak_ds_kwargs)
+            g_peaks.create_dataset("intensity", data=peak_int_arr, **peak_ds_kwargs)
+
+            g_index = h5.create_group("index")
+            g_index.create_dataset("ms1_scan_idx", data=ms1_scan_idx_arr)
+            g_index.create_dataset("ms2_scan_idx", data=ms2_scan_idx_arr)
+            g_index.create_dataset("ms1_time", data=ms1_time_arr)
+            g_index.create_dataset("base_peak", data=base_peak_arr)
+
+            if mz_bin_width is not None:
+                _write_mz_bins(h5, mz_bin_width, scan_level_arr, peak_counts, peak_mz_arr, peak_int_arr,
+                               peak_ds_kwargs)
+
+        os.replace(tmp_path, output_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def _write_mz_bins(h5, bin_width, scan_level_arr, peak_counts, peak_mz_arr, peak_int_arr, peak_ds_kwargs) -> None:
+    """
+    Write the secondary layout of MS1 peaks, sorted by m/z bin and then by scan.
+    The peaks of bin k (counted from `bin_start`) are rows bin_offsets[k]:bin_offsets[k+1].
+    """
 
-        g_index = h5.create_group("index")
-        g_index.create_dataset("ms1_scan_idx", data=ms1_scan_idx_arr)
-        g_index.create_dataset("ms2_scan_idx", data=ms2_scan_idx_arr)
-        g_index.create_dataset("ms1_time", data=ms1_time_arr)
+    scan_idx = np.repeat(np.arange(scan_level_arr.size, dtype=np.int32), peak_counts)
+    is_ms1 = scan_level_arr[scan_idx] == 1
+    scan_idx = scan_idx[is_ms1]
+    mz = peak_mz_arr[is_ms1]
+    bins = np.floor(mz / bin_width).astype(np.int64)
+    order = np.lexsort((scan_idx, bins))
+
+    bin_start = int(bins.min()) if bins.size > 0 else 0
+    n_bins = int(bins.max()) - bin_start + 1 if bins.size > 0 else 0
+    bin_offsets = np.zeros(n_bins + 1, dtype=np.int64)
+    np.cumsum(np.bincount(bins - bin_start, minlength=n_bins), out=bin_offsets[1:])
+
+    g_bins = h5.create_group("mz_bins")
+    g_bins.attrs["bin_width"] = float(bin_width)
+    g_bins.attrs["bin_start"] = bin_start
+    g_bins.create_dataset("bin_offsets", data=bin_offsets)
+    kwargs = peak_ds_kwargs if bins.size > 0 else {}
+    if "chunks" in kwargs:
+        kwargs = dict(kwargs, chunks=(min(kwargs["chunks"][0], bins.size),))
+    g_bins.create_dataset("mz", data=mz[order], **kwargs)
+    g_bins.create_dataset("intensity", data=peak_int_arr[is_ms1][order], **kwargs)
+    g_bins.create_dataset("scan_idx", data=scan_idx[order], **kwargs)
 
 
 def convert_raw_to_mzh5(
@@ -257,6 +347,10 @@ def convert_raw_to_mzh5(
     precursor_mz_offset: Optional[float] = 2.0,
     compression: Optional[str] = "lzf",
     compression_opts: Optional[int] = None,
+    npy_sidecar: bool = False,
+    skip_if_current: bool = False,
+    chunk_scans: int = 16,
+    mz_bin_width: Optional[float] = None,
 ) -> str:
     """
     Convert a mzML/mzXML file to MassCube HDF5 cache format (mzh5).
@@ -282,9 +376,22 @@ def convert_raw_to_mzh5(
     precursor_mz_offset : float or None
         Remove precursor region in MS2 using `precursor_mz - offset`.
     compression : str or None
-        Compression for peak arrays. Typical values: "lzf", "gzip", or None.
+        Compression for peak arrays: "lzf", "gzip", "szip" or None, or "zstd", "lz4"
+        and "blosc[:<cname>]" if hdf5plugin is installed.
     compression_opts : int, optional
         Compression level for codecs that support it.
+    npy_sidecar : bool
+        Also write the uncompressed `<output>.peaks.npy` sidecar used for memory-mapped
+        loading (see `read_mzh5_to_MSData`).
+    skip_if_current : bool
+        Do not convert if the output is a valid cache of the raw file with the same
+        preprocessing parameters (see `mzh5_is_current`).
+    chunk_scans : int
+        Approximate number of scans per HDF5 chunk of the peak arrays. Smaller chunks
+        make narrow RT windows cheaper to read.
+    mz_bin_width : float, optional
+        If set, also write the m/z-binned layout of MS1 peaks with this bin width in Da
+        (e.g. 1.0), which makes narrow m/z windows cheaper to read.
 
     Returns
     -------
@@ -313,6 +420,9 @@ def convert_raw_to_mzh5(
     if output_path is None:
         output_path = _default_output_path(file_name)
 
+    if skip_if_current and mzh5_is_current(output_path, file_name, params):
+        return output_path
+
     scan_level: List[int] = []
     scan_time: List[float] = []
     precursor_mz: List[float] = []
@@ -329,57 +439,51 @@ def convert_raw_to_mzh5(
     peak_cursor = 0
 
     if ext == ".mzml":
-        with mzml.MzML(file_name) as reader:
-            scan0 = reader[0]
-            scan0_meta = scan0.get("scanList", {}).get("scan", [{}])[0]
-            time_unit = _unit_info(
-                scan0_meta.get("scan start time", scan0_meta.get("scan time")),
-                default="minute",
-            )
-
-            for idx, spec in enumerate(reader):
-                level = int(spec.get("ms level", 0))
-                time_min = _mzml_scan_time(spec, time_unit)
-                precursor, iso = (None, None)
-                if level == 2:
-                    precursor, iso = _get_mzml_ms2_fields(spec)
-                signals = _to_signals(spec)
-
-                if _should_process_scan(level, time_min, params):
-                    s = _preprocess_signals_to_scan(
-                        level=level,
-                        id=idx,
-                        scan_time=time_min,
-                        signals=signals,
-                        params=params,
-                        precursor_mz=precursor,
-                        isolation_window=None if iso is None else [iso[0], iso[1]],
-                    )
-                    cleaned = s.signals
-                else:
-                    cleaned = np.empty((0, 2), dtype=np.float32)
-
-                n = 0 if cleaned is None else int(cleaned.shape[0])
-                peak_start.append(peak_cursor)
-                peak_cursor += n
-                peak_end.append(peak_cursor)
-
-                scan_level.append(level)
-                scan_time.append(float(time_min))
-                precursor_mz.append(np.nan if precursor is None else float(precursor))
-                if iso is None:
-                    isolation_window.append((np.nan, np.nan))
-                else:
-                    isolation_window.append((float(iso[0]), float(iso[1])))
-
-                if n > 0:
-                    peak_mz_chunks.append(cleaned[:, 0].astype(np.float32, copy=False))
-                    peak_int_chunks.append(cleaned[:, 1].astype(np.float32, copy=False))
-                    if level == 1:
-                        ms1_scan_idx.append(idx)
-                        ms1_time.append(float(time_min))
-                    elif level == 2:
-                        ms2_scan_idx.append(idx)
+        for spec in iter_mzml_spectra(file_name, fast=params.fast_mzml_reader):
+            idx = spec.index
+            level = spec.level
+            time_min = spec.scan_time
+            precursor, iso = (None, None)
+            if level == 2 and (spec.precursor_mz is not None or spec.isolation_window is not None):
+                precursor = spec.precursor_mz
+                iso = (1.5, 1.5) if spec.isolation_window is None else spec.isolation_window
+            signals = spec.signals
+
+            if _should_process_scan(level, time_min, params):
+                s = _preprocess_signals_to_scan(
+                    level=level,
+                    id=idx,
+                    scan_time=time_min,
+                    signals=signals,
+                    params=params,
+                    precursor_mz=precursor,
+                    isolation_window=None if iso is None else [iso[0], iso[1]],
+                )
+                cleaned = s.signals
+            else:
+                cleaned = np.empty((0, 2), dtype=np.float32)
+
+            n = 0 if cleaned is None else int(cleaned.shape[0])
+            peak_start.append(peak_cursor)
+            peak_cursor += n
+            peak_end.append(peak_cursor)
+
+            scan_level.append(level)
+            scan_time.append(float(time_min))
+            precursor_mz.append(np.nan if precursor is None else float(precursor))
+            if iso is None:
+                isolation_window.append((np.nan, np.nan))
+            else:
+                isolation_window.append((float(iso[0]), float(iso[1])))
+
+            if n > 0:
+                peak_mz_chunks.append(cleaned[:, 0].astype(np.float32, copy=False))
+                peak_int_chunks.append(cleaned[:, 1].astype(np.float32, copy=False))
+                if level == 1:
+                    ms1_scan_idx.append(idx)
+                    ms1_time.append(float(time_min))
+                elif level == 2:
+                    ms2_scan_idx.append(idx)
 
     elif ext == ".mzxml":
         with mzxml.MzXML(file_name) as reader:
@@ -431,14 +535,14 @@ def convert_raw_to_mzh5(
                         ms2_scan_idx.append(idx)
 
     scan_level_arr = np.asarray(scan_level, dtype=np.int8)
-    scan_time_arr = np.asarray(scan_time, dtype=np.float32)
-    precursor_arr = np.asarray(precursor_mz, dtype=np.float32)
-    isolation_arr = np.asarray(isolation_window, dtype=np.float32)
+    scan_time_arr = np.asarray(scan_time, dtype=np.float64)
+    precursor_arr = np.asarray(precursor_mz, dtype=np.float64)
+    isolation_arr = np.asarray(isolation_window, dtype=np.float64)
     peak_start_arr = np.asarray(peak_start, dtype=np.int64)
     peak_end_arr = np.asarray(peak_end, dtype=np.int64)
     ms1_scan_idx_arr = np.asarray(ms1_scan_idx, dtype=np.int32)
     ms2_scan_idx_arr = np.asarray(ms2_scan_idx, dtype=np.int32)
-    ms1_time_arr = np.asarray(ms1_time, dtype=np.float32)
+    ms1_time_arr = np.asarray(ms1_time, dtype=np.float64)
 
     if len(peak_mz_chunks) > 0:
         peak_mz_arr = np.concatenate(peak_mz_chunks, dtype=np.float32)
@@ -447,6 +551,13 @@ def convert_raw_to_mzh5(
         peak_mz_arr = np.empty(0, dtype=np.float32)
         peak_int_arr = np.empty(0, dtype=np.float32)
 
+    # base peak of each valid MS1 scan, so that it is available without reading all peaks
+    base_peak_arr = np.empty((ms1_scan_idx_arr.size, 2), dtype=np.float32)
+    for i, idx in enumerate(ms1_scan_idx_arr):
+        s, e = peak_start_arr[idx], peak_end_arr[idx]
+        j = s + np.argmax(peak_int_arr[s:e])
+        base_peak_arr[i] = (peak_mz_arr[j], peak_int_arr[j])
+
     _write_hdf5(
         output_path=output_path,
         source_file=file_name,
@@ -461,22 +572,32 @@ def convert_raw_to_mzh5(
         ms1_scan_idx_arr=ms1_scan_idx_arr,
         ms2_scan_idx_arr=ms2_scan_idx_arr,
         ms1_time_arr=ms1_time_arr,
+        base_peak_arr=base_peak_arr,
         peak_mz_arr=peak_mz_arr,
         peak_int_arr=peak_int_arr,
         compression=compression,
         compression_opts=compression_opts,
+        chunk_scans=chunk_scans,
+        mz_bin_width=mz_bin_width,
     )
 
+    if npy_sidecar:
+        write_peak_sidecar(output_path, np.column_stack((peak_mz_arr, peak_int_arr)))
+
     return output_path
 
 
 def batch_convert_raw_to_mzh5(
     file_names: Sequence[str],
     output_dir: Optional[str] = None,
+    n_jobs: int = 1,
+    overwrite: bool = False,
     **kwargs,
-) -> List[str]:
+) -> List[Optional[str]]:
     """
-    Convert multiple mzML/mzXML files to mzh5.
+    Convert multiple mzML/mzXML files to mzh5. Files with a valid cache are
+    skipped unless `overwrite` is True, so an interrupted or extended batch
+    can be resumed by running it again.
 
     Parameters
     ----------
@@ -484,22 +605,462 @@ def batch_convert_raw_to_mzh5(
         Input raw file paths.
     output_dir : str, optional
         Output directory for mzh5 files. If None, outputs next to each raw file.
+    n_jobs : int
+        Number of worker processes. -1 to use all CPUs.
+    overwrite : bool
+        Convert all files even if a valid cache exists.
     **kwargs
         Extra parameters forwarded to `convert_raw_to_mzh5`.
 
     Returns
     -------
-    list of str
-        Output mzh5 paths.
+    list of str or None
+        Output mzh5 paths in the order of `file_names`. None for files that
+        failed to convert.
     """
 
-    outputs: List[str] = []
+    outputs: List[Optional[str]] = []
     for fn in file_names:
         if output_dir is None:
-            out = None
+            outputs.append(None)
         else:
             os.makedirs(output_dir, exist_ok=True)
             base = os.path.splitext(os.path.basename(fn))[0]
-            out = os.path.join(output_dir, base + ".mzh5")
-        outputs.append(convert_raw_to_mzh5(file_name=fn, output_path=out, **kwargs))
-    return outputs
+            outputs.append(os.path.join(output_dir, base + ".mzh5"))
+
+    if n_jobs == 1:
+        results = [_convert_one(fn, out, overwrite, kwargs) for fn, out in zip(file_names, outputs)]
+    else:
+        from joblib import Parallel, delayed
+        results = Parallel(n_jobs=n_jobs, backend="loky")(
+            delayed(_convert_one)(fn, out, overwrite, kwargs) for fn, out in zip(file_names, outputs)
+        )
+
+    n_failed = sum(r is None for r in results)
+    if n_failed > 0:
+        print(f"{n_failed} of {len(results)} files failed to convert to mzh5.")
+
+    return results
+
+
+def _convert_one(file_name: str, output_path: Optional[str], overwrite: bool, kwargs: dict) -> Optional[str]:
+    try:
+        return convert_raw_to_mzh5(file_name=file_name, output_path=output_path,
+                                   skip_if_current=not overwrite, **kwargs)
+    except Exception as e:
+        print(f"Error converting {file_name} to mzh5: {e}")
+        return None
+
+
+def read_mzh5_meta(file_name: str) -> dict:
+    """
+    Read the conversion metadata stored in `/meta` of a mzh5 file.
+
+    Parameters
+    ----------
+    file_name : str
+        Path to the mzh5 file.
+
+    Returns
+    -------
+    dict
+        Metadata attributes. Missing optional values (stored as NaN or "None")
+        are returned as None.
+    """
+
+    h5py = _require_h5py()
+
+    with h5py.File(file_name, "r") as h5:
+        if h5.attrs.get("format") != MZH5_FORMAT:
+            raise ValueError(f"Not a MassCube mzh5 file: {file_name}")
+        meta = {k: _decode_attr(v) for k, v in h5["meta"].attrs.items()}
+        meta["version"] = int(h5.attrs.get("version", 0))
+
+    return meta
+
+
+def mzh5_matches_params(file_name: str, params: Params) -> bool:
+    """
+    Check whether a mzh5 cache was generated with the same preprocessing
+    parameters (scan levels, intensity thresholds, centroiding, RT and m/z range) as
+    `params`, so that loading it gives the same scans as parsing the raw file.
+
+    Parameters
+    ----------
+    file_name : str
+        Path to the mzh5 file.
+    params : Params
+        Parameters for the current processing.
+
+    Returns
+    -------
+    bool
+        True if the cache can be reused.
+    """
+
+    if not os.path.isfile(file_name):
+        return False
+
+    try:
+        meta = read_mzh5_meta(file_name)
+    except (ImportError, OSError, ValueError):
+        return False
+
+    if sorted(int(x) for x in meta.get("scan_levels", [])) != sorted(int(x) for x in params.scan_levels):
+        return False
+
+    for key in _PREPROCESSING_KEYS:
+        a = meta.get(key)
+        b = getattr(params, key, None)
+        if a is None or b is None:
+            if a is not b:
+                return False
+        elif not np.isclose(float(a), float(b)):
+            return False
+
+    return True
+
+
+def file_hash(file_name: str, chunk_size: int = 1 << 22) -> str:
+    """
+    Compute the BLAKE2b hash of a file's content.
+
+    Parameters
+    ----------
+    file_name : str
+        Path to the file.
+    chunk_size : int
+        Number of bytes to read at a time.
+
+    Returns
+    -------
+    str
+        Hex digest of the file content.
+    """
+
+    h = hashlib.blake2b(digest_size=20)
+    with open(file_name, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def mzh5_is_current(file_name: str, raw_file: str, params: Params) -> bool:
+    """
+    Check whether a mzh5 cache is still valid for a raw file: it was converted
+    with the same preprocessing parameters and from the same raw data. The raw
+    file is identified by its size and mtime, and its content hash is only
+    computed if the mtime changed (e.g. the file was copied).
+
+    Parameters
+    ----------
+    file_name : str
+        Path to the mzh5 file.
+    raw_file : str
+        Path to the raw file.
+    params : Params
+        Parameters for the current processing.
+
+    Returns
+    -------
+    bool
+        True if the cache can be reused.
+    """
+
+    if not mzh5_matches_params(file_name, params):
+        return False
+
+    meta = read_mzh5_meta(file_name)
+    # caches written before the source was recorded cannot be checked
+    if meta.get("source_size") is None:
+        return False
+
+    st = os.stat(raw_file)
+    if int(meta["source_size"]) != st.st_size:
+        return False
+    if meta.get("source_mtime") is not None and float(meta["source_mtime"]) == st.st_mtime:
+        return True
+    return meta.get("source_hash") == file_hash(raw_file)
+
+
+def find_mzh5_cache(file_name: str, params: Params) -> str:
+    """
+    Find a reusable mzh5 cache of a raw file (see `mzh5_is_current`). The cache
+    is searched in the temporary directory of the project first and then next
+    to the raw file.
+
+    Parameters
+    ----------
+    file_name : str
+        Path to the raw file.
+    params : Params
+        Parameters for the current processing.
+
+    Returns
+    -------
+    str
+        Path to the valid mzh5 cache, or `file_name` if no valid cache is found.
+    """
+
+    if file_name.lower().endswith(".mzh5"):
+        return file_name
+
+    candidates = []
+    if params.tmp_file_dir is not None:
+        base = os.path.splitext(os.path.basename(file_name))[0]
+        candidates.append(os.path.join(params.tmp_file_dir, base + ".mzh5"))
+    candidates.append(_default_output_path(file_name))
+
+    for fn in candidates:
+        if mzh5_is_current(fn, file_name, params):
+            return fn
+
+    return file_name
+
+
+def read_mzh5_to_MSData(d, file_name: str, mmap: bool = False, write_sidecar: bool = False) -> None:
+    """
+    Read a mzh5 file to a MSData object. The flattened peak arrays are used
+    directly as the ScanTable of the MSData object, so no per-scan arrays are
+    created.
+
+    Parameters
+    ----------
+    d : MSData
+        The MSData object. `d.params` must be set.
+    file_name : str
+        Path to the mzh5 file.
+    mmap : bool
+        If True, the peak array is memory-mapped from the uncompressed
+        `<file>.peaks.npy` sidecar instead of being loaded into memory. The
+        signals of a scan are sliced from the mapped array on first access,
+        so processes reading the same file share the pages through the OS
+        cache. Without a current sidecar, the peaks are loaded from HDF5.
+    write_sidecar : bool
+        If True, the sidecar is written when it is missing or older than the
+        mzh5 file. Otherwise nothing is written next to the mzh5 file, and the
+        sidecar is only used if it was written at conversion (`npy_sidecar`).
+    """
+
+    h5py = _require_h5py()
+
+    meta = read_mzh5_meta(file_name)
+
+    with h5py.File(file_name, "r") as h5:
+        g_scans = h5["scans"]
+        level_arr = g_scans["level"][()]
+        time_arr = g_scans["time"][()].astype(np.float64)
+        precursor_arr = g_scans["precursor_mz"][()]
+        isolation_arr = g_scans["isolation_window"][()]
+        peak_start_arr = g_scans["peak_start"][()]
+        peak_end_arr = g_scans["peak_end"][()]
+        base_peak_arr = h5["index"]["base_peak"][()] if "base_peak" in h5["index"] else None
+
+        g_peaks = h5["peaks"]
+        n_peaks = g_peaks["mz"].shape[0]
+        if mmap:
+            peaks = _load_peak_sidecar(file_name, n_peaks, write=write_sidecar)
+        if not mmap or peaks is None:
+            mmap = False
+            peaks = np.empty((n_peaks, 2), dtype=np.float32)
+            peaks[:, 0] = g_peaks["mz"][()]
+            peaks[:, 1] = g_peaks["intensity"][()]
+
+    # the loaded data reflect the preprocessing parameters used for conversion
+    params = d.params
+    params.scan_levels = [int(x) for x in meta["scan_levels"]]
+    for key in _PREPROCESSING_KEYS:
+        # files written before the m/z range was recorded keep the current values
+        if key in meta:
+            setattr(params, key, meta[key])
+    params.is_centroid = bool(meta.get("is_centroid", params.is_centroid))
+    if meta.get("ion_mode") is not None:
+        params.ion_mode = meta["ion_mode"]
+    if meta.get("ms_type") is not None:
+        params.ms_type = meta["ms_type"]
+    params.file_format = "mzh5"
+
+    # scans skipped during conversion have no signals, same as parsing the raw file
+    has_signals = (np.isin(level_arr, params.scan_levels) & (time_arr >= params.rt_lower_limit)
+                   & (time_arr <= params.rt_upper_limit))
+    precursor_arr = np.where(has_signals, precursor_arr, np.nan)
+    isolation_arr = np.where(has_signals[:, None], isolation_arr, np.nan)
+
+    # peaks are written scan by scan, so the start offsets plus the last end give the CSR offsets
+    if level_arr.size > 0 and np.array_equal(peak_start_arr[1:], peak_end_arr[:-1]) and peak_start_arr[0] == 0:
+        offset = np.append(peak_start_arr, peak_end_arr[-1])
+    else:
+        counts = peak_end_arr - peak_start_arr
+        offset = np.zeros(level_arr.size + 1, dtype=np.int64)
+        np.cumsum(counts, out=offset[1:])
+        pos = np.repeat(peak_start_arr - offset[:-1], counts) + np.arange(offset[-1])
+        peaks = np.asarray(peaks[pos])
+
+    # indexes are derived from the offsets, so mapped peaks are not touched here
+    d.scans = ScanTable(level=level_arr, time=time_arr, peaks=peaks, offset=offset, precursor_mz=precursor_arr,
+                        isolation_window=isolation_arr, has_signals=has_signals)
+    is_valid = has_signals & (np.diff(offset) > 0)
+    d.ms1_idx_arr = np.where(is_valid & (level_arr == 1))[0]
+    d.ms2_idx_arr = np.where(is_valid & (level_arr == 2))[0]
+    d.ms1_time_arr = time_arr[d.ms1_idx_arr]
+    if base_peak_arr is not None and len(base_peak_arr) == len(d.ms1_idx_arr):
+        d.base_peak_arr = base_peak_arr
+    else:
+        d.base_peak_arr = d.scans.base_peaks(d.ms1_idx_arr)
+
+
+def read_window(
+    file_name: str,
+    rt_range: Optional[Sequence[float]] = None,
+    mz_range: Optional[Sequence[float]] = None,
+    level: int = 1,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Read the signals in a retention time and m/z window of a mzh5 file. Only
+    the HDF5 chunks that overlap the window are decompressed. For MS1 windows,
+    the m/z-binned layout is used if the file has one.
+
+    Parameters
+    ----------
+    file_name : str
+        Path to the mzh5 file.
+    rt_range : sequence of float, optional
+        [start, end] of the window in minutes. None for all scans.
+    mz_range : sequence of float, optional
+        [start, end] of the window in m/z. None for all signals.
+    level : int
+        MS level of the scans to read.
+
+    Returns
+    -------
+    scan_idx : np.ndarray
+        Scan index of each signal.
+    scan_time : np.ndarray
+        Scan time of each signal.
+    signals : np.ndarray
+        The signals as [[m/z, intensity], ...], ordered by scan and m/z.
+    """
+
+    h5py = _require_h5py()
+
+    rt0, rt1 = (-np.inf, np.inf) if rt_range is None else (rt_range[0], rt_range[1])
+    mz0, mz1 = (-np.inf, np.inf) if mz_range is None else (mz_range[0], mz_range[1])
+    empty = (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64), np.empty((0, 2), dtype=np.float32))
+
+    with h5py.File(file_name, "r") as h5:
+        g_scans = h5["scans"]
+        level_arr = g_scans["level"][()]
+        time_arr = g_scans["time"][()]
+        start_arr = g_scans["peak_start"][()]
+        end_arr = g_scans["peak_end"][()]
+
+        scan_sel = np.where((level_arr == level) & (time_arr >= rt0) & (time_arr <= rt1) & (end_arr > start_arr))[0]
+        if scan_sel.size == 0:
+            return empty
+
+        if level == 1 and mz_range is not None and "mz_bins" in h5:
+            g_bins = h5["mz_bins"]
+            bin_width = float(g_bins.attrs["bin_width"])
+            bin_start = int(g_bins.attrs["bin_start"])
+            bin_offsets = g_bins["bin_offsets"][()]
+            b0 = max(int(np.floor(mz0 / bin_width)) - bin_start, 0)
+            b1 = min(int(np.floor(mz1 / bin_width)) - bin_start, bin_offsets.size - 2)
+            if b1 < b0:
+                return empty
+            lo, hi = bin_offsets[b0], bin_offsets[b1 + 1]
+            mz = g_bins["mz"][lo:hi]
+            intensity = g_bins["intensity"][lo:hi]
+            scan_idx = g_bins["scan_idx"][lo:hi].astype(np.int64)
+        else:
+            # peaks of consecutive scans are contiguous, so one slice covers the RT window
+            lo, hi = start_arr[scan_sel[0]], end_arr[scan_sel[-1]]
+            mz = h5["peaks"]["mz"][lo:hi]
+            intensity = h5["peaks"]["intensity"][lo:hi]
+            scan_idx = np.repeat(np.arange(level_arr.size, dtype=np.int64)[scan_sel[0]:scan_sel[-1] + 1],
+                                 (end_arr - start_arr)[scan_sel[0]:scan_sel[-1] + 1])
+
+    selected = np.zeros(level_arr.size, dtype=bool)
+    selected[scan_sel] = True
+    keep = selected[scan_idx] & (mz >= mz0) & (mz <= mz1)
+    scan_idx = scan_idx[keep]
+    mz = mz[keep]
+    intensity = intensity[keep]
+
+    order = np.lexsort((mz, scan_idx))
+    signals = np.column_stack((mz[order], intensity[order])).astype(np.float32, copy=False)
+    return scan_idx[order], time_arr[scan_idx[order]], signals
+
+
+def write_peak_sidecar(file_name: str, peaks: Optional[np.ndarray] = None) -> str:
+    """
+    Write the peaks of a mzh5 file as an uncompressed (n, 2) float32 `.npy`
+    sidecar that can be memory-mapped. The file is written to a temporary
+    name first and renamed, so concurrent readers never see a partial file.
+
+    Parameters
+    ----------
+    file_name : str
+        Path to the mzh5 file.
+    peaks : np.ndarray, optional
+        The [[m/z, intensity], ...] array. If None, it is read from the mzh5 file.
+
+    Returns
+    -------
+    str
+        Path to the sidecar file.
+    """
+
+    if peaks is None:
+        h5py = _require_h5py()
+        with h5py.File(file_name, "r") as h5:
+            peaks = np.empty((h5["peaks"]["mz"].shape[0], 2), dtype=np.float32)
+            peaks[:, 0] = h5["peaks"]["mz"][()]
+            peaks[:, 1] = h5["peaks"]["intensity"][()]
+
+    output_path = _peak_sidecar_path(file_name)
+    tmp_path = output_path + f".{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        np.save(f, np.ascontiguousarray(peaks, dtype=np.float32))
+    os.replace(tmp_path, output_path)
+
+    return output_path
+
+
+def _peak_sidecar_path(file_name: str) -> str:
+    root, _ = os.path.splitext(file_name)
+    return root + ".peaks.npy"
+
+
+def _load_peak_sidecar(file_name: str, n_peaks: int, write: bool = False) -> Optional[np.ndarray]:
+    """
+    Memory-map the peak sidecar of a mzh5 file. If `write` is True, the sidecar
+    is (re)written when it is missing or older than the mzh5 file. Returns None
+    if it cannot be used.
+    """
+
+    path = _peak_sidecar_path(file_name)
+    try:
+        if not os.path.exists(path) or os.path.getmtime(path) < os.path.getmtime(file_name):
+            if not write:
+                return None
+            write_peak_sidecar(file_name)
+        peaks = np.load(path, mmap_mode="r")
+    except (OSError, ValueError):
+        return None
+
+    if peaks.shape != (n_peaks, 2) or peaks.dtype != np.float32:
+        return None
+
+    return peaks
+
+
+def _decode_attr(value):
+    if isinstance(value, bytes):
+        value = value.decode()
+    if isinstance(value, str):
+        return None if value == "None" else value
+    if isinstance(value, (float, np.floating)) and np.isnan(value):
+        return None
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
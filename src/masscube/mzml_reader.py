@@ -0,0 +1,391 @@
+# Author: Huaxu Yu
+
+"""
+mzml_reader.py - fast mzML reader for MassCube
+
+This module streams spectra from mzML files with lxml.etree.iterparse. Only the
+fields used by MassCube are read from each spectrum:
+
+1. MS level and scan start time.
+2. Precursor m/z and isolation window offsets of the first precursor.
+3. The m/z and intensity arrays, decoded from base64 (and zlib) directly to NumPy.
+
+Files with features the fast path does not handle (e.g. numpress compression or
+referenceable parameter groups inside spectra) are read with pyteomics instead.
+
+For indexed mzML files, the spectrum offsets in <indexList> allow any range of
+spectra to be decoded on its own (see read_spectrum_offsets and iter_spectra_at),
+which is used to read a single file with multiple workers.
+"""
+
+from __future__ import annotations
+
+import base64
+import re
+import zlib
+from typing import Iterator, NamedTuple, Optional, Tuple
+
+import numpy as np
+from lxml import etree
+from pyteomics import mzml
+
+
+# controlled vocabulary accessions
+_MS_LEVEL = "MS:1000511"
+_SCAN_START_TIME = "MS:1000016"
+_SELECTED_ION_MZ = "MS:1000744"
+_ISOLATION_LOWER_OFFSET = "MS:1000828"
+_ISOLATION_UPPER_OFFSET = "MS:1000829"
+_MZ_ARRAY = "MS:1000514"
+_INTENSITY_ARRAY = "MS:1000515"
+_ZLIB = "MS:1000574"
+_NO_COMPRESSION = "MS:1000576"
+_DTYPES = {
+    "MS:1000521": np.dtype("<f4"),
+    "MS:1000523": np.dtype("<f8"),
+    "MS:1000519": np.dtype("<i4"),
+    "MS:1000522": np.dtype("<i8"),
+}
+_SECOND_UNITS = ("UO:0000010", "second")
+
+
+class Spectrum(NamedTuple):
+    """
+    The fields of a spectrum used by MassCube.
+    """
+
+    index: int                                          # index of the spectrum in the file
+    level: int                                          # MS level
+    scan_time: float                                    # scan time in minute
+    precursor_mz: Optional[float]                       # selected ion m/z of the first precursor
+    isolation_window: Optional[Tuple[float, float]]     # (lower offset, upper offset) of the first precursor
+    mz: np.ndarray                                      # m/z array
+    intensity: np.ndarray                               # intensity array
+
+    @property
+    def signals(self) -> np.ndarray:
+        """
+        Signals as 2D numpy array in float32, organized as [[m/z, intensity], ...].
+        """
+        signals = np.empty((len(self.mz), 2), dtype=np.float32)
+        signals[:, 0] = self.mz
+        signals[:, 1] = self.intensity
+        return signals
+
+
+class UnsupportedMzML(Exception):
+    """
+    Raised by the fast reader for spectra it cannot decode.
+    """
+
+
+def iter_mzml_spectra(file_name: str, fast: bool = True) -> Iterator[Spectrum]:
+    """
+    Iterate over the spectra of a mzML file in file order.
+
+    The fast lxml reader is used by default. If it meets a spectrum it cannot
+    decode, reading continues with pyteomics from that spectrum on, so callers
+    always get every spectrum exactly once.
+
+    Parameters
+    ----------
+    file_name : str
+        Path to the mzML file.
+    fast : bool
+        Whether to use the fast lxml reader. If False, pyteomics is used.
+
+    Yields
+    ------
+    Spectrum
+        The spectra of the file.
+    """
+
+    n_read = 0
+    if fast:
+        try:
+            for spec in _iter_spectra_lxml(file_name):
+                yield spec
+                n_read += 1
+            return
+        except UnsupportedMzML:
+            pass
+
+    for spec in _iter_spectra_pyteomics(file_name, start=n_read):
+        yield spec
+
+
+def _iter_spectra_lxml(file_name: str) -> Iterator[Spectrum]:
+    """
+    Stream spectra with lxml.etree.iterparse. Each spectrum element is cleared
+    once it is decoded, so the memory use does not grow with the file size.
+    """
+
+    context = etree.iterparse(file_name, events=("end",), tag="{*}spectrum", huge_tree=True)
+    for idx, (_, elem) in enumerate(context):
+        yield _parse_spectrum(elem, idx)
+        elem.clear(keep_tail=True)
+        parent = elem.getparent()
+        while elem.getprevious() is not None:
+            del parent[0]
+    del context
+
+
+def _parse_spectrum(elem, idx: int) -> Spectrum:
+    ns = elem.tag[:-len("spectrum")]
+    cv_tag = ns + "cvParam"
+
+    level = None
+    scan_time = 0.0
+    precursor_mz = None
+    isolation_window = None
+    mz_arr = None
+    int_arr = None
+    default_length = int(elem.get("defaultArrayLength", 0))
+
+    for child in elem:
+        tag = child.tag
+        if tag == cv_tag:
+            if child.get("accession") == _MS_LEVEL:
+                level = int(child.get("value"))
+        elif tag == ns + "scanList":
+            scan_time = _parse_scan_time(child, ns)
+        elif tag == ns + "precursorList":
+            precursor_mz, isolation_window = _parse_precursor(child, ns)
+        elif tag == ns + "binaryDataArrayList":
+            for bda in child:
+                if bda.tag != ns + "binaryDataArray":
+                    continue
+                kind, arr = _decode_binary_data_array(bda, ns, default_length)
+                if kind == _MZ_ARRAY:
+                    mz_arr = arr
+                elif kind == _INTENSITY_ARRAY:
+                    int_arr = arr
+        elif tag == ns + "referenceableParamGroupRef":
+            raise UnsupportedMzML("referenceable parameter groups are not supported")
+
+    if level is None:
+        raise UnsupportedMzML("MS level is missing")
+    if mz_arr is None or int_arr is None or len(mz_arr) != len(int_arr):
+        mz_arr = np.empty(0, dtype=np.float64)
+        int_arr = np.empty(0, dtype=np.float32)
+
+    return Spectrum(idx, level, scan_time, precursor_mz, isolation_window, mz_arr, int_arr)
+
+
+def _parse_scan_time(scan_list, ns: str) -> float:
+    scan = scan_list.find(ns + "scan")
+    if scan is None:
+        return 0.0
+    for cv in scan.iter(ns + "cvParam"):
+        if cv.get("accession") == _SCAN_START_TIME or cv.get("name") == "scan time":
+            scan_time = float(cv.get("value"))
+            if cv.get("unitAccession") in _SECOND_UNITS or cv.get("unitName") in _SECOND_UNITS:
+                scan_time /= 60     # convert to minute
+            return scan_time
+    return 0.0
+
+
+def _parse_precursor(precursor_list, ns: str):
+    precursor = precursor_list.find(ns + "precursor")
+    if precursor is None:
+        return None, None
+
+    precursor_mz = None
+    lower = upper = None
+    iw = precursor.find(ns + "isolationWindow")
+    if iw is not None:
+        for cv in iw.iter(ns + "cvParam"):
+            acc = cv.get("accession")
+            if acc == _ISOLATION_LOWER_OFFSET:
+                lower = _to_float(cv.get("value"), default=1.5)
+            elif acc == _ISOLATION_UPPER_OFFSET:
+                upper = _to_float(cv.get("value"), default=1.5)
+    ion = precursor.find(ns + "selectedIonList/" + ns + "selectedIon")
+    if ion is not None:
+        for cv in ion.iter(ns + "cvParam"):
+            if cv.get("accession") == _SELECTED_ION_MZ:
+                precursor_mz = _to_float(cv.get("value"))
+                break
+
+    isolation_window = None
+    if lower is not None and upper is not None:
+        isolation_window = (lower, upper)
+    return precursor_mz, isolation_window
+
+
+def _decode_binary_data_array(bda, ns: str, default_length: int):
+    kind = None
+    dtype = None
+    compressed = None
+    for child in bda:
+        if child.tag == ns + "cvParam":
+            acc = child.get("accession")
+            if acc in _DTYPES:
+                dtype = _DTYPES[acc]
+            elif acc == _ZLIB:
+                compressed = True
+            elif acc == _NO_COMPRESSION:
+                compressed = False
+            elif acc in (_MZ_ARRAY, _INTENSITY_ARRAY):
+                kind = acc
+        elif child.tag == ns + "referenceableParamGroupRef":
+            raise UnsupportedMzML("referenceable parameter groups are not supported")
+
+    if kind is None:
+        return None, None
+    if dtype is None or compressed is None:
+        # e.g. numpress or other codecs
+        raise UnsupportedMzML("unsupported binary data array encoding")
+
+    text = bda.findtext(ns + "binary")
+    if not text:
+        return kind, np.empty(0, dtype=dtype)
+    raw = base64.b64decode(text)
+    if compressed:
+        raw = zlib.decompress(raw)
+    arr = np.frombuffer(raw, dtype=dtype)
+
+    length = int(bda.get("arrayLength", default_length))
+    if len(arr) != length:
+        raise UnsupportedMzML("array length does not match")
+    return kind, arr
+
+
+def read_spectrum_offsets(file_name: str) -> Optional[Tuple[np.ndarray, int]]:
+    """
+    Read the byte offsets of all spectra from the index of an indexedmzML file.
+
+    Parameters
+    ----------
+    file_name : str
+        Path to the mzML file.
+
+    Returns
+    -------
+    tuple or None
+        (offsets, end_offset), where offsets is an int64 array with the byte offset
+        of each spectrum in file order and end_offset is the offset of <indexList>.
+        None if the file is not indexed or the index does not match the spectra.
+    """
+
+    with open(file_name, "rb") as f:
+        f.seek(0, 2)
+        size = f.tell()
+        f.seek(max(0, size - 4096))
+        m = re.search(rb"<indexListOffset>\s*(\d+)\s*</indexListOffset>", f.read())
+        if m is None:
+            return None
+        end_offset = int(m.group(1))
+        if end_offset >= size:
+            return None
+        f.seek(end_offset)
+        index_text = f.read()
+
+        m = re.search(rb'<index\s+name="spectrum"\s*>(.*?)</index>', index_text, re.S)
+        if m is None:
+            return None
+        offsets = np.array(re.findall(rb"<offset[^>]*>\s*(\d+)\s*</offset>", m.group(1)), dtype=np.int64)
+        if len(offsets) == 0 or np.any(np.diff(offsets) <= 0) or offsets[-1] >= end_offset:
+            return None
+
+        # spot check that the offsets point at spectrum elements
+        for i in {0, len(offsets) // 2, len(offsets) - 1}:
+            f.seek(offsets[i])
+            if not f.read(9) == b"<spectrum":
+                return None
+
+    return offsets, end_offset
+
+
+def iter_spectra_at(file_name: str, offsets: np.ndarray, end_offset: int, first_index: int = 0) -> Iterator[Spectrum]:
+    """
+    Decode a range of consecutive spectra of an indexed mzML file.
+
+    Parameters
+    ----------
+    file_name : str
+        Path to the mzML file.
+    offsets : np.ndarray
+        Byte offsets of the spectra, from read_spectrum_offsets.
+    end_offset : int
+        A byte offset after the last spectrum, e.g. the offset of the next spectrum.
+    first_index : int
+        Index of the first spectrum in the file.
+
+    Yields
+    ------
+    Spectrum
+        The spectra in the range.
+
+    Raises
+    ------
+    UnsupportedMzML
+        If an offset does not point at a spectrum or the spectrum cannot be decoded.
+    """
+
+    if len(offsets) == 0:
+        return
+
+    with open(file_name, "rb") as f:
+        f.seek(offsets[0])
+        data = f.read(end_offset - offsets[0])
+
+    parser = etree.XMLParser(huge_tree=True)
+    rel = np.append(offsets - offsets[0], len(data))
+    for k in range(len(offsets)):
+        block = data[rel[k]:rel[k+1]]
+        stop = block.find(b"</spectrum>")
+        if not block.startswith(b"<spectrum") or stop < 0:
+            raise UnsupportedMzML("spectrum offset does not match")
+        try:
+            elem = etree.fromstring(block[:stop + len(b"</spectrum>")], parser)
+        except etree.XMLSyntaxError as e:
+            raise UnsupportedMzML(str(e))
+        yield _parse_spectrum(elem, first_index + k)
+
+
+def _iter_spectra_pyteomics(file_name: str, start: int = 0) -> Iterator[Spectrum]:
+    with mzml.MzML(file_name) as reader:
+        for idx, spec in enumerate(reader):
+            if idx < start:
+                continue
+
+            scan = spec.get("scanList", {}).get("scan", [{}])[0]
+            scan_time = scan.get("scan start time", scan.get("scan time", 0.0))
+            if getattr(scan_time, "unit_info", None) == "second":
+                scan_time = scan_time / 60
+            scan_time = float(scan_time)
+
+            precursor_mz = None
+            isolation_window = None
+            precursors = spec.get("precursorList", {}).get("precursor", [])
+            if len(precursors) > 0:
+                selected = precursors[0].get("selectedIonList", {}).get("selectedIon", [])
+                if len(selected) > 0:
+                    precursor_mz = _to_float(selected[0].get("selected ion m/z"))
+                iw = precursors[0].get("isolationWindow", {})
+                if "isolation window lower offset" in iw and "isolation window upper offset" in iw:
+                    isolation_window = (_to_float(iw["isolation window lower offset"], 1.5),
+                                        _to_float(iw["isolation window upper offset"], 1.5))
+
+            mz_arr = spec.get("m/z array")
+            int_arr = spec.get("intensity array")
+            if mz_arr is None or int_arr is None:
+                mz_arr = np.empty(0, dtype=np.float64)
+                int_arr = np.empty(0, dtype=np.float32)
+
+            yield Spectrum(idx, int(spec["ms level"]), scan_time, precursor_mz, isolation_window,
+                           np.asarray(mz_arr), np.asarray(int_arr))
+
+
+def _to_float(value, default=None):
+    # same as raw_data_utils._safe_float, which cannot be imported here
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        if isinstance(value, str) and value.strip().count(",") == 1 and "." not in value:
+            try:
+                return float(value.strip().replace(",", "."))
+            except ValueError:
+                pass
+        return default
@@ -1,58 +1,175 @@
 # Author: Huaxu Yu
 
 """
-mzpkl.py - pickle utilities for MassCube
-
-This module defines the pkl format the raw files in MassCube:
-
-1. Structure of the pickle file format.
-2. Convert the raw data to pickle file.
+mzpkl.py - intermediate file utilities for MassCube
+
+This module defines the mzpkl format, the intermediate file that MassCube writes
+to the tmp directory for reloading the raw data (gap filling and feature grouping):
+
+1. Structure of the mzpkl file format.
+2. Convert the MSData object to mzpkl file and read it back.
+
+Since version 2, a mzpkl file is an uncompressed NumPy .npz bundle of the columnar
+arrays of MSData (see raw_data_utils.ScanTable), so no Python objects are pickled
+and reading it back is a handful of bulk array reads. As the arrays are stored
+without compression, the peaks can also be memory-mapped from the bundle (mmap=True),
+so the workers of gap filling and feature grouping share the pages through the OS
+cache instead of each loading whole files. Version 1 files (pickled dictionaries)
+can still be read, but not memory-mapped.
+
+Structure (version 2)
+---------------------
+format_version, name, ion_mode
+    version of the format, file name and ion mode (0-d arrays)
+ms1_time_arr, ms1_idx_arr, ms2_idx_arr, base_peak_arr
+    indexes of MS1/MS2 scans and the base peak chromatogram
+scan_level, scan_time, scan_precursor_mz, scan_isolation_window, scan_offset, scan_has_signals
+    scan-wise arrays of the ScanTable
+peaks
+    [[m/z, intensity], ...] of all scans
 """
 
 
 # imports
+import os
 import pickle
+import struct
+import zipfile
+import numpy as np
+
+
+MZPKL_VERSION = 2
+
+_ZIP_MAGIC = b"PK"
 
 
 def convert_MSData_to_mzpkl(d, output_dir: str = None):
     """
-    Convert the MSData object to pickle format.
+    Convert the MSData object to mzpkl format.
 
     Parameters
     ----------
     d: MSData
         The MSData object.
     output_dir: str
-        The path to the output directory.
+        The path to the output file. If None, the arrays are returned as a dictionary.
     """
 
-    # more keys can be added to the results dictionary if needed
+    table = d.scans
+
+    # more arrays can be added if needed, readers ignore unknown keys
     results = {
-        "name": d.params.file_name,
-        "ion_mode": d.params.ion_mode,
-        "ms1_time_arr": d.ms1_time_arr,
-        "ms1_idx_arr": d.ms1_idx_arr,
-        "ms2_idx_arr": d.ms2_idx_arr,
-        "scans": d.scans
+        "format_version": np.array(MZPKL_VERSION),
+        "name": np.array(str(d.params.file_name)),
+        "ion_mode": np.array(str(d.params.ion_mode)),
+        "ms1_time_arr": np.asarray(d.ms1_time_arr, dtype=np.float64),
+        "ms1_idx_arr": np.asarray(d.ms1_idx_arr, dtype=np.int64),
+        "ms2_idx_arr": np.asarray(d.ms2_idx_arr, dtype=np.int64),
+        "base_peak_arr": np.asarray(d.base_peak_arr, dtype=np.float32).reshape(-1, 2),
+        "scan_level": table.level,
+        "scan_time": table.time,
+        "scan_precursor_mz": table.precursor_mz,
+        "scan_isolation_window": table.isolation_window,
+        "scan_offset": table.offset,
+        "scan_has_signals": table.has_signals,
+        "peaks": np.asarray(table.peaks, dtype=np.float32),
     }
 
     if output_dir is not None:
-        with open(output_dir, 'wb') as f:
-            pickle.dump(results, f)
+        # write to a temporary file and rename it, so readers never see a partial file
+        tmp_path = output_dir + f".{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, **results)
+        os.replace(tmp_path, output_dir)
     else:
         return results
 
 
-def read_mzpkl_to_MSData(d, file_path: str):
+def read_mzpkl_to_MSData(d, file_path: str, mmap: bool = False):
     """
-    Read the pickle file to MSData object.
+    Read the mzpkl file to MSData object.
 
     Parameters
     ----------
     d: MSData
         The MSData object
     file_path: str
-        The path to the pickle file.
+        The path to the mzpkl file.
+    mmap: bool
+        Whether to memory-map the peaks from the file instead of loading them into memory.
+        The peaks are loaded if they cannot be mapped (version 1 files).
+    """
+
+    with open(file_path, 'rb') as f:
+        is_npz = f.read(2) == _ZIP_MAGIC
+
+    if not is_npz:
+        if mmap:
+            print("\t{} is a version 1 mzpkl file that cannot be memory-mapped, it is loaded into memory.".format(file_path))
+        _read_pickled_mzpkl(d, file_path)
+        return None
+
+    from .raw_data_utils import ScanTable
+
+    with np.load(file_path, allow_pickle=False) as results:
+        version = int(results["format_version"])
+        if version > MZPKL_VERSION:
+            raise ValueError("mzpkl format version {} is not supported, please update MassCube.".format(version))
+
+        d.params.file_name = str(results["name"])
+        ion_mode = str(results["ion_mode"])
+        d.params.ion_mode = None if ion_mode == "None" else ion_mode
+        d.ms1_time_arr = results["ms1_time_arr"]
+        d.ms1_idx_arr = results["ms1_idx_arr"]
+        d.ms2_idx_arr = results["ms2_idx_arr"]
+        d.base_peak_arr = results["base_peak_arr"]
+        peaks = _map_npz_array(file_path, "peaks") if mmap else None
+        if peaks is None:
+            peaks = results["peaks"]
+        d.scans = ScanTable(level=results["scan_level"], time=results["scan_time"], peaks=peaks,
+                            offset=results["scan_offset"], precursor_mz=results["scan_precursor_mz"],
+                            isolation_window=results["scan_isolation_window"],
+                            has_signals=results["scan_has_signals"])
+
+
+def _map_npz_array(file_path: str, key: str):
+    """
+    Memory-map an array of a .npz bundle. This is possible because np.savez stores the
+    .npy files without compression, so the data of an array are contiguous bytes of the
+    bundle. Returns None if the array is compressed, empty or has an unsupported header.
+    """
+
+    with zipfile.ZipFile(file_path) as z:
+        info = z.getinfo(key + ".npy")
+    if info.compress_type != zipfile.ZIP_STORED:
+        return None
+
+    with open(file_path, 'rb') as f:
+        # the data of a member start after its local file header (30 bytes, the name and the extra field)
+        f.seek(info.header_offset)
+        header = f.read(30)
+        if header[:4] != b"PK\x03\x04":
+            return None
+        n_name, n_extra = struct.unpack("<HH", header[26:30])
+        f.seek(info.header_offset + 30 + n_name + n_extra)
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+        elif version == (2, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+        else:
+            return None
+        offset = f.tell()
+
+    if dtype.hasobject or int(np.prod(shape)) == 0:
+        return None
+
+    return np.memmap(file_path, dtype=dtype, mode="r", offset=offset, shape=shape, order="F" if fortran_order else "C")
+
+
+def _read_pickled_mzpkl(d, file_path: str):
+    """
+    Read a version 1 mzpkl file, a pickled dictionary.
     """
 
     with open(file_path, 'rb') as f:
@@ -64,6 +181,10 @@ def read_mzpkl_to_MSData(d, file_path: str):
     d.ms1_idx_arr = results["ms1_idx_arr"]
     d.ms2_idx_arr = results["ms2_idx_arr"]
     d.scans = results["scans"]
+    # files written before the ScanTable store a list of Scan objects
+    if isinstance(d.scans, list):
+        from .raw_data_utils import ScanTable
+        d.scans = ScanTable.from_scans(d.scans)
 
 
 def raw_data_to_mzpkl(raw_data: str, output_dir: str = None):
@@ -72,10 +193,10 @@ def raw_data_to_mzpkl(raw_data: str, output_dir: str = None):
 
     Parameters
     ----------
-    raw_data: 
+    raw_data:
         The raw MSData object.
     output_dir: str
         The path to the output directory.
     """
 
-    return convert_MSData_to_mzpkl(raw_data, output_dir)
\ No newline at end of file
+    return convert_MSData_to_mzpkl(raw_data, output_dir)
@@ -35,6 +35,7 @@ class Params:
         self.normalization_dir = None       # directory for the normalization output, string
         self.statistics_dir = None          # directory for the statistical analysis output, string
         self.problematic_files = {}         # problematic files, dictionary: {file_name: error_message}
+        self.profile_path = None            # JSON lines file to record the time and memory of the processing stages (see profiling.py), None for no record, string
 
         # raw data reading and cleaning
         self.file_name = None               # file name of the raw data, string
@@ -44,6 +45,9 @@ class Params:
         self.is_centroid = True             # whether the raw data is centroid data, boolean
         self.file_format = None             # file type in lower case, 'mzml', 'mzxml', 'mzjson' or 'mzjson.gz', string
         self.scan_time_unit = "minute"      # time unit of the scan time, "minute" or "second", string
+        self.fast_mzml_reader = True        # whether to read mzML files with the lxml reader (pyteomics is used for unsupported files), boolean
+        self.vectorized_preprocessing = True  # whether to filter and centroid the scans in batches instead of one by one, boolean
+        self.use_numba = False              # whether to use numba-compiled kernels for the hot loops if numba is installed (see kernels.py), boolean
         self.mz_lower_limit = 0.0           # lower limit of m/z in Da, float
         self.mz_upper_limit = 100000.0      # upper limit of m/z in Da, float
         self.rt_lower_limit = 0.0           # lower limit of RT in minutes, float
@@ -59,7 +63,15 @@ class Params:
         self.mz_tol_ms1 = 0.01              # m/z tolerance for MS1, default is 0.01
         self.mz_tol_ms2 = 0.015             # m/z tolerance for MS2, default is 0.015
         self.feature_gap_tol = 10           # gap tolerance within a feature, default is 10 (i.e. 10 consecutive scans without signal), integer
-        self.batch_size = 100               # batch size for parallel processing, default is 100, integer
+        self.roi_engine = "vectorized"      # engine to trace ROIs, "vectorized" (array-based) or "classic" (one Feature object per ROI), string
+        self.roi_min_length = 0             # ROIs with fewer non-zero scans are dropped during feature detection, 0 to keep all, integer
+        self.roi_min_height = 0.0           # ROIs with a lower highest intensity are dropped during feature detection, 0 to keep all, float
+        self.predict_peak_quality = False   # whether to score the peak shapes with the bundled neural network (see peak_quality.py), boolean
+        self.streaming_detection = False    # whether to detect features from mzML files in one pass without keeping the MS1 scans (see MSData.stream_features), boolean
+        self.max_tasks_per_worker = 100     # number of files a worker processes before it is restarted to release memory, default is 100, integer
+        self.batch_size = None              # deprecated and ignored: files are no longer processed in batches, see max_tasks_per_worker
+        self.max_worker_memory = 0.0        # a worker is restarted after a file once its peak memory exceeds this value in GB, 0 for no limit, float
+        self.memory_budget = 0.0            # files are processed at the same time only while their estimated memory fits in this value in GB, 0 to use 80% of the physical memory, float
         self.percent_cpu_to_use = 0.8       # percentage of CPU to use, default is 0.8, float
         
         # feature grouping
@@ -114,7 +126,7 @@ class Params:
 
         # output
         self.output_single_file = False     # whether to output the processed individual files to a csv file
-        self.output_ms1_scans = False       # whether to output all MS1 scans to a pickle file for faster data reloading (only used in untargted metabolomics workflow)
+        self.output_ms1_scans = False       # whether to output all MS1 scans to a mzpkl file for faster data reloading (only used in untargted metabolomics workflow)
         self.output_aligned_file = False    # whether to output aligned features to a csv file
         self.quant_method = "peak_height"   # value for quantification and output, "peak_height", "peak_area" or "top_average", string
     
@@ -229,6 +241,13 @@ class Params:
             self.set_default(ms_type, ion_mode)
             self.plot_bpc = True
 
+        # streamed files keep no MS1 scans, so no intermediate file is written to reload them
+        if self.streaming_detection and (self.fill_gaps or self.group_features_after_alignment):
+            print("\tstreaming_detection is turned off, as gap filling and feature grouping after alignment " +
+                  "reload the MS1 scans of each file. Set fill_gaps and group_features_after_alignment " +
+                  "to False to use it.")
+            self.streaming_detection = False
+
         # STEP 5: read the sample names and sample metadata from the sample table
         if os.path.exists(os.path.join(self.project_dir, "sample_table.csv")):
             self.read_sample_metadata(os.path.join(self.project_dir, "sample_table.csv"))
@@ -286,7 +305,7 @@ class Params:
 
     def check_parameters(self):
         """
-        Check if the parameters are correct using PARAMETER_RAGEES.
+        Check if the parameters are correct using PARAMETER_RAGEES and ROI_ENGINES.
         ------------------------------------
         """
 
@@ -296,7 +315,15 @@ class Params:
                 setattr(self, key, PARAMETER_DEFAULT[key])
         if not os.path.exists(str(self.ms2_library_path)):
             self.ms2_library_path = None
-        self.batch_size = int(self.batch_size)
+        self.max_tasks_per_worker = int(self.max_tasks_per_worker)
+        if isinstance(self.roi_engine, str):
+            self.roi_engine = self.roi_engine.strip().lower()
+        if self.roi_engine not in ROI_ENGINES:
+            raise ValueError("Parameter roi_engine should be one of {}, but it is {}.".format(ROI_ENGINES, self.roi_engine))
+        if self.batch_size is not None:
+            print("Parameter batch_size is deprecated and ignored, as files are no longer processed in batches. "
+                  "Use max_tasks_per_worker to restart the workers after a number of files.")
+            self.batch_size = None
 
 
     def output_parameters(self, path, format="json"):
@@ -385,6 +412,14 @@ def find_ms_info(file_name):
         if "centroid spectrum" in text or 'centroided="1"' in text:
             centroid = True
 
+    # for mzh5, the information was recorded from the raw file during conversion
+    elif file_name.lower().endswith('.mzh5'):
+        from .mzh5 import read_mzh5_meta
+        meta = read_mzh5_meta(file_name)
+        ms_type = meta.get("ms_type")
+        ion_mode = meta.get("ion_mode")
+        centroid = bool(meta.get("is_centroid", False))
+
     return ms_type, ion_mode, centroid
 
 
@@ -432,4 +467,6 @@ PARAMETER_DEFAULT = {
     "mz_tol_merge_features": 0.01,
     "rt_tol_merge_features": 0.05,
     "ms2_sim_tol": 0.7
-}
\ No newline at end of file
+}
+# engines to trace ROIs in feature detection (see feature_detection.detect_features)
+ROI_ENGINES = ("vectorized", "classic")
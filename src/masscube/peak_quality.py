@@ -0,0 +1,176 @@
+# Author: Huaxu Yu
+
+# A module to score the chromatographic peak shapes of features with the bundled neural network
+
+"""
+The peak quality model (model/peak_quality_NN.keras) is a small dense network
+(64-32-16-4-1, ReLU and a sigmoid output) that scores a peak shape resampled to 64
+points. Its weights are exported once to model/peak_quality_NN.npz (see
+export_peak_quality_weights), so the inference only needs NumPy: all features of a
+file are scored with one matrix multiply per layer, without TensorFlow.
+"""
+
+import os
+import io
+import json
+import zipfile
+import numpy as np
+
+
+MODEL_DIR = os.path.join(os.path.dirname(__file__), "model")
+PEAK_QUALITY_WEIGHTS = os.path.join(MODEL_DIR, "peak_quality_NN.npz")
+N_POINTS = 64               # number of points of the resampled peak shape
+
+_ACTIVATIONS = {
+    "relu": lambda x: np.maximum(x, 0),
+    "sigmoid": lambda x: 0.5 * (1 + np.tanh(0.5 * x)),      # without overflow for large negative x
+    "linear": lambda x: x,
+}
+
+# the loaded model, shared by all calls in a process
+_model = None
+
+
+def load_peak_quality_model(path=None):
+    """
+    Load the weights of the peak quality model. The default model is loaded once per process.
+
+    Parameters
+    ----------
+    path: str
+        Path to a npz file written by export_peak_quality_weights. If None, the bundled
+        model is used.
+
+    Returns
+    -------
+    layers: list
+        A list of (kernel, bias, activation) of the dense layers.
+    """
+
+    global _model
+
+    if path is None and _model is not None:
+        return _model
+
+    with np.load(PEAK_QUALITY_WEIGHTS if path is None else path, allow_pickle=False) as data:
+        activations = [str(a) for a in data["activations"]]
+        layers = [(data["kernel_{}".format(i)], data["bias_{}".format(i)], a) for i, a in enumerate(activations)]
+
+    if path is None:
+        _model = layers
+    return layers
+
+
+def export_peak_quality_weights(model_path, output_path=PEAK_QUALITY_WEIGHTS):
+    """
+    Export the weights of a Keras model (.keras) of dense layers to a npz file for
+    load_peak_quality_model. h5py is required.
+
+    Parameters
+    ----------
+    model_path: str
+        Path to the .keras file.
+    output_path: str
+        Path to the npz file.
+    """
+
+    try:
+        import h5py
+    except ImportError as exc:
+        raise ImportError("h5py is required to read .keras files. Install it with: pip install h5py") from exc
+
+    with zipfile.ZipFile(model_path) as z:
+        config = json.loads(z.read("config.json"))
+        weights = z.read("model.weights.h5")
+
+    dense = [layer["config"] for layer in config["config"]["layers"] if layer["class_name"] == "Dense"]
+    arrays = {"activations": np.array([c["activation"] for c in dense])}
+    with h5py.File(io.BytesIO(weights), "r") as h5:
+        # dense layers are stored as dense, dense_1, dense_2, ... in the order of the model
+        for i in range(len(dense)):
+            group = h5["layers"]["dense" if i == 0 else "dense_{}".format(i)]["vars"]
+            arrays["kernel_{}".format(i)] = np.asarray(group["0"], dtype=np.float32)
+            arrays["bias_{}".format(i)] = np.asarray(group["1"], dtype=np.float32)
+
+    np.savez(output_path, **arrays)
+
+
+def resample_peak_shapes(features, n_points=N_POINTS):
+    """
+    Resample the peak shapes of features to a fixed number of points. A zero is added to
+    both ends of each peak, the peak is linearly interpolated at n_points evenly spaced
+    positions and divided by its maximum. All features are resampled together.
+
+    Parameters
+    ----------
+    features: list
+        A list of summarized Feature objects.
+    n_points: int
+        Number of points.
+
+    Returns
+    -------
+    shapes: numpy array
+        The resampled peak shapes with a shape of (number of features, n_points) in float32.
+    """
+
+    if len(features) == 0:
+        return np.empty((0, n_points), dtype=np.float32)
+
+    lengths = np.array([len(f.signals) for f in features], dtype=np.int64) + 2
+    offset = np.cumsum(lengths) - lengths
+    y = np.zeros(int(np.sum(lengths)), dtype=np.float64)
+    inner = np.ones(len(y), dtype=bool)
+    inner[offset] = False
+    inner[offset + lengths - 1] = False
+    y[inner] = np.concatenate([f.signals[:, 1] for f in features])
+
+    # positions as np.linspace(0, length - 1, n_points) of each peak
+    step = (lengths - 1) / (n_points - 1)
+    x = np.arange(n_points)[None, :] * step[:, None]
+    x[:, -1] = lengths - 1
+    left = np.minimum(np.floor(x).astype(np.int64), (lengths - 2)[:, None])
+    frac = x - left
+    left += offset[:, None]
+    shapes = y[left] + (y[left + 1] - y[left]) * frac
+
+    top = np.max(shapes, axis=1, keepdims=True)
+    np.divide(shapes, top, out=shapes, where=top > 0)
+
+    return shapes.astype(np.float32)
+
+
+def predict_peak_quality(features, model=None, batch_size=100000):
+    """
+    Score the peak shapes of features with the peak quality model. The score (0-1, higher
+    is better) is stored in Feature.peak_quality.
+
+    Parameters
+    ----------
+    features: list
+        A list of summarized Feature objects.
+    model: list
+        Layers from load_peak_quality_model. If None, the bundled model is used.
+    batch_size: int
+        Number of features scored at once, to bound the memory of the resampled shapes.
+
+    Returns
+    -------
+    scores: numpy array
+        The scores of the features.
+    """
+
+    if model is None:
+        model = load_peak_quality_model()
+
+    scores = np.empty(len(features), dtype=np.float32)
+    for b0 in range(0, len(features), batch_size):
+        x = resample_peak_shapes(features[b0:b0 + batch_size])
+        for kernel, bias, activation in model:
+            x = _ACTIVATIONS[activation](x @ kernel + bias)
+        scores[b0:b0 + batch_size] = x[:, 0]
+
+    for f, s in zip(features, scores):
+        f.peak_quality = float(s)
+
+    return scores
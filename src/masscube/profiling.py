@@ -0,0 +1,166 @@
+# Author: Huaxu Yu
+
+# A module to record the time, memory and item counts of the processing stages
+
+"""
+Each stage of process_single_file (read, detect, segment, summarize, annotate, group,
+output, mzpkl) and of the project (alignment, gap filling, annotation, grouping,
+normalization, statistics) is recorded as one JSON line with
+- file: the sample, or "project" for the project-level stages,
+- stage: the name of the stage,
+- wall_time and cpu_time in seconds (the CPU time of all threads of the process),
+- peak_rss: the peak resident memory in MB at the end of the stage. In a worker it is the
+  peak since the file was started (Linux), so the stage that raises it stands out,
+- item counts of the stage such as scans, rois and features.
+
+The workflow writes the lines of a run to project_files/stage_profiles/<time>.jsonl and
+a summary table of the stages next to it (see summarize_stage_profile). The lines of a
+file are appended in one write, so the workers can share the file.
+"""
+
+import os
+import json
+import time
+import pandas as pd
+
+from .scheduler import peak_rss
+
+
+class StageProfiler:
+    """
+    Record the stages of a file or the project, one after another.
+    """
+
+    def __init__(self, name, path=None):
+        """
+        Parameters
+        ----------
+        name: str
+            The sample name, or "project".
+        path: str
+            Path to the JSON lines file. If None, the stages are recorded but not saved.
+        """
+
+        self.name = name
+        self.path = path
+        self.records = []
+        self._stage = None          # [name, wall time, cpu time] of the running stage
+
+
+    def start(self, stage):
+        """
+        Start a stage. The running stage, if any, is stopped first.
+
+        Parameters
+        ----------
+        stage: str
+            The name of the stage.
+        """
+
+        if self._stage is not None:
+            self.stop()
+        self._stage = [stage, time.perf_counter(), time.process_time()]
+
+
+    def stop(self, **counts):
+        """
+        Stop the running stage.
+
+        Parameters
+        ----------
+        counts: int
+            Item counts of the stage, e.g. features=100.
+        """
+
+        if self._stage is None:
+            return
+        stage, wall, cpu = self._stage
+        self._stage = None
+        peak = peak_rss()
+        record = {
+            "file": self.name,
+            "stage": stage,
+            "wall_time": round(time.perf_counter() - wall, 4),
+            "cpu_time": round(time.process_time() - cpu, 4),
+            "peak_rss": None if peak is None else round(peak / 1024**2, 1),
+        }
+        record.update({k: int(v) for k, v in counts.items() if v is not None})
+        self.records.append(record)
+
+
+    def save(self):
+        """
+        Stop the running stage and append the records to the JSON lines file.
+        """
+
+        self.stop()
+        if self.path is None or len(self.records) == 0:
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        lines = "".join(json.dumps(r) + "\n" for r in self.records)
+        with open(self.path, "a") as f:
+            f.write(lines)
+        self.records = []
+
+
+def summarize_stage_profile(path, output_path=None):
+    """
+    Summarize the stages of a JSON lines file written by StageProfiler.
+
+    Parameters
+    ----------
+    path: str
+        Path to the JSON lines file.
+    output_path: str
+        Path to the tab-separated summary table. If None, it is saved next to the JSON
+        lines file with the suffix "_summary.txt".
+
+    Returns
+    -------
+    summary: pandas DataFrame
+        One row per stage in the order of processing with the number of files, the total,
+        median and maximum wall time, the total CPU time, the maximum peak memory (MB) and
+        the total item counts.
+    """
+
+    df = pd.read_json(path, lines=True)
+    if output_path is None:
+        output_path = os.path.splitext(path)[0] + "_summary.txt"
+
+    count_columns = [c for c in df.columns if c not in ("file", "stage", "wall_time", "cpu_time", "peak_rss")]
+    rows = []
+    for stage, g in df.groupby("stage", sort=False):
+        row = {
+            "stage": stage,
+            "files": g["file"].nunique(),
+            "wall_time": g["wall_time"].sum(),
+            "median_wall_time": g["wall_time"].median(),
+            "max_wall_time": g["wall_time"].max(),
+            "cpu_time": g["cpu_time"].sum(),
+            "max_peak_rss": g["peak_rss"].max(),
+        }
+        for c in count_columns:
+            row[c] = g[c].sum(min_count=1)
+        rows.append(row)
+
+    summary = pd.DataFrame(rows).round(3)
+    summary[count_columns] = summary[count_columns].astype("Int64")
+    summary.to_csv(output_path, sep="\t", index=False)
+    return summary
+
+
+def report_stage_profile(path):
+    """
+    Print the summary table of a JSON lines file written by StageProfiler, if it exists.
+
+    Parameters
+    ----------
+    path: str
+        Path to the JSON lines file.
+    """
+
+    if path is None or not os.path.exists(path):
+        return
+    summary = summarize_stage_profile(path)
+    print("Time (s) and peak memory (MB) of the processing stages:")
+    print(summary.astype(object).fillna("").to_string(index=False))
@@ -3,17 +3,21 @@
 # A module to read and process the raw MS data
 
 # imports
-from pyteomics import mzml, mzxml
+from pyteomics import mzxml
 import numpy as np
 import pandas as pd
 import os
+from joblib import Parallel, delayed, cpu_count
 import matplotlib.pyplot as plt
 import matplotlib.font_manager as fm
 
 from .params import Params, find_ms_info
-from .feature_detection import detect_features, segment_feature
+from .feature_detection import detect_features, segment_feature, summarize_features, ROITracer, _report_pruned_rois
 from .mzpkl import convert_MSData_to_mzpkl, read_mzpkl_to_MSData
+from .mzml_reader import iter_mzml_spectra, iter_spectra_at, read_spectrum_offsets, UnsupportedMzML
 from .utils_functions import centroid_signals
+from .kernels import is_enabled, eic_max_signals
+from .peak_quality import predict_peak_quality
 
 
 """
@@ -23,13 +27,13 @@ Classes
 
 class MSData:
     """
-    A class that models a single file (mzML, mzXML, mzjson
+    A class that models a single file (mzML, mzXML, mzh5, mzjson
     or compressed mzjson file) and processes the raw data.
     """
 
     def __init__(self):
         
-        self.scans = []                 # A list of Scan objects for mass spectra
+        self.scans = []                 # A ScanTable of all mass spectra, indexing it gives Scan objects
         self.ms1_idx_arr = []           # Scan indexes of MS1 spectra
         self.ms1_time_arr = []          # Time of MS1 scans
         self.ms2_idx_arr = []           # Scan indexes of MS2 spectra
@@ -40,21 +44,27 @@ class MSData:
         self.features = []              # A list of features
         self.feature_mz_arr = None      # m/z of all features
         self.feature_rt_arr = None      # Retention time of all features
+        self.pruned_roi_number = 0      # Number of ROIs dropped by early pruning in feature detection
         
         self.mass_err_model_arr = None  # np.array of mass error model, [[ref_mz, measured_mz], ...]
+
+        self._mz_index = None           # MS1 signals sorted by m/z for batched EIC extraction, see build_mz_index
+        self._precursor_ion_fractions = None    # {MS2 scan index: precursor ion fraction} if MS1 scans are not kept, see stream_features
         
 
 
     def read_raw_data(self, file_name, params=None, scan_levels=[1,2], centroid_mz_tol=0.005, 
-                      ms1_abs_int_tol=None, ms2_abs_int_tol=None, ms2_rel_int_tol=0.01, precursor_mz_offset=2):
+                      ms1_abs_int_tol=None, ms2_abs_int_tol=None, ms2_rel_int_tol=0.01, precursor_mz_offset=2,
+                      mmap=False, write_sidecar=False, n_jobs=1):
         """
-        Read raw data (mzML, mzXML, mzjson or compressed mzjson). Parsing of the mzML and mzXML files
-        is performed using pyteomics.
+        Read raw data (mzML, mzXML, mzh5, mzjson or compressed mzjson). mzML files are streamed with
+        lxml (see mzml_reader.iter_mzml_spectra) and mzXML files are parsed with pyteomics. mzh5 files (see mzh5.convert_raw_to_mzh5) are loaded from the 
+        stored peak arrays without parsing, and the preprocessing parameters stored in the file are used.
 
         Parameters
         ----------
         file_name: str
-            Name of the raw data file. Valid extensions are mzML, mzXML, mzjson and gz.
+            Name of the raw data file. Valid extensions are mzML, mzXML, mzh5, mzjson and gz.
         params: Params object
             A Params object that contains the parameters.
         scan_levels: list
@@ -72,13 +82,25 @@ class MSData:
         precursor_mz_offset: float
             To remove the precursor ion from MS2 scan. The m/z upper limit of signals 
             in MS2 scans is calculated as precursor_mz - precursor_mz_offset.
+        mmap: bool
+            For mzh5 and mzpkl files only. Whether to memory-map the peaks instead of loading them
+            into memory. Signals of each scan are sliced from the mapped array on first access.
+        write_sidecar: bool
+            For mzh5 files only. Whether to write the peak sidecar for memory mapping if it is
+            missing or outdated. If False, such files are read from HDF5 without writing anything.
+        n_jobs: int
+            For indexed mzML files only. Number of workers to decode and preprocess the spectra,
+            -1 to use all CPUs. Default is 1 (sequential).
         """
 
         if file_name.lower().endswith(".mzpkl"):
             self.params = Params()
-            read_mzpkl_to_MSData(self, file_name)
+            read_mzpkl_to_MSData(self, file_name, mmap=mmap)
             return None
 
+        if mmap and not file_name.lower().endswith(".mzh5"):
+            print("\tOnly mzh5 and mzpkl files can be memory-mapped, {} is loaded into memory.".format(os.path.basename(file_name)))
+
         # priority for parameter setting:
         # 1. a Params object
         # 2. parameters provided through the function
@@ -97,6 +119,46 @@ class MSData:
             params.ion_mode = ion_mode
             params.is_centroid = centroid
         
+        self._set_params(file_name, params)
+        base_name = os.path.basename(file_name)
+        
+        if os.path.isfile(file_name):
+            if base_name.lower().endswith(".mzml"):
+                table = None
+                if n_jobs != 1 and self.params.fast_mzml_reader:
+                    table = read_mzml_scans_parallel(file_name, self.params, n_jobs=n_jobs)
+                if table is None:
+                    self.extract_scan_spectra(iter_mzml_spectra(file_name, fast=self.params.fast_mzml_reader))
+                else:
+                    self.scans = table
+                    self.index_scans()
+                self.params.file_format = "mzml"
+            elif base_name.lower().endswith(".mzxml"):
+                with mzxml.MzXML(file_name) as reader:
+                    self.extract_scan_mzxml(scans=reader)
+                    self.params.file_format = "mzxml"
+            elif base_name.lower().endswith(".mzh5"):
+                from .mzh5 import read_mzh5_to_MSData
+                read_mzh5_to_MSData(self, file_name, mmap=mmap, write_sidecar=write_sidecar)
+            else:
+                raise ValueError("Unsupported raw data format. " +
+                                 "Raw data must be mzML, mzXML, mzh5, mzjson or mzjson.gz.")
+        else:
+            print("File {} does not exist.".format(file_name))
+
+
+    def _set_params(self, file_name, params):
+        """
+        Function to set the parameters and the file name for reading a raw file.
+
+        Parameters
+        ----------
+        file_name: str
+            Name of the raw data file.
+        params: Params object
+            A Params object that contains the parameters.
+        """
+
         # set intensity tolerance for MS1 scans if not provided
         if params.ms1_abs_int_tol is None:
             # 30000 for orbitrap, 1000 for other types
@@ -116,88 +178,132 @@ class MSData:
         self.params.file_path = file_name
         base_name = os.path.basename(file_name)
         self.params.file_name = base_name.split(".")[0]
-        
-        if os.path.isfile(file_name):
-            if base_name.lower().endswith(".mzml"):
-                with mzml.MzML(file_name) as reader:
-                    self.extract_scan_mzml(scans=reader)
-                    self.params.file_format = "mzml"
-            elif base_name.lower().endswith(".mzxml"):
-                with mzxml.MzXML(file_name) as reader:
-                    self.extract_scan_mzxml(scans=reader)
-                    self.params.file_format = "mzxml"
-            else:
-                raise ValueError("Unsupported raw data format. " +
-                                 "Raw data must be mzML, mzXML, mzjson or mzjson.gz.")
-        else:
-            print("File {} does not exist.".format(file_name))
 
 
-    def extract_scan_mzml(self, scans):
+    def stream_features(self, file_name, params=None, batch_size=1000):
         """
-        Function to extract all scans and convert them to Scan objects.
+        Read a mzML file and detect features in a single pass. Blocks of spectra are decoded
+        and preprocessed (see iter_scan_tables) and their MS1 scans are fed to a ROITracer,
+        so the MS1 scans are never held at the same time and parsing overlaps with detection.
+        The features are the same as detected by read_raw_data and detect_features with the
+        vectorized engine.
+
+        Only the MS2 scans and the metadata of all scans are kept in self.scans. MS1 scans 
+        have no signals in it, and the base peak chromatogram and the precursor ion fractions 
+        of the MS2 scans are computed while streaming. Functions that need the MS1 signals
+        (e.g. EIC extraction, feature grouping and mzpkl output) cannot be used afterwards.
 
         Parameters
         ----------
-        scans: iteratable object from pyteomics mzml.MzML
-            An iteratable object that contains all MS1 and MS2 scans.
+        file_name: str
+            Name of the mzML file.
+        params: Params object
+            A Params object that contains the parameters. If None, the default parameters
+            are used based on the type of mass spectrometer.
+        batch_size: int
+            Number of spectra preprocessed at once.
         """
 
-        if self.params is None:
-            raise ValueError("Please set the parameters before extracting scans.")
-
-        time_unit = scans[0]['scanList']['scan'][0]['scan start time'].unit_info
+        if params is None:
+            params = Params()
+            ms_type, ion_mode, centroid = find_ms_info(file_name)
+            params.set_default(ms_type, ion_mode)
+            params.ms_type = ms_type
+            params.is_centroid = centroid
+        self._set_params(file_name, params)
 
-        for idx, spec in enumerate(scans):
-            
-            # get time
-            if "scan start time" in spec['scanList']['scan'][0]:
-                scan_time = spec['scanList']['scan'][0]['scan start time']
-            elif "scan time" in spec['scanList']['scan'][0]:
-                scan_time = spec['scanList']['scan'][0]['scan time']   # not a standard format
+        if not os.path.isfile(file_name):
+            print("File {} does not exist.".format(file_name))
+            return None
+        if not file_name.lower().endswith(".mzml"):
+            raise ValueError("Streaming feature detection only supports mzML files.")
+        self.params.file_format = "mzml"
+
+        tracer = ROITracer(self.params.mz_tol_ms1, self.params.feature_gap_tol, min_length=self.params.roi_min_length,
+                           min_height=self.params.roi_min_height, use_numba=self.params.use_numba)
+        features = []
+        tables = []
+        ms1_idx, ms1_time, base_peaks = [], [], []
+        pif = {}
+        # the last MS1 scan (time, signals) and the MS2 scans after it, waiting for the next MS1 scan
+        prev_ms1 = None
+        pending_ms2 = []
+        first_idx = 0
+
+        spectra = iter_mzml_spectra(file_name, fast=self.params.fast_mzml_reader)
+        for table in iter_scan_tables(spectra, self.params, batch_size=batch_size):
+            counts = np.diff(table.offset)
+            is_valid = table.has_signals & (counts > 0)
+            for i in np.flatnonzero(is_valid):
+                scan_time = table.time[i]
+                signals = table.get_signals(i)
+                if table.level[i] == 1:
+                    tracer.add_scan(signals[:, 0], signals[:, 1], scan_time, first_idx + i)
+                    ms1_idx.append(first_idx + i)
+                    ms1_time.append(scan_time)
+                    base_peaks.append(signals[np.argmax(signals[:, 1])].copy())
+                    # the closest MS1 scan of an MS2 scan is the one before or after it
+                    for ms2_idx, ms2_time, mz, iso_window in pending_ms2:
+                        if prev_ms1 is not None and abs(prev_ms1[0] - ms2_time) <= abs(scan_time - ms2_time):
+                            pif[ms2_idx] = _precursor_ion_fraction(prev_ms1[1], mz, iso_window)
+                        else:
+                            pif[ms2_idx] = _precursor_ion_fraction(signals, mz, iso_window)
+                    pending_ms2 = []
+                    prev_ms1 = (scan_time, np.array(signals))
+                    features.extend(summarize_features(tracer.pop_features(), pa=False, g_score=False, a_score=False))
+                elif table.level[i] == 2:
+                    mz = _safe_float(table.precursor_mz[i])
+                    iso_window = table.isolation_window[i]
+                    iso_window = None if np.isnan(iso_window[0]) else [float(iso_window[0]), float(iso_window[1])]
+                    if mz is None or not np.isfinite(mz):
+                        pif[first_idx + i] = 0.0
+                    else:
+                        pending_ms2.append((first_idx + i, scan_time, mz, iso_window))
+
+            # drop the MS1 signals of the block
+            is_ms1_peak = np.repeat(table.level == 1, counts)
+            table.filter_peaks(~is_ms1_peak)
+            tables.append(table)
+            first_idx += len(table)
+
+        for ms2_idx, ms2_time, mz, iso_window in pending_ms2:
+            pif[ms2_idx] = 0.0 if prev_ms1 is None else _precursor_ion_fraction(prev_ms1[1], mz, iso_window)
+
+        features.extend(summarize_features(tracer.close(), pa=False, g_score=False, a_score=False))
+        _report_pruned_rois(self, tracer.n_pruned)
+        # sort by m/z
+        features.sort(key=lambda x: x.mz)
+        self.features = features
+
+        self.scans = ScanTable.concat(tables)
+        self.ms1_idx_arr = np.array(ms1_idx, dtype=np.int64)
+        self.ms1_time_arr = np.array(ms1_time, dtype=np.float64)
+        self.ms2_idx_arr = np.where(self.scans.has_signals & (np.diff(self.scans.offset) > 0) & (self.scans.level == 2))[0]
+        self.base_peak_arr = np.array(base_peaks, dtype=np.float32).reshape(-1, 2)
+        self._precursor_ion_fractions = pif
+        self._mz_index = None
+
+
+    def extract_scan_spectra(self, spectra):
+        """
+        Function to extract all scans from Spectrum records and store them in a ScanTable.
 
-            if time_unit == 'second':
-                scan_time /= 60     # convert to minute
-            
-            scan_time = float(scan_time)
+        Parameters
+        ----------
+        spectra: iteratable object of mzml_reader.Spectrum
+            An iteratable object that contains all MS1 and MS2 scans, e.g. from iter_mzml_spectra.
+        """
 
-            # get level of mass spectrum
-            level = spec['ms level']
+        if self.params is None:
+            raise ValueError("Please set the parameters before extracting scans.")
 
-            # skip scans not in the defined scan levels or outside the defined retention time range
-            if (level not in self.params.scan_levels) or (scan_time < self.params.rt_lower_limit) or (scan_time > self.params.rt_upper_limit):
-                self.scans.append(Scan(level=level, id=idx, scan_time=scan_time, signals=None, precursor_mz=None))
-                continue
-            
-            signals = np.array([spec['m/z array'], spec['intensity array']], dtype=np.float32).T
-            precursor_mz = None
-            isolation_window = None
-            
-            if level == 2:
-                isolation_window = [1.5, 1.5]
-                precursor = spec['precursorList']['precursor'][0]
-                precursor_mz = _safe_float(
-                    precursor['selectedIonList']['selectedIon'][0].get('selected ion m/z')
-                )
-                if 'isolationWindow' in precursor:
-                    if 'isolation window lower offset' in precursor['isolationWindow'] and 'isolation window upper offset' in precursor['isolationWindow']:
-                        isolation_window = [
-                            _safe_float(precursor['isolationWindow']['isolation window lower offset'], default=1.5),
-                            _safe_float(precursor['isolationWindow']['isolation window upper offset'], default=1.5),
-                        ]
-            
-            self.scans.append(_preprocess_signals_to_scan(level=level, id=idx, scan_time=scan_time, signals=signals, 
-                                                          params=self.params, precursor_mz=precursor_mz, isolation_window=isolation_window))
-        
-        self.ms1_idx_arr = np.array([s.id for s in self.scans if s.level == 1 and s.signals is not None and len(s.signals) > 0])
-        self.ms2_idx_arr = np.array([s.id for s in self.scans if s.level == 2 and s.signals is not None and len(s.signals) > 0])
-        self.ms1_time_arr = np.array([self.scans[i].time for i in self.ms1_idx_arr])
-        self.base_peak_arr = np.array([self.scans[i].signals[np.argmax(self.scans[i].signals[:, 1])] for i in self.ms1_idx_arr])
+        self.scans = _spectra_to_scan_table(spectra, self.params)
+        self.index_scans()
 
 
     def extract_scan_mzxml(self, scans):
         """
-        Function to extract all scans and convert them to Scan objects.
+        Function to extract all scans and store them in a ScanTable.
 
         Parameters
         ----------
@@ -209,6 +315,7 @@ class MSData:
             raise ValueError("Please set the parameters before extracting scans.")
         
         time_unit = scans[0]["retentionTime"].unit_info
+        scan_list = []
 
         for idx, spec in enumerate(scans):
 
@@ -225,7 +332,7 @@ class MSData:
 
             # skip scans not in the defined scan levels or outside the defined retention time range
             if (level not in self.params.scan_levels) or (scan_time < self.params.rt_lower_limit) or (scan_time > self.params.rt_upper_limit):
-                self.scans.append(Scan(level=level, id=idx, scan_time=scan_time, signals=None, precursor_mz=None))
+                scan_list.append(Scan(level=level, id=idx, scan_time=scan_time, signals=None, precursor_mz=None))
                 continue
             
             precursor_mz = None
@@ -239,13 +346,26 @@ class MSData:
                     wideness = _safe_float(spec['precursorMz'][0]["windowWideness"], default=3.0)
                     isolation_window = [wideness / 2, wideness / 2]        
             
-            self.scans.append(_preprocess_signals_to_scan(level=level, id=idx, scan_time=scan_time, signals=signals,
+            scan_list.append(_preprocess_signals_to_scan(level=level, id=idx, scan_time=scan_time, signals=signals,
                                                           params=self.params, precursor_mz=precursor_mz, isolation_window=isolation_window))
         
-        self.ms1_idx_arr = np.array([s.id for s in self.scans if s.level == 1 and s.signals is not None and len(s.signals) > 0])
-        self.ms2_idx_arr = np.array([s.id for s in self.scans if s.level == 2 and s.signals is not None and len(s.signals) > 0])
-        self.ms1_time_arr = np.array([self.scans[i].time for i in self.ms1_idx_arr])
-        self.base_peak_arr = np.array([self.scans[i].signals[np.argmax(self.scans[i].signals[:, 1])] for i in self.ms1_idx_arr])
+        self.scans = ScanTable.from_scans(scan_list)
+        self.index_scans()
+
+
+    def index_scans(self):
+        """
+        Function to find the MS1 and MS2 scans with signals and build the MS1 time array and 
+        the base peak chromatogram from the ScanTable.
+        """
+
+        table = self.scans
+        is_valid = table.has_signals & (np.diff(table.offset) > 0)
+        self.ms1_idx_arr = np.where(is_valid & (table.level == 1))[0]
+        self.ms2_idx_arr = np.where(is_valid & (table.level == 2))[0]
+        self.ms1_time_arr = table.time[self.ms1_idx_arr]
+        self.base_peak_arr = table.base_peaks(self.ms1_idx_arr)
+        self._mz_index = None
 
 
     def drop_ms1_ions_by_intensity(self, int_tol):
@@ -258,23 +378,32 @@ class MSData:
             Abolute intensity tolerance.
         """
 
-        for idx in self.ms1_idx_arr:
-            self.scans[idx].signals = self.scans[idx].signals[self.scans[idx].signals[:, 1] > int_tol]
+        table = self.scans
+        is_ms1 = np.zeros(len(table), dtype=bool)
+        is_ms1[self.ms1_idx_arr] = True
+        is_ms1_peak = np.repeat(is_ms1, np.diff(table.offset))
+        table.filter_peaks(~is_ms1_peak | (table.intensity > int_tol))
+        self._mz_index = None
 
     """
     For data processing including feature detection, feature segmentation, feature summarization
     --------------------------------------------------------------------------------------------
     """
 
-    def detect_features(self):
+    def detect_features(self, n_jobs=1):
         """
         Run feature detection. Parameters are specified in self.params (Params object).
+
+        Parameters
+        ----------
+        n_jobs: int
+            Number of workers to trace m/z slabs of the file in parallel, -1 to use all CPUs.
         """
 
         if len(self.ms1_idx_arr) == 0:
             return []
 
-        self.features = detect_features(self)
+        self.features = detect_features(self, n_jobs=n_jobs)
 
 
     def segment_features(self, iteration=2):
@@ -306,14 +435,12 @@ class MSData:
             Whether to calculate asymmetry factor.
         """      
 
-        valid_features = []
-        for feature in self.features:
-            try:
-                feature.summarize(g_score=cal_g_score, a_score=cal_a_score)
-                valid_features.append(feature)
-            except Exception:
-                continue
-        self.features = valid_features
+        # features that cannot be summarized are dropped
+        self.features = summarize_features(self.features, g_score=cal_g_score, a_score=cal_a_score)
+
+        # score the peak shapes of all features at once
+        if self.params.predict_peak_quality:
+            predict_peak_quality(self.features)
 
         # sort features by m/z
         self.features.sort(key=lambda x: x.mz)
@@ -471,6 +598,9 @@ class MSData:
                     "MS2", "MS2_scan_id", "precursor_ion_fraction", "matched_MS2", "search_mode", "annotation", "formula", "similarity", "matched_mz", "matched_peak_number", "SMILES", "InChIKey"]
 
         df = pd.DataFrame(result, columns=columns)
+        # the peak quality is appended only when it was predicted, so the other columns keep their positions
+        if any(f.peak_quality is not None for f in self.features):
+            df["peak_quality"] = [None if f.peak_quality is None else round(f.peak_quality, 3) for f in self.features]
         
         # save the dataframe to csv file
         if output_path is None:
@@ -488,9 +618,15 @@ class MSData:
         else:
             rt0, rt1 = rt_range[0], rt_range[1]
 
+        # use the m/z index if it has been built, results are identical
+        if self._mz_index is not None:
+            return self._get_eics_from_index([target_mz], [rt0], [rt1], mz_tol)[0]
+
         times = self.ms1_time_arr          # (n_ms1,) float32/float64, sorted
         ms1_idx = self.ms1_idx_arr         # (n_ms1,) int32, aligned to times
-        scans = self.scans                 # local bind
+        offset = self.scans.offset         # signals of scan i are peaks[offset[i]:offset[i+1]]
+        all_mzs = self.scans.mz
+        all_ints = self.scans.intensity
 
         # RT window -> contiguous slice via binary search (much faster than mask+where)
         left = np.searchsorted(times, rt0, side="left")
@@ -502,33 +638,143 @@ class MSData:
         eic_scan_idx_arr = ms1_idx[left:right]
         n = eic_scan_idx_arr.size
 
-        # allocate outputs as two 1D arrays (faster than (n,2) then column ops)
-        eic_mz = np.full(n, np.nan, dtype=np.float32)
-        eic_int = np.zeros(n, dtype=np.float32)
-
         mz0 = float(target_mz)
         lo = mz0 - mz_tol
         hi = mz0 + mz_tol
 
+        if self.params is not None and is_enabled(self.params.use_numba):
+            # memory-mapped peaks are passed as plain arrays without copying
+            eic_mz, eic_int = eic_max_signals(offset, np.asarray(all_mzs), np.asarray(all_ints), 
+                                              np.asarray(eic_scan_idx_arr), lo, hi)
+            eic_signals = np.column_stack((eic_mz, eic_int))
+            return eic_time_arr, eic_signals, eic_scan_idx_arr
+
+        # allocate outputs as two 1D arrays (faster than (n,2) then column ops)
+        eic_mz = np.full(n, np.nan, dtype=np.float32)
+        eic_int = np.zeros(n, dtype=np.float32)
+
         for out_i, scan_i in enumerate(eic_scan_idx_arr):
-            sig = scans[int(scan_i)].signals
-            if sig is None or sig.shape[0] == 0:
+            s0 = offset[scan_i]
+            s1 = offset[scan_i + 1]
+            if s1 <= s0:
                 continue
 
-            mzs = sig[:, 0]  # sorted ascending
+            mzs = all_mzs[s0:s1]  # sorted ascending
             # find m/z window indices in O(log n_peaks)
             l = np.searchsorted(mzs, lo, side="left")
             r = np.searchsorted(mzs, hi, side="right")
             if r <= l:
                 continue
 
-            ints = sig[:, 1]
-            j = l + int(np.argmax(ints[l:r]))
-            eic_mz[out_i] = mzs[j]
-            eic_int[out_i] = ints[j]
+            j = s0 + l + int(np.argmax(all_ints[s0 + l:s0 + r]))
+            eic_mz[out_i] = all_mzs[j]
+            eic_int[out_i] = all_ints[j]
 
         eic_signals = np.column_stack((eic_mz, eic_int)).astype(np.float32, copy=False)
         return eic_time_arr, eic_signals, eic_scan_idx_arr
+
+
+    def build_mz_index(self):
+        """
+        Function to build an index of all MS1 signals sorted by m/z. It is built once and 
+        used by get_eics and get_eic_data to extract EICs without looping over scans.
+
+        Returns
+        -------
+        tuple
+            (m/z, intensity, MS1 scan ordinal) of all MS1 signals sorted by m/z. The ordinal 
+            is the position of the scan in ms1_idx_arr.
+        """
+
+        if self._mz_index is not None:
+            return self._mz_index
+
+        table = self.scans
+        ms1_idx = np.asarray(self.ms1_idx_arr, dtype=np.int64)
+        starts = table.offset[ms1_idx]
+        counts = table.offset[ms1_idx + 1] - starts
+        total = int(np.sum(counts))
+
+        # positions of all MS1 signals in the peak array, in scan order
+        pos = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(total)
+        ordinal = np.repeat(np.arange(len(ms1_idx), dtype=np.int32), counts)
+
+        # stable sort keeps the order of signals with the same m/z within a scan
+        mzs = table.mz[pos]
+        order = np.argsort(mzs, kind="stable")
+        self._mz_index = (mzs[order], table.intensity[pos][order], ordinal[order])
+
+        return self._mz_index
+
+
+    def get_eics(self, mz_arr, rt_arr=None, mz_tol=0.005, rt_tol=0.3):
+        """
+        Function to extract EICs of many targets in a batch. For each target, the result is 
+        the same as get_eic_data(mz, rt, mz_tol, rt_tol).
+
+        Parameters
+        ----------
+        mz_arr: numpy array
+            Target m/z values.
+        rt_arr: numpy array
+            Target retention times. If None, EICs of the whole run are extracted.
+        mz_tol: float
+            m/z tolerance.
+        rt_tol: float
+            Retention time tolerance.
+
+        Returns
+        -------
+        list
+            A list of (eic_time_arr, eic_signals, eic_scan_idx_arr) for each target.
+        """
+
+        mz_arr = np.asarray(mz_arr, dtype=np.float64).ravel()
+        if rt_arr is None:
+            rt0_arr = np.zeros(len(mz_arr))
+            rt1_arr = np.full(len(mz_arr), np.inf)
+        else:
+            rt_arr = np.asarray(rt_arr, dtype=np.float64).ravel()
+            rt0_arr = rt_arr - rt_tol
+            rt1_arr = rt_arr + rt_tol
+
+        self.build_mz_index()
+        return self._get_eics_from_index(mz_arr, rt0_arr, rt1_arr, mz_tol)
+
+
+    def _get_eics_from_index(self, mz_arr, rt0_arr, rt1_arr, mz_tol, max_candidates=2**22):
+        """
+        Extract EICs with the m/z index for targets given by m/z and retention time ranges.
+        Targets are processed in blocks so that at most about max_candidates signals are 
+        gathered at a time.
+        """
+
+        idx_mz, idx_int, idx_ord = self._mz_index
+        times = self.ms1_time_arr
+        ms1_idx = self.ms1_idx_arr
+
+        mz_arr = np.asarray(mz_arr, dtype=np.float64)
+        # bounds are compared in float64, same as searching a python float in get_eic_data
+        lo = np.searchsorted(idx_mz, mz_arr - mz_tol, side="left")
+        hi = np.searchsorted(idx_mz, mz_arr + mz_tol, side="right")
+        left = np.searchsorted(times, np.asarray(rt0_arr, dtype=np.float64), side="left")
+        right = np.searchsorted(times, np.asarray(rt1_arr, dtype=np.float64), side="right")
+        right = np.maximum(right, left)
+        n_cand = np.where(right > left, hi - lo, 0)
+
+        results = []
+        block_start = 0
+        cum = np.cumsum(n_cand)
+        while block_start < len(mz_arr):
+            # at least one target per block
+            base = cum[block_start] - n_cand[block_start]
+            block_end = max(int(np.searchsorted(cum, base + max_candidates, side="right")), block_start + 1)
+            sl = slice(block_start, block_end)
+            results.extend(_eics_block(idx_mz, idx_int, idx_ord, times, ms1_idx, 
+                                       lo[sl], hi[sl], left[sl], right[sl], n_cand[sl]))
+            block_start = block_end
+
+        return results
     
 
     def plot_eics(self, target_mz_arr, target_rt=None, mz_tol=0.005, rt_tol=0.3, rt_range=None,
@@ -692,10 +938,7 @@ class MSData:
             A function to correct retention time.
         """
 
-        all_rts = np.array([s.time for s in self.scans])
-        all_rts = f(all_rts)
-        for i in range(len(self.scans)):
-            self.scans[i].time = all_rts[i]
+        self.scans.time = np.asarray(f(self.scans.time), dtype=np.float64)
 
 
     def convert_to_mzpkl(self):
@@ -837,6 +1080,299 @@ class Scan:
             return signals
 
 
+class ScanTable:
+    """
+    A columnar (struct-of-arrays) store of all scans in a file. The signals of all
+    scans are kept in one contiguous [[m/z, intensity], ...] array, and the signals of
+    scan i are peaks[offset[i]:offset[i+1]]. Indexing the table returns a ScanView, so
+    it can be used in place of a list of Scan objects.
+    """
+
+    def __init__(self, level, time, peaks, offset, precursor_mz=None, isolation_window=None, has_signals=None):
+        """
+        Parameters
+        ----------
+        level: numpy array
+            Level of each scan.
+        time: numpy array
+            Scan time of each scan in minute.
+        peaks: numpy array
+            Signals of all scans as 2D numpy array in float32, organized as [[m/z, intensity], ...].
+            It can be a memory-mapped array.
+        offset: numpy array
+            Offsets of the scans in peaks, with length of the number of scans + 1.
+        precursor_mz: numpy array
+            Precursor m/z of each scan, NaN for MS1 scans.
+        isolation_window: numpy array
+            Isolation window of each scan as [[lower offset, upper offset], ...], NaN for MS1 scans.
+        has_signals: numpy array
+            Whether the scan was processed. Scans that are not processed have signals of None.
+        """
+
+        n = len(level)
+        self.level = np.asarray(level, dtype=np.int8)                     # level of mass spectrum
+        self.time = np.asarray(time, dtype=np.float64)                    # scan time in minute
+        self.peaks = peaks                                                # [[m/z, intensity], ...] of all scans
+        self.offset = np.asarray(offset, dtype=np.int64)                  # scan i owns peaks[offset[i]:offset[i+1]]
+        if precursor_mz is None:
+            precursor_mz = np.full(n, np.nan)
+        self.precursor_mz = np.asarray(precursor_mz, dtype=np.float64)    # for MS2 only
+        if isolation_window is None:
+            isolation_window = np.full((n, 2), np.nan)
+        self.isolation_window = np.asarray(isolation_window, dtype=np.float64)  # for MS2 only
+        if has_signals is None:
+            has_signals = np.ones(n, dtype=bool)
+        self.has_signals = np.asarray(has_signals, dtype=bool)
+
+
+    @classmethod
+    def from_scans(cls, scans):
+        """
+        Function to build a ScanTable from a list of Scan objects.
+
+        Parameters
+        ----------
+        scans: list
+            A list of Scan objects ordered by scan id.
+
+        Returns
+        -------
+        table: ScanTable
+            A ScanTable object.
+        """
+
+        n = len(scans)
+        level = np.array([s.level for s in scans], dtype=np.int8)
+        time = np.array([s.time for s in scans], dtype=np.float64)
+        precursor_mz = np.array([np.nan if s.precursor_mz is None else s.precursor_mz for s in scans], dtype=np.float64)
+        isolation_window = np.full((n, 2), np.nan)
+        for i, s in enumerate(scans):
+            if s.isolation_window is not None:
+                isolation_window[i] = s.isolation_window
+        has_signals = np.array([s.signals is not None for s in scans], dtype=bool)
+
+        offset = np.zeros(n + 1, dtype=np.int64)
+        offset[1:] = np.cumsum([0 if s.signals is None else len(s.signals) for s in scans])
+        signals = [s.signals for s in scans if s.signals is not None and len(s.signals) > 0]
+        if len(signals) > 0:
+            peaks = np.concatenate(signals).astype(np.float32, copy=False)
+        else:
+            peaks = np.empty((0, 2), dtype=np.float32)
+
+        return cls(level=level, time=time, peaks=peaks, offset=offset, precursor_mz=precursor_mz,
+                   isolation_window=isolation_window, has_signals=has_signals)
+
+
+    @classmethod
+    def concat(cls, tables):
+        """
+        Function to concatenate ScanTables of consecutive ranges of scans.
+
+        Parameters
+        ----------
+        tables: list
+            A list of ScanTable objects in scan order.
+
+        Returns
+        -------
+        table: ScanTable
+            A ScanTable object.
+        """
+
+        if len(tables) == 1:
+            return tables[0]
+
+        offset = [np.zeros(1, dtype=np.int64)]
+        n_peaks = 0
+        for t in tables:
+            offset.append(t.offset[1:] + n_peaks)
+            n_peaks += t.offset[-1]
+
+        return cls(level=np.concatenate([t.level for t in tables]),
+                   time=np.concatenate([t.time for t in tables]),
+                   peaks=np.concatenate([t.peaks for t in tables]).astype(np.float32, copy=False),
+                   offset=np.concatenate(offset),
+                   precursor_mz=np.concatenate([t.precursor_mz for t in tables]),
+                   isolation_window=np.concatenate([t.isolation_window for t in tables]),
+                   has_signals=np.concatenate([t.has_signals for t in tables]))
+
+
+    def __len__(self):
+        return len(self.level)
+
+
+    def __getitem__(self, idx):
+        idx = int(idx)
+        if idx < 0:
+            idx += len(self.level)
+        if idx < 0 or idx >= len(self.level):
+            raise IndexError("scan index out of range")
+        return ScanView(self, idx)
+
+
+    def __iter__(self):
+        for idx in range(len(self.level)):
+            yield ScanView(self, idx)
+
+
+    @property
+    def mz(self):
+        """m/z of all signals."""
+        return self.peaks[:, 0]
+
+
+    @property
+    def intensity(self):
+        """Intensity of all signals."""
+        return self.peaks[:, 1]
+
+
+    def get_signals(self, idx):
+        """
+        Function to get the signals of a scan without creating a ScanView.
+
+        Parameters
+        ----------
+        idx: int
+            Scan index.
+
+        Returns
+        -------
+        signals: numpy array
+            A view of the signals of the scan, or None if the scan was not processed.
+        """
+
+        if not self.has_signals[idx]:
+            return None
+        return self.peaks[self.offset[idx]:self.offset[idx+1]]
+
+
+    def filter_peaks(self, keep):
+        """
+        Function to keep a subset of signals of all scans in place.
+
+        Parameters
+        ----------
+        keep: numpy array
+            A boolean mask over all signals.
+        """
+
+        kept = np.zeros(len(keep) + 1, dtype=np.int64)
+        np.cumsum(keep, out=kept[1:])
+        self.offset = kept[self.offset]
+        self.peaks = self.peaks[keep]
+
+
+    def base_peaks(self, idx_arr):
+        """
+        Function to get the most intense signal of each scan.
+
+        Parameters
+        ----------
+        idx_arr: numpy array
+            Indexes of scans with at least one signal.
+
+        Returns
+        -------
+        base_peak_arr: numpy array
+            The base peaks organized as [[m/z, intensity], ...].
+        """
+
+        idx_arr = np.asarray(idx_arr, dtype=np.int64)
+        if len(idx_arr) == 0:
+            return np.empty((0, 2), dtype=np.float32)
+
+        # gather the signals of the scans, segment k holds the signals of scan idx_arr[k]
+        starts = self.offset[idx_arr]
+        counts = self.offset[idx_arr + 1] - starts
+        seg_starts = np.cumsum(counts) - counts
+        pos = np.repeat(starts - seg_starts, counts) + np.arange(counts.sum())
+        ints = self.peaks[pos, 1]
+        seg_max = np.maximum.reduceat(ints, seg_starts)
+        # the first signal that reaches the maximum, same as np.argmax
+        is_max = ints == np.repeat(seg_max, counts)
+        seg_id = np.repeat(np.arange(len(idx_arr)), counts)
+        _, first = np.unique(seg_id[is_max], return_index=True)
+        return np.asarray(self.peaks[pos[np.flatnonzero(is_max)[first]]])
+
+
+class ScanView(Scan):
+    """
+    A thin Scan that reads its data from a row of a ScanTable. Setting the signals
+    detaches the view from the table. When pickled, it becomes a normal Scan.
+    """
+
+    def __init__(self, table, idx):
+        """
+        Parameters
+        ----------
+        table: ScanTable
+            The table that stores the scan.
+        idx: int
+            Index of the scan in the table.
+        """
+
+        self._table = table
+        self._own_signals = None
+        self._detached = False
+        self.id = idx
+        self.precursor_ion_fraction = None
+        self.file_name = None
+
+
+    @property
+    def level(self):
+        return int(self._table.level[self.id])
+
+
+    @property
+    def time(self):
+        return float(self._table.time[self.id])
+
+
+    @time.setter
+    def time(self, value):
+        self._table.time[self.id] = value
+
+
+    @property
+    def precursor_mz(self):
+        v = self._table.precursor_mz[self.id]
+        return None if np.isnan(v) else float(v)
+
+
+    @precursor_mz.setter
+    def precursor_mz(self, value):
+        self._table.precursor_mz[self.id] = np.nan if value is None else value
+
+
+    @property
+    def isolation_window(self):
+        v = self._table.isolation_window[self.id]
+        return None if np.isnan(v[0]) else [float(v[0]), float(v[1])]
+
+
+    @property
+    def signals(self):
+        if self._detached:
+            return self._own_signals
+        return self._table.get_signals(self.id)
+
+
+    @signals.setter
+    def signals(self, value):
+        self._own_signals = value
+        self._detached = True
+
+
+    def __reduce__(self):
+        signals = self.signals
+        if signals is not None:
+            signals = np.array(signals)
+        return (Scan, (self.level, self.id, self.time, signals, self.precursor_mz,
+                                  self.isolation_window, self.file_name, self.precursor_ion_fraction))
+
+
 """
 Helper functions
 ------------------------------------------------------------------------------------------------------------------------
@@ -889,7 +1425,7 @@ def _safe_float(value, default=None):
 
 def read_raw_file_to_obj(file_name, params=None, scan_levels=[1,2], centroid_mz_tol=0.005, 
                          ms1_abs_int_tol=1000, ms2_abs_int_tol=0, ms2_rel_int_tol=0.01, 
-                         precursor_mz_offset=2):
+                         precursor_mz_offset=2, mmap=False, write_sidecar=False, n_jobs=1):
     """
     Read a raw file to a MSData object. It's a useful function for data visualization or 
     simple data analysis. See the MSData class for detailed parameter settings.
@@ -897,7 +1433,7 @@ def read_raw_file_to_obj(file_name, params=None, scan_levels=[1,2], centroid_mz_
     Parameters
     ----------
     file_name: str
-        Name of the raw data file. Valid extensions are mzML, mzXML, mzjson and gz.
+        Name of the raw data file. Valid extensions are mzML, mzXML, mzh5, mzpkl, mzjson and gz.
     params: Params object
         A Params object that contains the parameters.
     scan_levels: list
@@ -915,6 +1451,12 @@ def read_raw_file_to_obj(file_name, params=None, scan_levels=[1,2], centroid_mz_
     precursor_mz_offset: float
         To remove the precursor ion from MS2 scan. The m/z upper limit of signals 
         in MS2 scans is calculated as precursor_mz - precursor_mz_offset.
+    mmap: bool
+        For mzh5 and mzpkl files only. Whether to memory-map the peaks instead of loading them into memory.
+    write_sidecar: bool
+        For mzh5 files only. Whether to write the peak sidecar for memory mapping if it is missing.
+    n_jobs: int
+        For indexed mzML files only. Number of workers to read the file, -1 to use all CPUs.
 
     Returns
     -------
@@ -926,10 +1468,41 @@ def read_raw_file_to_obj(file_name, params=None, scan_levels=[1,2], centroid_mz_
     d = MSData()
     d.read_raw_data(file_name, params=params, scan_levels=scan_levels, centroid_mz_tol=centroid_mz_tol,
                     ms1_abs_int_tol=ms1_abs_int_tol, ms2_abs_int_tol=ms2_abs_int_tol, 
-                    ms2_rel_int_tol=ms2_rel_int_tol, precursor_mz_offset=precursor_mz_offset)
+                    ms2_rel_int_tol=ms2_rel_int_tol, precursor_mz_offset=precursor_mz_offset, mmap=mmap,
+                    write_sidecar=write_sidecar, n_jobs=n_jobs)
     return d
 
 
+def find_reload_file(tmp_file_dir, file_name):
+    """
+    Find the intermediate file of a processed raw file for data reloading (e.g. gap filling
+    and feature grouping). Both mzh5 and mzpkl files are accepted. If both exist, the most
+    recently written one is used.
+
+    Parameters
+    ----------
+    tmp_file_dir: str
+        Directory of the intermediate files.
+    file_name: str
+        File name without extension.
+
+    Returns
+    -------
+    fn: str
+        Path to the intermediate file. None if not found.
+    """
+
+    if tmp_file_dir is None:
+        return None
+
+    candidates = [os.path.join(tmp_file_dir, file_name + ext) for ext in [".mzh5", ".mzpkl"]]
+    candidates = [fn for fn in candidates if os.path.exists(fn)]
+    if len(candidates) == 0:
+        return None
+
+    return max(candidates, key=os.path.getmtime)
+
+
 def find_best_ms2(ms2_list):
     """
     Function to find the best MS2 spectrum for a list of MS2 spectra.
@@ -945,6 +1518,257 @@ def find_best_ms2(ms2_list):
         return None
 
 
+def _spectrum_to_scan(spec, params):
+    """
+    Function to generate a Scan object from a mzml_reader.Spectrum record.
+    """
+
+    level = spec.level
+    scan_time = spec.scan_time
+
+    # skip scans not in the defined scan levels or outside the defined retention time range
+    if (level not in params.scan_levels) or (scan_time < params.rt_lower_limit) or (scan_time > params.rt_upper_limit):
+        return Scan(level=level, id=spec.index, scan_time=scan_time, signals=None, precursor_mz=None)
+
+    precursor_mz = None
+    isolation_window = None
+
+    if level == 2:
+        precursor_mz = spec.precursor_mz
+        isolation_window = [1.5, 1.5] if spec.isolation_window is None else list(spec.isolation_window)
+
+    return _preprocess_signals_to_scan(level=level, id=spec.index, scan_time=scan_time, signals=spec.signals,
+                                       params=params, precursor_mz=precursor_mz, isolation_window=isolation_window)
+
+
+def _read_mzml_chunk(file_name, offsets, end_offset, first_index, params):
+    """
+    Function to read and preprocess a range of spectra of an indexed mzML file.
+    """
+
+    return _spectra_to_scan_table(iter_spectra_at(file_name, offsets, end_offset, first_index), params)
+
+
+def _spectra_to_scan_table(spectra, params, batch_size=1000):
+    """
+    Function to preprocess Spectrum records into a ScanTable, in batches of spectra with
+    preprocess_spectra if params.vectorized_preprocessing is True, or scan by scan otherwise.
+    """
+
+    if not params.vectorized_preprocessing:
+        return ScanTable.from_scans([_spectrum_to_scan(spec, params) for spec in spectra])
+
+    return ScanTable.concat(list(iter_scan_tables(spectra, params, batch_size=batch_size)))
+
+
+def iter_scan_tables(spectra, params, batch_size=1000):
+    """
+    Function to preprocess Spectrum records in blocks of consecutive spectra, so that a
+    file can be processed without holding all of its scans.
+
+    Parameters
+    ----------
+    spectra: iteratable object of mzml_reader.Spectrum
+        Spectra in scan order, e.g. from iter_mzml_spectra.
+    params: Params object
+        A Params object that contains the parameters.
+    batch_size: int
+        Number of spectra in a block.
+
+    Yields
+    ------
+    table: ScanTable
+        A ScanTable of the next block of spectra. At least one (maybe empty) table is yielded.
+    """
+
+    n_tables = 0
+    batch = []
+    for spec in spectra:
+        batch.append(spec)
+        if len(batch) == batch_size:
+            yield _preprocess_batch(batch, params)
+            n_tables += 1
+            batch = []
+    if len(batch) > 0 or n_tables == 0:
+        yield _preprocess_batch(batch, params)
+
+
+def _preprocess_batch(spectra, params):
+    """
+    Function to preprocess a list of spectra with preprocess_spectra or scan by scan, 
+    see params.vectorized_preprocessing.
+    """
+
+    if params.vectorized_preprocessing:
+        return preprocess_spectra(spectra, params)
+    return ScanTable.from_scans([_spectrum_to_scan(spec, params) for spec in spectra])
+
+
+def preprocess_spectra(spectra, params):
+    """
+    Function to preprocess a batch of spectra at once, with the same results as 
+    _preprocess_signals_to_scan on each spectrum. The signals of all spectra are 
+    concatenated, filtered with masks and centroided with one segmented np.add.reduceat 
+    pass over the (scan, m/z group) boundaries.
+
+    Parameters
+    ----------
+    spectra: list
+        A list of mzml_reader.Spectrum records in scan order.
+    params: Params object
+        A Params object that contains the parameters.
+
+    Returns
+    -------
+    table: ScanTable
+        A ScanTable of the spectra.
+    """
+
+    n = len(spectra)
+    level = np.array([spec.level for spec in spectra], dtype=np.int8)
+    time = np.array([spec.scan_time for spec in spectra], dtype=np.float64)
+    # scans not in the defined scan levels or outside the defined retention time range have no signals
+    has_signals = np.isin(level, params.scan_levels) & (time >= params.rt_lower_limit) & (time <= params.rt_upper_limit)
+
+    precursor_mz = np.full(n, np.nan)
+    isolation_window = np.full((n, 2), np.nan)
+    raw_counts = np.zeros(n, dtype=np.int64)
+    for i, spec in enumerate(spectra):
+        if not has_signals[i]:
+            continue
+        raw_counts[i] = len(spec.mz)
+        if spec.level == 2:
+            if spec.precursor_mz is not None:
+                precursor_mz[i] = spec.precursor_mz
+            # the isolation window is not kept for empty scans, same as _preprocess_signals_to_scan
+            if raw_counts[i] > 0:
+                isolation_window[i] = (1.5, 1.5) if spec.isolation_window is None else spec.isolation_window
+
+    selected = [spec for i, spec in enumerate(spectra) if raw_counts[i] > 0]
+    if len(selected) == 0:
+        return ScanTable(level=level, time=time, peaks=np.empty((0, 2), dtype=np.float32),
+                         offset=np.zeros(n + 1, dtype=np.int64), precursor_mz=precursor_mz,
+                         isolation_window=isolation_window, has_signals=has_signals)
+
+    mz = np.concatenate([spec.mz for spec in selected]).astype(np.float32, copy=False)
+    intensity = np.concatenate([spec.intensity for spec in selected]).astype(np.float32, copy=False)
+    scan_of = np.repeat(np.arange(n), raw_counts)
+    peak_level = level[scan_of]
+
+    # filter MS1 signals by m/z range and intensity
+    keep = np.ones(len(mz), dtype=bool)
+    is_ms1 = peak_level == 1
+    keep[is_ms1] = ((mz[is_ms1] > params.mz_lower_limit) & (mz[is_ms1] < params.mz_upper_limit) &
+                    (intensity[is_ms1] > params.ms1_abs_int_tol) & (intensity[is_ms1] < np.inf))
+
+    # filter MS2 signals by the intensity of the base signal and the precursor m/z
+    is_ms2 = peak_level == 2
+    if np.any(is_ms2):
+        starts = np.cumsum(raw_counts) - raw_counts
+        ms2_scans = np.where((level == 2) & (raw_counts > 0))[0]
+        int_lower = np.zeros(n)
+        int_lower[ms2_scans] = np.maximum(params.ms2_abs_int_tol,
+                                          _segment_max(intensity, starts[ms2_scans], raw_counts[ms2_scans]) * params.ms2_rel_int_tol)
+        mz_upper = np.full(n, np.inf)
+        if params.precursor_mz_offset is not None:
+            valid = np.isfinite(precursor_mz)
+            mz_upper[valid] = precursor_mz[valid] - params.precursor_mz_offset
+        # thresholds are compared in float32 as with the scalar thresholds of clean_signals
+        int_lower = int_lower.astype(np.float32)
+        mz_upper = mz_upper.astype(np.float32)
+        s2 = scan_of[is_ms2]
+        keep[is_ms2] = ((mz[is_ms2] > 0) & (mz[is_ms2] < mz_upper[s2]) &
+                        (intensity[is_ms2] > int_lower[s2]) & (intensity[is_ms2] < np.inf))
+
+    mz = mz[keep]
+    intensity = intensity[keep]
+    scan_of = scan_of[keep]
+    counts = np.bincount(scan_of, minlength=n)
+
+    # centroid the signals of all scans at once, groups never span two scans
+    if params.centroid_mz_tol is not None and len(mz) > 0:
+        order = np.lexsort((mz, scan_of))
+        mz = mz[order]
+        intensity = intensity[order]
+        scan_of = scan_of[order]
+        new_group = np.ones(len(mz), dtype=bool)
+        new_group[1:] = (scan_of[1:] != scan_of[:-1]) | (np.diff(mz) >= params.centroid_mz_tol)
+        group_starts = np.flatnonzero(new_group)
+
+        sum_intensity = np.add.reduceat(intensity, group_starts)
+        weighted_mz = np.add.reduceat(mz * intensity, group_starts) / sum_intensity
+        # scans with a single signal are not centroided
+        single = counts[scan_of[group_starts]] <= 1
+        weighted_mz[single] = mz[group_starts[single]]
+
+        mz = weighted_mz
+        intensity = sum_intensity
+        scan_of = scan_of[group_starts]
+        counts = np.bincount(scan_of, minlength=n)
+
+    offset = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(counts, out=offset[1:])
+    peaks = np.empty((len(mz), 2), dtype=np.float32)
+    peaks[:, 0] = mz
+    peaks[:, 1] = intensity
+
+    return ScanTable(level=level, time=time, peaks=peaks, offset=offset, precursor_mz=precursor_mz,
+                     isolation_window=isolation_window, has_signals=has_signals)
+
+
+def _segment_max(values, starts, counts):
+    """
+    Function to get the maximum of each segment values[starts[i]:starts[i]+counts[i]] (counts > 0).
+    """
+
+    pos = np.repeat(starts - (np.cumsum(counts) - counts), counts) + np.arange(counts.sum())
+    return np.maximum.reduceat(values[pos], np.cumsum(counts) - counts)
+
+
+def read_mzml_scans_parallel(file_name, params, n_jobs=-1):
+    """
+    Function to read and preprocess the scans of an indexed mzML file in parallel. The
+    spectra are split into chunks by the byte offsets in <indexList>, each chunk is decoded 
+    and preprocessed by a worker, and the scans are returned in file order.
+
+    Parameters
+    ----------
+    file_name: str
+        Name of the mzML file.
+    params: Params object
+        A Params object that contains the parameters.
+    n_jobs: int
+        Number of workers. -1 to use all CPUs.
+
+    Returns
+    -------
+    table: ScanTable
+        A ScanTable of all scans, or None if the file is not indexed or cannot be 
+        read with the fast reader.
+    """
+
+    index = read_spectrum_offsets(file_name)
+    if index is None:
+        return None
+    offsets, end_offset = index
+
+    n_workers = cpu_count() if n_jobs < 0 else max(1, n_jobs)
+    # more chunks than workers to balance files with uneven scan sizes
+    n_chunks = min(len(offsets), n_workers * 4)
+    bounds = np.linspace(0, len(offsets), n_chunks + 1).astype(int)
+
+    try:
+        results = Parallel(n_jobs=n_workers, backend="loky")(
+            delayed(_read_mzml_chunk)(file_name, offsets[b0:b1], offsets[b1] if b1 < len(offsets) else end_offset,
+                                      b0, params)
+            for b0, b1 in zip(bounds[:-1], bounds[1:]) if b1 > b0
+        )
+    except UnsupportedMzML:
+        return None
+
+    return ScanTable.concat(results)
+
+
 def _preprocess_signals_to_scan(level, id, scan_time, signals, params, precursor_mz=None, isolation_window=None):
     """
     Function to generate a Scan object from signals.
@@ -969,7 +1793,7 @@ def _preprocess_signals_to_scan(level, id, scan_time, signals, params, precursor
                                 intensity_range=[int_lower, np.inf])
     
     if params.centroid_mz_tol is not None:
-        signals = centroid_signals(signals, mz_tol=params.centroid_mz_tol)
+        signals = centroid_signals(signals, mz_tol=params.centroid_mz_tol, use_numba=params.use_numba)
     
     return Scan(level=level, id=id, scan_time=scan_time, signals=signals, 
                 precursor_mz=precursor_mz, isolation_window=isolation_window)
@@ -994,6 +1818,10 @@ def cal_precursor_ion_fraction(d: MSData, ms2: Scan) -> float:
         The precursor ion fraction.
     """
 
+    # computed while streaming the file, see MSData.stream_features
+    if d._precursor_ion_fractions is not None:
+        return d._precursor_ion_fractions.get(ms2.id, 0.0)
+
     mz = _safe_float(ms2.precursor_mz)
     if mz is None or not np.isfinite(mz):
         return 0.0
@@ -1007,8 +1835,14 @@ def cal_precursor_ion_fraction(d: MSData, ms2: Scan) -> float:
     idx = np.argmin(np.abs(time_arr - ms2_rt))
     ms1_scan = d.scans[d.ms1_idx_arr[idx]]
 
-    s = ms1_scan.signals
-    iso_window = ms2.isolation_window
+    return _precursor_ion_fraction(ms1_scan.signals, mz, ms2.isolation_window)
+
+
+def _precursor_ion_fraction(s, mz, iso_window):
+    """
+    Function to calculate the precursor ion fraction from the signals of an MS1 scan.
+    """
+
     if iso_window is None or len(iso_window) != 2:
         return 0.0
     s = s[(s[:,0] > mz - iso_window[0]) & (s[:,0] < mz + iso_window[1])]
@@ -1027,6 +1861,51 @@ def cal_precursor_ion_fraction(d: MSData, ms2: Scan) -> float:
 
 
 
+def _eics_block(idx_mz, idx_int, idx_ord, times, ms1_idx, lo, hi, left, right, n_cand):
+    """
+    Extract EICs for a block of targets from the m/z index (see MSData.get_eics).
+    """
+
+    n_scans = right - left
+    eic_start = np.cumsum(n_scans) - n_scans
+    total_scans = int(np.sum(n_scans))
+
+    eic_mz = np.full(total_scans, np.nan, dtype=np.float32)
+    eic_int = np.zeros(total_scans, dtype=np.float32)
+
+    # gather the index positions of all candidate signals, target by target
+    total = int(np.sum(n_cand))
+    if total > 0:
+        target = np.repeat(np.arange(len(lo)), n_cand)
+        pos = np.repeat(lo - (np.cumsum(n_cand) - n_cand), n_cand) + np.arange(total)
+        ordinal = idx_ord[pos]
+        in_rt = (ordinal >= left[target]) & (ordinal < right[target])
+        target, pos, ordinal = target[in_rt], pos[in_rt], ordinal[in_rt]
+
+        # the most intense signal in each (target, scan), first in m/z order on ties
+        key = eic_start[target] + ordinal - left[target]
+        intensity = idx_int[pos]
+        order = np.lexsort((pos, -intensity, key))
+        key = key[order]
+        first = np.ones(len(key), dtype=bool)
+        first[1:] = key[1:] != key[:-1]
+        best = order[first]
+        eic_mz[key[first]] = idx_mz[pos[best]]
+        eic_int[key[first]] = intensity[best]
+
+    eic_signals = np.column_stack((eic_mz, eic_int))
+
+    results = []
+    for i in range(len(lo)):
+        if n_scans[i] <= 0:
+            results.append((_EMPTY_F32, _EMPTY_SIG, _EMPTY_I32))
+            continue
+        s0, s1 = eic_start[i], eic_start[i] + n_scans[i]
+        results.append((times[left[i]:right[i]], eic_signals[s0:s1], ms1_idx[left[i]:right[i]]))
+
+    return results
+
+
 _EMPTY_F32 = np.empty(0, dtype=np.float32)
 _EMPTY_I32 = np.empty(0, dtype=np.int32)
 _EMPTY_SIG = np.empty((0, 2), dtype=np.float32)
@@ -0,0 +1,421 @@
+# Author: Huaxu Yu
+
+# A module to process files in parallel with a pool of long-lived workers
+
+"""
+The main process keeps one queue of tasks and sends the next task to a worker as soon
+as the worker returns the previous one, so no worker waits for the slowest file of a
+batch. Files are scheduled from the largest to the smallest (see order_by_size) to keep
+the largest files from running alone at the end.
+
+With a memory budget, a task is only started while the estimated memory of the running
+tasks stays within the budget (see MemoryEstimator), so large files run with fewer
+files at the same time instead of running out of memory. The peak memory of every task
+is returned to calibrate the estimates.
+
+A worker is restarted after max_tasks tasks or once its peak memory exceeds max_memory
+to release the memory that is not returned to the system. A worker that dies (e.g.
+killed when out of memory) only fails its current task.
+"""
+
+import os
+import sys
+import multiprocessing
+from multiprocessing.connection import wait
+import numpy as np
+import pandas as pd
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows, where workers are only restarted by max_tasks
+    resource = None
+
+
+# the estimate of a file is DEFAULT_MEMORY_BASE + DEFAULT_MEMORY_RATIO * file size until
+# MIN_CALIBRATION_FILES files of the format are observed
+DEFAULT_MEMORY_BASE = 500 * 1024**2
+DEFAULT_MEMORY_RATIO = 4.0
+MIN_CALIBRATION_FILES = 5
+
+
+def order_by_size(files):
+    """
+    Order files from the largest to the smallest.
+
+    Parameters
+    ----------
+    files: list
+        Paths to the files. Files that are not found are placed at the end.
+
+    Returns
+    -------
+    order: list
+        Indexes of the files in the order to be processed.
+    """
+
+    sizes = [os.path.getsize(f) if f is not None and os.path.isfile(f) else -1 for f in files]
+    return sorted(range(len(files)), key=lambda i: -sizes[i])
+
+
+def peak_rss():
+    """
+    Peak resident memory of the current process in bytes since the start or the last
+    reset_peak_rss, None if not available.
+    """
+
+    # VmHWM on Linux can be reset between tasks, unlike ru_maxrss
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux and bytes on macOS
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+def reset_peak_rss():
+    """
+    Reset the peak resident memory to the current one (Linux only), so peak_rss gives the
+    peak of the next task instead of the peak of the process.
+    """
+
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def total_memory():
+    """
+    Total physical memory in bytes, None if not available.
+    """
+
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def get_memory_budget(budget_gb=0.0, ratio=0.8):
+    """
+    The memory budget of parallel file processing.
+
+    Parameters
+    ----------
+    budget_gb: float
+        The budget in GB. If 0, a ratio of the total physical memory is used.
+    ratio: float
+        The ratio of the total physical memory used if budget_gb is 0.
+
+    Returns
+    -------
+    budget: float
+        The budget in bytes, 0 for no limit (total memory not available).
+    """
+
+    if budget_gb:
+        return budget_gb * 1024**3
+    total = total_memory()
+    return 0 if total is None else ratio * total
+
+
+class MemoryEstimator:
+    """
+    Estimate the peak memory of processing a file as base + ratio * file size for each file
+    format. The model is fitted to the peak memory of the files observed in previous runs
+    (a csv file with the columns file_name, file_size and peak_memory), and the base is
+    raised so that no observed file is underestimated.
+    """
+
+    def __init__(self, path=None):
+        """
+        Parameters
+        ----------
+        path: str
+            Path to the csv file of the observed files. If None, the defaults are used
+            and nothing is saved.
+        """
+
+        self.path = path
+        self.records = []           # [[file_name, file_size, peak_memory], ...]
+        self.models = {}            # {file extension: (base, ratio)}
+
+        if path is not None and os.path.exists(path):
+            df = pd.read_csv(path)
+            self.records = df[["file_name", "file_size", "peak_memory"]].values.tolist()
+
+
+    def model(self, ext):
+        """
+        The model of a file format.
+
+        Parameters
+        ----------
+        ext: str
+            The file extension in lower case, e.g. ".mzml".
+
+        Returns
+        -------
+        base, ratio: float
+            The estimated memory in bytes is base + ratio * file size.
+        """
+
+        if ext in self.models:
+            return self.models[ext]
+
+        base, ratio = DEFAULT_MEMORY_BASE, DEFAULT_MEMORY_RATIO
+        records = np.array([r[1:] for r in self.records if _ext(r[0]) == ext], dtype=np.float64).reshape(-1, 2)
+        if len(records) >= MIN_CALIBRATION_FILES:
+            size, peak = records[:, 0], records[:, 1]
+            ratio = max(np.polyfit(size, peak, 1)[0], 0.0) if np.ptp(size) > 0 else 0.0
+            # no observed file is underestimated
+            base = np.max(peak - ratio * size)
+
+        self.models[ext] = (float(base), float(ratio))
+        return self.models[ext]
+
+
+    def estimate(self, files):
+        """
+        Estimate the peak memory of processing files.
+
+        Parameters
+        ----------
+        files: list
+            Paths to the files.
+
+        Returns
+        -------
+        memory: numpy array
+            The estimated peak memory of each file in bytes.
+        """
+
+        memory = np.zeros(len(files))
+        for i, f in enumerate(files):
+            base, ratio = self.model(_ext(f))
+            memory[i] = base + ratio * (os.path.getsize(f) if os.path.isfile(f) else 0)
+        return memory
+
+
+    def record(self, file_name, peak_memory):
+        """
+        Record the observed peak memory of a file. Call save to write the records.
+
+        Parameters
+        ----------
+        file_name: str
+            Path to the file.
+        peak_memory: int
+            The peak memory in bytes.
+        """
+
+        if peak_memory is None or not os.path.isfile(file_name):
+            return
+        name = os.path.basename(file_name)
+        # the latest observation of a file replaces the previous ones
+        self.records = [r for r in self.records if r[0] != name]
+        self.records.append([name, os.path.getsize(file_name), int(peak_memory)])
+        self.models.pop(_ext(file_name), None)
+
+
+    def save(self):
+        """
+        Write the records to the csv file.
+        """
+
+        if self.path is None:
+            return
+        df = pd.DataFrame(self.records, columns=["file_name", "file_size", "peak_memory"])
+        df.to_csv(self.path, index=False)
+
+
+def report_peak_memory(peaks):
+    """
+    Print the median and the maximum peak memory of the processed files.
+
+    Parameters
+    ----------
+    peaks: dict
+        {file name: peak memory in bytes or None}
+    """
+
+    peaks = {k: v for k, v in peaks.items() if v is not None}
+    if len(peaks) == 0:
+        return
+    name = max(peaks, key=peaks.get)
+    print("\tPeak memory per file: median {:.0f} MB, max {:.0f} MB ({}).".format(
+        np.median(list(peaks.values())) / 1024**2, peaks[name] / 1024**2, name))
+
+
+def run_tasks(func, tasks, n_workers, max_tasks=0, max_memory=0, memory=None, memory_budget=0):
+    """
+    Run tasks with a pool of long-lived worker processes.
+
+    Parameters
+    ----------
+    func: function
+        A function defined at the top level of a module.
+    tasks: list
+        A list of (args, kwargs) of func, in the order to be started.
+    n_workers: int
+        Number of worker processes.
+    max_tasks: int
+        A worker is restarted after this many tasks, 0 for never.
+    max_memory: float
+        A worker is restarted after a task once its peak memory exceeds this value in
+        bytes, 0 for no limit.
+    memory: list
+        The estimated peak memory of each task in bytes.
+    memory_budget: float
+        Tasks are started only while the estimated memory of the running tasks is within
+        this value in bytes, 0 for no limit. A task larger than the budget runs alone.
+
+    Yields
+    ------
+    i: int
+        Index of the finished task.
+    result: object
+        The result of func, None if the task failed.
+    peak: int
+        The peak memory of the task in bytes, None if not available.
+    """
+
+    if len(tasks) == 0:
+        return
+
+    n_workers = max(1, min(n_workers, len(tasks)))
+    workers = {}                # {connection: [process, index of the running task or None, whether stopped]}
+    pending = list(range(len(tasks)))
+    n_finished = 0
+
+    def start_worker():
+        conn, child_conn = multiprocessing.Pipe()
+        p = multiprocessing.Process(target=_worker, args=(func, child_conn, max_tasks, max_memory), daemon=True)
+        p.start()
+        child_conn.close()
+        workers[conn] = [p, None, False]
+
+    def next_task():
+        # position of the first pending task that fits in the memory budget, any task if nothing is running
+        if len(pending) == 0:
+            return None
+        if memory is None or not memory_budget:
+            return 0
+        used = [memory[w[1]] for w in workers.values() if w[1] is not None]
+        for k, i in enumerate(pending):
+            if len(used) == 0 or sum(used) + memory[i] <= memory_budget:
+                return k
+        return None
+
+    def dispatch():
+        # send tasks to the idle workers, and stop them if no task is left
+        for conn, w in workers.items():
+            if w[1] is not None or w[2]:
+                continue
+            k = next_task()
+            try:
+                if k is not None:
+                    w[1] = pending.pop(k)
+                    conn.send(tasks[w[1]])
+                elif len(pending) == 0:
+                    w[2] = True
+                    conn.send(None)
+                else:
+                    break
+            except OSError:
+                # the worker died, which is handled when its connection is closed
+                pass
+
+    def remove_worker(conn):
+        p = workers.pop(conn)[0]
+        conn.close()
+        p.join()
+        if len(pending) > 0:
+            start_worker()
+
+    try:
+        for _ in range(n_workers):
+            start_worker()
+        dispatch()
+
+        while n_finished < len(tasks):
+            for conn in wait(list(workers)):
+                p, i, _ = workers[conn]
+                try:
+                    kind, value, peak, restart = conn.recv()
+                except (EOFError, OSError):
+                    # the worker died (e.g. killed when out of memory), only its task fails
+                    remove_worker(conn)
+                    dispatch()
+                    if i is not None:
+                        n_finished += 1
+                        print("\tWorker of task {} exited unexpectedly (exit code {}).".format(i, p.exitcode))
+                        yield i, None, None
+                    continue
+
+                n_finished += 1
+                workers[conn][1] = None
+                if restart:
+                    remove_worker(conn)
+                dispatch()
+
+                if kind == "error":
+                    print("\tError occurred in task {}: {}".format(i, value))
+                    value = None
+                yield i, value, peak
+
+    finally:
+        for conn, w in workers.items():
+            try:
+                conn.send(None)
+            except OSError:
+                pass
+        for conn, w in workers.items():
+            w[0].join(timeout=5)
+            if w[0].is_alive():
+                w[0].terminate()
+            conn.close()
+
+
+def _worker(func, conn, max_tasks, max_memory):
+    # run the tasks from the main process until it stops the worker or the worker should be restarted
+    n = 0
+    parent = os.getppid()
+    while True:
+        if not conn.poll(5.0):
+            # stop if the main process was killed
+            if os.getppid() != parent:
+                break
+            continue
+        try:
+            task = conn.recv()
+        except EOFError:
+            break
+        if task is None:
+            break
+
+        args, kwargs = task
+        reset_peak_rss()
+        try:
+            message = ("done", func(*args, **kwargs))
+        except Exception as e:
+            message = ("error", "{}: {}".format(type(e).__name__, e))
+        peak = peak_rss()
+        n += 1
+        restart = bool(max_tasks and n >= max_tasks) or bool(max_memory and (peak or 0) > max_memory)
+        conn.send(message + (peak, restart))
+        if restart:
+            break
+
+
+def _ext(file_name):
+    # file extension in lower case
+    return os.path.splitext(str(file_name))[1].lower()
@@ -0,0 +1,238 @@
+# Author: Huaxu Yu
+
+# A module to skip the stages of the untargeted metabolomics workflow whose inputs are unchanged
+
+"""
+Each stage of the workflow (detection of every file, alignment, annotation, grouping,
+normalization and statistics) is recorded in project_files/stage_cache.json with a key,
+the BLAKE2b hash of
+1. the content of its input files,
+2. the values of the parameters in STAGE_PARAMS that change its results,
+3. extra inputs such as the sample table or the keys of upstream stages.
+
+A stage is skipped only if its key is unchanged and its outputs still exist with the
+recorded content. Parameters that only change the speed (e.g. roi_engine, use_numba) are
+not part of the keys. Hashes of files are reused while their size and mtime are unchanged.
+"""
+
+import os
+import json
+import hashlib
+import numpy as np
+
+from .mzh5 import file_hash
+
+
+STAGE_CACHE_VERSION = 1
+STAGE_CACHE_FILE = "stage_cache.json"
+
+# parameters that change the results of each stage
+STAGE_PARAMS = {
+    "detection": (
+        "ion_mode", "ms_type", "mz_lower_limit", "mz_upper_limit", "rt_lower_limit", "rt_upper_limit",
+        "scan_levels", "centroid_mz_tol", "ms1_abs_int_tol", "ms2_abs_int_tol", "ms2_rel_int_tol",
+        "precursor_mz_offset", "mz_tol_ms1", "mz_tol_ms2", "feature_gap_tol", "roi_min_length",
+        "roi_min_height", "predict_peak_quality",
+    ),
+    "alignment": (
+        "mz_tol_alignment", "rt_tol_alignment", "noise_tol", "gaussian_similarity_tol", "rt_tol_rt_correction",
+        "correct_rt", "scan_number_cutoff", "detection_rate_cutoff", "merge_features", "mz_tol_merge_features",
+        "rt_tol_merge_features", "fill_gaps", "gap_filling_method", "gap_filling_rt_window", "ms1_abs_int_tol",
+        "quant_method",
+    ),
+    "annotation": (
+        "fuzzy_search", "consider_rt", "rt_tol_annotation", "ms2_sim_tol", "spectral_similarity_method",
+        "ion_mode", "mz_tol_ms1", "mz_tol_ms2", "precursor_mz_offset", "mz_tol_alignment", "rt_tol_alignment",
+    ),
+    "grouping": (
+        "group_features_after_alignment", "mz_tol_feature_grouping", "rt_tol_feature_grouping",
+        "scan_scan_cor_tol", "isotope_rel_int_limit", "ion_mode", "correct_rt", "quant_method",
+    ),
+    "normalization": (
+        "signal_normalization", "signal_norm_method", "sample_normalization", "sample_norm_method",
+        "plot_normalization",
+    ),
+    "stats": (
+        "run_statistics",
+    ),
+}
+
+
+class StageCache:
+    """
+    A record of the keys and outputs of the workflow stages of a project.
+    """
+
+    def __init__(self, project_file_dir):
+        """
+        Load the record of a project, an empty record if not found or written by another version.
+
+        Parameters
+        ----------
+        project_file_dir: str
+            The directory of the project files.
+        """
+
+        self.path = os.path.join(project_file_dir, STAGE_CACHE_FILE)
+        self.stages = {}            # {stage: {name: {"key": key, "outputs": {path: hash}}}}
+        self.files = {}             # {absolute path: [size, mtime_ns, hash]}
+
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, "r") as f:
+                    data = json.load(f)
+            except (OSError, ValueError):
+                data = {}
+            if data.get("version") == STAGE_CACHE_VERSION:
+                self.stages = data.get("stages", {})
+                self.files = data.get("files", {})
+
+
+    def file_hash(self, file_name):
+        """
+        Content hash of a file, reused while its size and mtime are unchanged.
+
+        Parameters
+        ----------
+        file_name: str
+            Path to the file.
+
+        Returns
+        -------
+        str
+            Hex digest of the file content.
+        """
+
+        path = os.path.abspath(file_name)
+        st = os.stat(path)
+        memo = self.files.get(path)
+        if memo is not None and memo[0] == st.st_size and memo[1] == st.st_mtime_ns:
+            return memo[2]
+        h = file_hash(path)
+        self.files[path] = [st.st_size, st.st_mtime_ns, h]
+        return h
+
+
+    def key(self, stage, params, files=(), extra=None):
+        """
+        Compute the key of a stage.
+
+        Parameters
+        ----------
+        stage: str
+            The stage, one of STAGE_PARAMS.
+        params: Params object
+            The parameters of the workflow.
+        files: list
+            Paths to the input files. Files are identified by name and content, so the
+            keys do not change if the project is moved.
+        extra: object
+            Other inputs that can be serialized to JSON, e.g. keys of upstream stages.
+
+        Returns
+        -------
+        str
+            The key of the stage.
+        """
+
+        content = {
+            "stage": stage,
+            "params": {k: _normalize(getattr(params, k, None)) for k in STAGE_PARAMS[stage]},
+            "files": [[os.path.basename(f), self.file_hash(f)] for f in files],
+            "extra": extra,
+        }
+        text = json.dumps(content, sort_keys=True, default=str)
+        return hashlib.blake2b(text.encode(), digest_size=20).hexdigest()
+
+
+    def is_current(self, stage, key, name="project"):
+        """
+        Check if a stage was run with the same key and its outputs are unchanged.
+
+        Parameters
+        ----------
+        stage: str
+            The stage.
+        key: str
+            The current key of the stage.
+        name: str
+            The item of the stage, e.g. the sample name for detection.
+
+        Returns
+        -------
+        bool
+            True if the stage can be skipped.
+        """
+
+        entry = self.stages.get(stage, {}).get(name)
+        if entry is None or entry["key"] != key:
+            return False
+        for path, h in entry["outputs"].items():
+            if not os.path.isfile(path) or self.file_hash(path) != h:
+                return False
+        return True
+
+
+    def record(self, stage, key, outputs, name="project"):
+        """
+        Record a completed stage. Call save to write the record.
+
+        Parameters
+        ----------
+        stage: str
+            The stage.
+        key: str
+            The key of the stage.
+        outputs: list
+            Paths to the output files of the stage.
+        name: str
+            The item of the stage, e.g. the sample name for detection.
+        """
+
+        outputs = {os.path.abspath(p): self.file_hash(p) for p in outputs}
+        self.stages.setdefault(stage, {})[name] = {"key": key, "outputs": outputs}
+
+
+    def save(self):
+        """
+        Write the record. The file is replaced at once, so an interrupted run keeps the last record.
+        """
+
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"version": STAGE_CACHE_VERSION, "stages": self.stages, "files": self.files}, f)
+        os.replace(tmp_path, self.path)
+
+
+def sample_table_hash(sample_metadata):
+    """
+    Hash of the sample metadata without the paths of the raw files.
+
+    Parameters
+    ----------
+    sample_metadata: pandas DataFrame
+        The sample metadata of Params.
+
+    Returns
+    -------
+    str
+        Hex digest of the sample metadata.
+    """
+
+    if sample_metadata is None:
+        return None
+    df = sample_metadata.drop(columns=["ABSOLUTE_PATH"], errors="ignore")
+    return hashlib.blake2b(df.to_csv(index=False).encode(), digest_size=20).hexdigest()
+
+
+def _normalize(value):
+    # parameters read from parameters.csv are floats, so numbers are compared as floats
+    if value is None or isinstance(value, (bool, str)):
+        return value
+    if isinstance(value, np.bool_):
+        return bool(value)
+    if isinstance(value, (int, float, np.number)):
+        return float(value)
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return [_normalize(v) for v in value]
+    return str(value)
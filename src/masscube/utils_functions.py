@@ -12,6 +12,8 @@ from collections import Counter, defaultdict
 from dataclasses import dataclass
 from IsoSpecPy import IsoTotalProb
 
+from .kernels import is_enabled, centroid_sorted
+
 
 ####################################################################################################
 # Sample management functions
@@ -457,7 +459,7 @@ def convert_signals_to_string(signals):
     return string
 
 
-def centroid_signals(signals, mz_tol=0.005):
+def centroid_signals(signals, mz_tol=0.005, use_numba=False):
     """
     Function to centroid signals in a mass spectrum.
 
@@ -467,6 +469,8 @@ def centroid_signals(signals, mz_tol=0.005):
         MS signals for a scan as 2D numpy array in float32, organized as [[m/z, intensity], ...].
     mz_tol: float
         m/z tolerance for centroiding. Default is 0.005 Da.
+    use_numba: bool
+        Whether to use the numba kernel if numba is installed, the results are the same.
 
     Returns
     -------
@@ -482,6 +486,11 @@ def centroid_signals(signals, mz_tol=0.005):
     mz = signals[:, 0]
     intensity = signals[:, 1]
 
+    if is_enabled(use_numba):
+        # the tolerance is compared in the dtype of the signals as with np.diff below
+        weighted_mz, sum_intensity = centroid_sorted(mz, intensity, mz.dtype.type(mz_tol))
+        return np.column_stack((weighted_mz, sum_intensity)).astype(np.float32)
+
     diff = np.diff(mz)
     group_starts = np.where(diff >= mz_tol)[0] + 1
     group_boundaries = np.r_[0, group_starts, len(signals)]
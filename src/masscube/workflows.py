@@ -5,7 +5,6 @@
 # Import modules
 import os
 import multiprocessing
-from joblib import Parallel, delayed
 from tqdm import tqdm
 import pickle
 from copy import deepcopy
@@ -13,16 +12,24 @@ import pandas as pd
 import numpy as np
 from importlib.metadata import version
 import time
+import socket
+import argparse
+import threading
 
-from .raw_data_utils import read_raw_file_to_obj
+from .raw_data_utils import read_raw_file_to_obj, MSData
+from .mzh5 import find_mzh5_cache, file_hash
 from .params import Params, find_ms_info
 from .feature_grouping import group_features_after_alignment, group_features_single_file
-from .alignment import feature_alignment, output_feature_table, convert_features_to_df, output_feature_to_msp
+from .alignment import feature_alignment, output_feature_table, convert_features_to_df, output_feature_to_msp, select_valid_single_files
 from .annotation import annotate_aligned_features, annotate_features, feature_annotation_mzrt
 from .normalization import sample_normalization, signal_normalization
 from .visualization import plot_ms2_matching_from_feature_table
 from .stats import full_statistical_analysis
 from .utils_functions import convert_signals_to_string
+from .stage_cache import StageCache, sample_table_hash
+from .scheduler import run_tasks, order_by_size, MemoryEstimator, get_memory_budget, report_peak_memory, peak_rss, reset_peak_rss
+from .job_queue import JobQueue, JOB_QUEUE_FILE, JOB_PARAMS_FILE
+from .profiling import StageProfiler, report_stage_profile
 
 
 # 1. Untargeted feature detection for a single file
@@ -31,7 +38,11 @@ def process_single_file(file_name: str, params: Params = None, segment_feature:
                         annotate_ms2: bool = False, ms2_library_path: str = None, 
                         output_dir: str = None, return_data: bool = True):
     """
-    Untargeted data processing for a single file (mzML, mzXML, mzjson or compressed mzjson).
+    Untargeted data processing for a single file (mzML, mzXML, mzh5, mzjson or compressed mzjson).
+    If a mzh5 cache of the raw file converted with the same preprocessing parameters is found 
+    in the tmp directory or next to the raw file, it is loaded instead of parsing the raw file.
+    With params.streaming_detection, mzML files are read and traced in one pass without keeping 
+    the MS1 scans (see MSData.stream_features).
 
     Parameters
     ----------
@@ -62,25 +73,44 @@ def process_single_file(file_name: str, params: Params = None, segment_feature:
     """
 
     step = "INIT"
+    # time, memory and item counts of the stages (see profiling.py)
+    profiler = StageProfiler(os.path.splitext(os.path.basename(file_name))[0])
 
     try:
         # STEP 1. data reading, parsing, and parameter preparation
         step = "STEP 1: data reading and parameter preparation"
+        profiler.start("read")
         if params is None:
             params = Params()
             ms_type, ion_mode, _ = find_ms_info(file_name)
             params.set_default(ms_type, ion_mode)
+        profiler.path = params.profile_path
 
-        d = read_raw_file_to_obj(file_name, params=params)
+        # reuse a valid mzh5 cache (see convert_raw_to_mzh5) to skip parsing the raw file
+        raw_file = find_mzh5_cache(file_name, params)
+
+        # stream mzML files through feature detection without keeping the MS1 scans, 
+        # unless they are needed for feature grouping
+        is_streamed = params.streaming_detection and raw_file.lower().endswith(".mzml") and not group_features
+        if is_streamed:
+            d = MSData()
+            d.stream_features(raw_file, params=params)
+        else:
+            d = read_raw_file_to_obj(raw_file, params=params)
+        # in streaming mode, features are detected while reading
+        profiler.stop(ms1_scans=len(d.ms1_idx_arr), ms2_scans=len(d.ms2_idx_arr), 
+                      features=len(d.features) if is_streamed else None)
 
         # check if the MS1 data is valid (no MS1 data found when intensity tolerance is too high)
         if len(d.ms1_idx_arr) == 0:
             print("No valid MS1 data were found in: " + file_name + ". Please check the file and MS1 intensity tolerance.")
+            profiler.save()
             return d
 
         # check if the file is centroid
         if not d.params.is_centroid:
             print("File: " + file_name + " is not centroid and skipped.")
+            profiler.save()
             return None
         # set ms2 library path
         if ms2_library_path is not None:
@@ -88,17 +118,24 @@ def process_single_file(file_name: str, params: Params = None, segment_feature:
         
         # STEP 2. feature detection and segmentation
         step = "STEP 2: feature detection and segmentation"
-        d.detect_features()
+        if not is_streamed:
+            profiler.start("detect")
+            d.detect_features()
+            profiler.stop(rois=len(d.features) + d.pruned_roi_number, features=len(d.features))
 
         if segment_feature:
+            profiler.start("segment")
             d.segment_features()
+            profiler.stop(features=len(d.features))
 
         # STEP 3. feature evaluation
         step = "STEP 3: feature evaluation"
+        profiler.start("summarize")
         if evaluate_peak_shape:
             d.summarize_features(cal_g_score=True, cal_a_score=True)
         else:
             d.summarize_features(cal_g_score=False, cal_a_score=False)
+        profiler.stop(features=len(d.features))
 
         # STEP 4. MS2 annotation
         step = "STEP 4: MS2 annotation"
@@ -106,15 +143,20 @@ def process_single_file(file_name: str, params: Params = None, segment_feature:
             if ms2_library_path is None:
                 ms2_library_path = d.params.ms2_library_path
             if ms2_library_path is not None:
+                profiler.start("annotate")
                 annotate_features(d=d, sim_tol=d.params.ms2_sim_tol, fuzzy_search=True, ms2_library_path=ms2_library_path)
+                profiler.stop(features=len(d.features), annotated=sum(f.annotation is not None for f in d.features))
 
         # STEP 5. feature grouping
         step = "STEP 5: feature grouping"
         if group_features:
+            profiler.start("group")
             group_features_single_file(d)
+            profiler.stop(features=len(d.features))
 
         # STEP 6. visualization and output
         step = "STEP 6: visualization and output"
+        profiler.start("output")
         if d.params.plot_bpc and d.params.bpc_dir is not None:
             d.plot_bpc(output_dir=os.path.join(d.params.bpc_dir, d.params.file_name + "_bpc.png"))
      
@@ -123,10 +165,18 @@ def process_single_file(file_name: str, params: Params = None, segment_feature:
         
         elif d.params.output_single_file and d.params.single_file_dir is not None:
             d.output_single_file()
+        profiler.stop(features=len(d.features))
             
-        # for faster data reloading
+        # for faster data reloading (not needed if the data were loaded from a mzh5 cache in tmp_file_dir)
         if d.params.tmp_file_dir is not None:
-            d.convert_to_mzpkl()
+            tmp_mzh5 = os.path.join(d.params.tmp_file_dir, d.params.file_name + ".mzh5")
+            if is_streamed:
+                print("\tMS1 scans of " + file_name + " were not kept in streaming mode. Convert it to mzh5 for gap filling.")
+            elif os.path.abspath(d.params.file_path) != os.path.abspath(tmp_mzh5):
+                profiler.start("mzpkl")
+                d.convert_to_mzpkl()
+                profiler.stop(scans=len(d.scans))
+        profiler.save()
 
         if return_data:
             return d
@@ -137,13 +187,62 @@ def process_single_file(file_name: str, params: Params = None, segment_feature:
         print("\tError occurred: " + file_name)
         print(f"\t\tFailed at {step}.")
         print(f"\t\t{type(e).__name__}: {e}")
+        profiler.save()
         return None
 
 # 2. Untargeted metabolomics workflow
+def select_files_to_process(params: Params, cache: StageCache):
+    """
+    Find the samples whose feature detection is not current. Files processed by 
+    distributed workers with the same key (see run_worker) are recorded in the cache first.
+
+    Parameters
+    ----------
+    params : Params object
+        Parameters of the workflow.
+    cache : StageCache object
+        The stage cache of the project.
+
+    Returns
+    -------
+    detection_keys : dict
+        {sample name: key of its detection stage}
+    to_be_processed : list
+        A list of (sample name, path to the raw file).
+    """
+
+    done_jobs = {}
+    queue_path = os.path.join(params.project_file_dir, JOB_QUEUE_FILE)
+    if os.path.exists(queue_path):
+        done_jobs = JobQueue(queue_path).done_jobs()
+
+    detection_keys = {}
+    to_be_processed = []
+    for i in range(len(params.sample_metadata)):
+        name = params.sample_metadata.iloc[i, 0]
+        raw_file = params.sample_metadata.loc[i, 'ABSOLUTE_PATH']
+        if raw_file is None:
+            continue
+        detection_keys[name] = cache.key("detection", params, files=[raw_file])
+        if cache.is_current("detection", detection_keys[name], name=name):
+            continue
+        # the output is accepted only if it is still the one written by the worker
+        output_path = os.path.join(params.single_file_dir, name + ".txt")
+        job = done_jobs.get(name)
+        if job is not None and job[0] == detection_keys[name] and os.path.isfile(output_path) and \
+                cache.file_hash(output_path) == job[1]:
+            cache.record("detection", detection_keys[name], [output_path], name=name)
+            continue
+        to_be_processed.append((name, raw_file))
+
+    return detection_keys, to_be_processed
+
+
 def untargeted_metabolomics_workflow(path: str = None, return_results: bool = False, only_process_single_files: bool = False,
                                      return_params_only: bool = False):
     """
-    The untargeted metabolomics workflow. See the documentation for details.
+    The untargeted metabolomics workflow. See the documentation for details. Stages whose 
+    input files and parameters are unchanged since the last run are skipped (see stage_cache.py).
 
     Parameters
     ----------
@@ -181,6 +280,10 @@ def untargeted_metabolomics_workflow(path: str = None, return_results: bool = Fa
         params.project_dir = os.getcwd()
     
     params._untargeted_metabolomics_workflow_preparation()
+    # time, memory and item counts of the stages of this run (see profiling.py)
+    run_label = time.strftime("%Y%m%d%H%M%S", time.localtime())
+    params.profile_path = os.path.join(params.project_file_dir, "stage_profiles", run_label + ".jsonl")
+    profiler = StageProfiler("project", params.profile_path)
 
     # save the parameters to metadata
     for key, value in params.__dict__.items():
@@ -193,69 +296,92 @@ def untargeted_metabolomics_workflow(path: str = None, return_results: bool = Fa
 
     # STEP 2. Process individual files
     print("Step 2: Processing individual files for feature detection...")
-    processed_files = [f.split(".")[0] for f in os.listdir(params.single_file_dir) if f.lower().endswith(".txt")]
-    to_be_processed = [
-        params.sample_metadata.loc[i, 'ABSOLUTE_PATH']
-        for i in range(len(params.sample_metadata))
-        if params.sample_metadata.iloc[i, 0] not in processed_files
-    ]
+    # a stage is skipped only if its inputs and parameters are unchanged (see stage_cache.py)
+    cache = StageCache(params.project_file_dir)
+    detection_keys, to_be_processed = select_files_to_process(params, cache)
     print(f"\t{len(to_be_processed)} files to process out of {len(params.sample_metadata)} files.")
+
+    # remove the outdated results, so a file that fails is not aligned
+    for name, _ in to_be_processed:
+        output_path = os.path.join(params.single_file_dir, name + ".txt")
+        if os.path.exists(output_path):
+            os.remove(output_path)
     
-    workers = int(multiprocessing.cpu_count() * params.percent_cpu_to_use)
+    workers = max(1, int(multiprocessing.cpu_count() * params.percent_cpu_to_use))
     print("\tA total of {} CPU cores are detected, {} cores are used.".format(multiprocessing.cpu_count(), workers))
 
-    import math
-    import gc
-    n_files = len(to_be_processed)
-    n_batches = math.ceil(n_files / params.batch_size)
-
-    for b in range(n_batches):
-        start = b * params.batch_size
-        end = min(start + params.batch_size, n_files)
-        batch = to_be_processed[start:end]
-
-        print(f"\nProcessing batch {b+1}/{n_batches} ({len(batch)} files)")
-
-        results = Parallel(
-            n_jobs=workers,
-            backend="loky",
-            return_as="generator"
-        )(
-            delayed(process_single_file)(f, params, return_data=False)
-            for f in batch
-        )
-
-        for _ in tqdm(results, total=len(batch), desc=f"Batch {b+1}", unit="file"):
-            pass
-
-        # Clean up memory
-        gc.collect()
-
+    # files are processed from the largest to the smallest by long-lived workers, and only while 
+    # their estimated memory fits in the budget (see scheduler.py)
+    to_be_processed = [to_be_processed[i] for i in order_by_size([f for _, f in to_be_processed])]
+    estimator = MemoryEstimator(os.path.join(params.project_file_dir, "file_memory_usage.csv"))
+    results = run_tasks(process_single_file, [((f, params), {"return_data": False}) for _, f in to_be_processed],
+                        workers, max_tasks=params.max_tasks_per_worker, max_memory=params.max_worker_memory * 1024**3,
+                        memory=estimator.estimate([f for _, f in to_be_processed]), 
+                        memory_budget=get_memory_budget(params.memory_budget))
+
+    peaks = {}
+    for n, (i, _, peak) in enumerate(tqdm(results, total=len(to_be_processed), unit="file"), 1):
+        name, raw_file = to_be_processed[i]
+        peaks[name] = peak
+        output_path = os.path.join(params.single_file_dir, name + ".txt")
+        if os.path.exists(output_path):
+            cache.record("detection", detection_keys[name], [output_path], name=name)
+        estimator.record(raw_file, peak)
+        if n % workers == 0:
+            cache.save()
+
+    cache.save()
+    estimator.save()
+    report_peak_memory(peaks)
     metadata[2]["status"] = "completed"
     print("\tIndividual file processing is completed.")
     print("~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~")
     
     if only_process_single_files:
+        report_stage_profile(params.profile_path)
         return None
     
     # STEP 3. Feature alignment
-    if not os.path.exists(params.project_dir + "/aligned_feature_table.txt"):
+    features = None
+    sample_hash = sample_table_hash(params.sample_metadata)
+    aligned_names = [n for n in detection_keys if os.path.exists(os.path.join(params.single_file_dir, n + ".txt"))]
+    alignment_key = cache.key("alignment", params, files=[os.path.join(params.single_file_dir, n + ".txt") for n in aligned_names],
+                              extra={"samples": sample_hash, "detection": [detection_keys[n] for n in aligned_names]})
+    aligned_pkl = os.path.join(params.project_file_dir, "aligned_features_before_annotation.pkl")
+    if cache.is_current("alignment", alignment_key):
+        print("Step 3: Feature alignment is skipped. The single files and parameters are unchanged.")
+        select_valid_single_files(params.single_file_dir, params)
+    else:
         print("Step 3: Aligning features...")
-        features = feature_alignment(params.single_file_dir, params)
-        metadata[3]["status"] = "completed"
+        features = feature_alignment(params.single_file_dir, params, profiler=profiler)
         print("\tFeature alignment is completed.")
-        print("~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~")
 
         feature_table = convert_features_to_df(features=features, sample_names=params.sample_metadata.iloc[:,0], quant_method=params.quant_method)
         # output feature table to a txt file
         output_path = os.path.join(params.project_file_dir, "aligned_feature_table_before_annotation.txt")
         output_feature_table(feature_table, output_path)
         # output features as pickle file to the project directory
-        with open(os.path.join(params.project_file_dir, "aligned_features.pkl"), "wb") as f:
+        with open(aligned_pkl, "wb") as f:
             pickle.dump(features, f)
+        cache.record("alignment", alignment_key, [output_path, aligned_pkl])
+        cache.save()
+    metadata[3]["status"] = "completed"
+    print("~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~")
         
     # STEP 4. Feature annotation
+    mzrt_path = os.path.join(params.project_dir, "mzrt_list.csv")
+    annotation_files = [aligned_pkl] + [p for p in (params.ms2_library_path, mzrt_path) if p is not None and os.path.isfile(p)]
+    annotation_key = cache.key("annotation", params, files=annotation_files)
+    annotated_pkl = os.path.join(params.project_file_dir, "aligned_features_before_grouping.pkl")
+    if cache.is_current("annotation", annotation_key):
+        print("Step 4: Feature annotation is skipped. The aligned features, libraries and parameters are unchanged.")
+        features = None
+    else:
         print("Step 4: Annotating features...")
+        profiler.start("annotation")
+        if features is None:
+            with open(aligned_pkl, "rb") as f:
+                features = pickle.load(f)
         # annotation (using MS2 library)
         print("\tAnnotating features using the MS2 library...")
         if params.ms2_library_path is not None and os.path.exists(params.ms2_library_path):
@@ -264,67 +390,106 @@ def untargeted_metabolomics_workflow(path: str = None, return_results: bool = Fa
         else:
             print("\tNo MS2 library is found. MS2 annotation is skipped.")
         # annotation (using mzrt list)
-        if os.path.exists(os.path.join(params.project_dir, "mzrt_list.csv")):
+        if os.path.exists(mzrt_path):
             print("\tAnnotating features using the extra mzrt list...")
-            features = feature_annotation_mzrt(features, os.path.join(params.project_dir, "mzrt_list.csv"), params.mz_tol_alignment, params.rt_tol_alignment)
+            features = feature_annotation_mzrt(features, mzrt_path, params.mz_tol_alignment, params.rt_tol_alignment)
             print("\tmz/rt annotation is completed.")
-        # annotate feature groups
+        with open(annotated_pkl, "wb") as f:
+            pickle.dump(features, f)
+        profiler.stop(features=len(features), annotated=sum(f.annotation is not None for f in features))
+        cache.record("annotation", annotation_key, [annotated_pkl])
+        cache.save()
+
+    # annotate feature groups
+    grouping_key = cache.key("grouping", params, files=[annotated_pkl])
+    table_path = os.path.join(params.project_dir, "aligned_feature_table.txt")
+    msp_path = os.path.join(params.project_file_dir, "features.msp")
+    features_pkl = os.path.join(params.project_file_dir, "aligned_features.pkl")
+    if cache.is_current("grouping", grouping_key):
+        print("\tFeature grouping is skipped. Using the existing aligned feature table.")
+        features = None
+        feature_table = pd.read_csv(table_path, sep="\t", low_memory=False)
+    else:
         print("\tAnnotating feature groups...")
+        profiler.start("grouping")
+        if features is None:
+            with open(annotated_pkl, "rb") as f:
+                features = pickle.load(f)
         if params.group_features_after_alignment:
             group_features_after_alignment(features, params)
         for f in features:
             f.isotope_signals = convert_signals_to_string(f.isotope_signals)
         print("\tFeature grouping is completed.")
-        metadata[4]["status"] = "completed"
 
         feature_table = convert_features_to_df(features=features, sample_names=params.sample_metadata.iloc[:,0], quant_method=params.quant_method)
         # output feature table to a txt file
-        output_path = os.path.join(params.project_dir, "aligned_feature_table.txt")
-        output_feature_table(feature_table, output_path)
+        output_feature_table(feature_table, table_path)
         # output the acquired MS2 spectra to a MSP file (designed for MassWiki)
-        output_path = os.path.join(params.project_file_dir, "features.msp")
-        output_feature_to_msp(feature_table, output_path)
+        output_feature_to_msp(feature_table, msp_path)
         # output features as pickle file to the project directory
-        with open(os.path.join(params.project_file_dir, "aligned_features.pkl"), "wb") as f:
+        with open(features_pkl, "wb") as f:
             pickle.dump(features, f)
+        profiler.stop(features=len(features))
+        cache.record("grouping", grouping_key, [table_path, msp_path, features_pkl])
+        cache.save()
+    metadata[4]["status"] = "completed"
+    print("~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~")
+
+    normalized_path = os.path.join(params.project_dir, "normalized_feature_table.txt")
+    is_normalized = params.sample_normalization or params.signal_normalization
+    normalization_key = cache.key("normalization", params, files=[table_path], extra={"samples": sample_hash})
+    if is_normalized and cache.is_current("normalization", normalization_key):
+        print("Step 5 and 6: Normalization is skipped. The aligned feature table and parameters are unchanged.")
+        feature_table = pd.read_csv(normalized_path, sep="\t", low_memory=False)
+        metadata[5]["status"] = "completed" if params.signal_normalization else "skipped"
+        metadata[6]["status"] = "completed" if params.sample_normalization else "skipped"
         print("~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~")
     else:
-        print("Step 3: Feature alignment is skipped. Using the existing aligned feature table.")
-        print("Step 4: Feature annotation is skipped. Using the existing aligned feature table.")
-        feature_table = pd.read_csv(params.project_dir + "/aligned_feature_table.txt", sep="\t", low_memory=False)
-
-    # STEP 5. signal normalization
-    if params.signal_normalization:
-        print("Step 5: Running signal normalization...")
-        if params.plot_normalization:
-            feature_table = signal_normalization(feature_table, params.sample_metadata, params.signal_norm_method, output_plot_path=params.normalization_dir)
+        # STEP 5. signal normalization
+        if params.signal_normalization:
+            print("Step 5: Running signal normalization...")
+            profiler.start("signal_normalization")
+            if params.plot_normalization:
+                feature_table = signal_normalization(feature_table, params.sample_metadata, params.signal_norm_method, output_plot_path=params.normalization_dir)
+            else:
+                feature_table = signal_normalization(feature_table, params.sample_metadata, params.signal_norm_method)
+            profiler.stop(features=len(feature_table))
+            metadata[5]["status"] = "completed"
+            print("\tMS signal drift normalization is completed.")
         else:
-            feature_table = signal_normalization(feature_table, params.sample_metadata, params.signal_norm_method)
-        metadata[5]["status"] = "completed"
-        print("\tMS signal drift normalization is completed.")
-    else:
-        metadata[5]["status"] = "skipped"
-        print("Step 5: MS signal drift normalization is skipped.")
-    print("~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~")
+            metadata[5]["status"] = "skipped"
+            print("Step 5: MS signal drift normalization is skipped.")
+        print("~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~")
 
-    # STEP 6. sample normalization
-    if params.sample_normalization:
-        print("Step 6: Running sample normalization...")
-        feature_table = sample_normalization(feature_table, params.sample_metadata, params.sample_norm_method)
-        metadata[6]["status"] = "completed"
-        print("\tSample Normalization is completed.")
-    else:
-        metadata[6]["status"] = "skipped"
-        print("Step 6: Sample normalization is skipped.")
-    
-    if params.sample_normalization or params.signal_normalization:
-        output_path = os.path.join(params.project_dir, "normalized_feature_table.txt")
-        output_feature_table(feature_table, output_path)
+        # STEP 6. sample normalization
+        if params.sample_normalization:
+            print("Step 6: Running sample normalization...")
+            profiler.start("sample_normalization")
+            feature_table = sample_normalization(feature_table, params.sample_metadata, params.sample_norm_method)
+            profiler.stop(features=len(feature_table))
+            metadata[6]["status"] = "completed"
+            print("\tSample Normalization is completed.")
+        else:
+            metadata[6]["status"] = "skipped"
+            print("Step 6: Sample normalization is skipped.")
+        
+        if is_normalized:
+            output_feature_table(feature_table, normalized_path)
+            cache.record("normalization", normalization_key, [normalized_path])
+            cache.save()
 
     # STEP 7. statistical analysis
-    if params.run_statistics:
+    stats_key = cache.key("stats", params, files=[normalized_path if is_normalized else table_path], extra={"samples": sample_hash})
+    if params.run_statistics and cache.is_current("stats", stats_key):
+        metadata[7]["status"] = "completed"
+        print("Step 7: Statistical analysis is skipped. The feature table and parameters are unchanged.")
+    elif params.run_statistics:
         print("Step 7: Running statistical analysis...")
+        profiler.start("stats")
         feature_table = full_statistical_analysis(feature_table, params)
+        profiler.stop(features=len(feature_table))
+        cache.record("stats", stats_key, [e.path for e in os.scandir(params.statistics_dir) if e.is_file()])
+        cache.save()
         metadata[7]["status"] = "completed"
         print("\tStatistical analysis is completed.")
     else:
@@ -334,6 +499,8 @@ def untargeted_metabolomics_workflow(path: str = None, return_results: bool = Fa
     
     # STEP 8. output and visualization
     metadata[0]['end_time'] = time.strftime("%Y-%m-%d %H:%M:%S %Z", time.localtime())
+    profiler.save()
+    report_stage_profile(params.profile_path)
     time_label = time.strftime("%Y%m%d%H%M%S", time.localtime())
     metadata_file_name = "data_processing_metadata_" + time_label + ".pkl"
     with open(os.path.join(params.project_file_dir, metadata_file_name), "wb") as f:
@@ -350,6 +517,9 @@ def untargeted_metabolomics_workflow(path: str = None, return_results: bool = Fa
     print("The workflow is completed.")
 
     if return_results:
+        if features is None:
+            with open(features_pkl, "rb") as f:
+                features = pickle.load(f)
         return features, params
 
 
@@ -409,7 +579,8 @@ def run_evaluation(path=None):
 
 # 4. Batch file processing
 def batch_file_processing(path=None, segment_feature=True, group_features=False, evaluate_peak_shape=True,
-                          annotate_ms2=True, ms2_library_path=None, cpu_ratio=0.8, batch_size=100):
+                          annotate_ms2=True, ms2_library_path=None, cpu_ratio=0.8, batch_size=None, memory_budget=0.0,
+                          max_tasks_per_worker=100):
     """
     Process single files using default parameters.
 
@@ -430,8 +601,17 @@ def batch_file_processing(path=None, segment_feature=True, group_features=False,
     cpu_ratio : float
         The percentage of CPU cores to use. Default is 0.8.
     batch_size : int
-        The number of files to process in each batch. Default is 100.
+        Deprecated and ignored, as files are no longer processed in batches. Use max_tasks_per_worker.
+    memory_budget : float
+        Files are processed at the same time only while their estimated memory fits in this value 
+        in GB. Default is 0 (80% of the physical memory).
+    max_tasks_per_worker : int
+        The number of files a worker processes before it is restarted to release memory. Default is 100.
     """
+
+    if batch_size is not None:
+        print("batch_size is deprecated and ignored, as files are no longer processed in batches. "
+              "Use max_tasks_per_worker to restart the workers after a number of files.")
    
     if path is None:
         path = os.getcwd()
@@ -446,18 +626,216 @@ def batch_file_processing(path=None, segment_feature=True, group_features=False,
 
     print("{} files to process out of {} files.".format(len(to_be_processed), len(all_files)))
 
-    workers = int(multiprocessing.cpu_count() * cpu_ratio)
+    workers = max(1, int(multiprocessing.cpu_count() * cpu_ratio))
     print("A total of {} CPU cores are detected, {} cores are used.".format(multiprocessing.cpu_count(), workers))
-    for i in range(0, len(to_be_processed), batch_size):
-        if len(to_be_processed) - i < batch_size:
-            print("\tProcessing files from " + str(i) + " to " + str(len(to_be_processed)))
+
+    # files are processed from the largest to the smallest by long-lived workers, and only while 
+    # their estimated memory fits in the budget (see scheduler.py)
+    to_be_processed = [to_be_processed[i] for i in order_by_size(to_be_processed)]
+    estimator = MemoryEstimator(os.path.join(path, "file_memory_usage.csv"))
+    tasks = [((f, None, segment_feature, group_features, evaluate_peak_shape, annotate_ms2, ms2_library_path, single_file_dir), 
+              {"return_data": False}) for f in to_be_processed]
+    results = run_tasks(process_single_file, tasks, workers, max_tasks=max_tasks_per_worker, memory=estimator.estimate(to_be_processed),
+                        memory_budget=get_memory_budget(memory_budget))
+    peaks = {}
+    for i, _, peak in tqdm(results, total=len(tasks), unit="file"):
+        peaks[os.path.basename(to_be_processed[i])] = peak
+        estimator.record(to_be_processed[i], peak)
+    estimator.save()
+    report_peak_memory(peaks)
+
+
+def enqueue_single_files(path: str = None):
+    """
+    Add the files of a project whose feature detection is not current to the job queue
+    of the project (project_files/job_queue.sqlite), to be processed by run_worker on any
+    computer that shares the project directory. Run the workflow after the workers are 
+    done to use their results, and to process the files that failed.
+
+    Parameters
+    ----------
+    path : str
+        The project directory. If None, the current working directory is used.
+
+    Returns
+    -------
+    n : int
+        Number of jobs added.
+    """
+
+    params = _prepare_project_params(path)
+    cache = StageCache(params.project_file_dir)
+    detection_keys, to_be_processed = select_files_to_process(params, cache)
+    cache.save()
+
+    jobs = []
+    for name, raw_file in to_be_processed:
+        # relative to the project directory, which can be mounted at different paths on the workers
+        rel_path = os.path.relpath(raw_file, params.project_dir)
+        file_name = raw_file if rel_path.startswith("..") else rel_path
+        jobs.append((name, file_name, os.path.getsize(raw_file), detection_keys[name]))
+
+    # the workers load the prepared parameters instead of preparing the project again
+    _save_worker_params(params)
+    queue = JobQueue(os.path.join(params.project_file_dir, JOB_QUEUE_FILE))
+    n = queue.add(jobs)
+    print("{} jobs are added. Jobs in the queue: {}.".format(n, _format_counts(queue.counts())))
+    return n
+
+
+def run_worker(path: str = None, lease_time: float = 300.0, poll_interval: float = 10.0, max_jobs: int = 0):
+    """
+    Process the jobs in the job queue of a project (see enqueue_single_files) until no job 
+    is pending or running. Any number of workers can run on the computers that share the 
+    project directory. The lease of a job is renewed while it is running, and the job is 
+    queued again if the worker stops without finishing it. Workers use the parameters saved
+    by enqueue_single_files, so enqueue again after changing parameters.csv.
+
+    Parameters
+    ----------
+    path : str
+        The project directory. If None, the current working directory is used.
+    lease_time : float
+        Seconds before the job of a stopped worker is queued again. Default is 300.
+    poll_interval : float
+        Seconds to wait for the jobs of other workers to finish or to be queued again. Default is 10.
+    max_jobs : int
+        The worker stops after this many jobs to release memory, 0 for no limit. Default is 0.
+
+    Returns
+    -------
+    n : int
+        Number of jobs processed by the worker.
+    """
+
+    params = _load_worker_params(os.getcwd() if path is None else path)
+    queue = JobQueue(os.path.join(params.project_file_dir, JOB_QUEUE_FILE))
+    worker = "{}-{}".format(socket.gethostname(), os.getpid())
+    print("Worker {} started.".format(worker))
+
+    n = 0
+    while max_jobs == 0 or n < max_jobs:
+        job = queue.claim(worker, lease_time)
+        if job is None:
+            counts = queue.counts()
+            if counts["running"] == 0:
+                break
+            time.sleep(poll_interval)
+            continue
+
+        name = job["name"]
+        raw_file = os.path.join(params.project_dir, job["file_name"])
+        output_path = os.path.join(params.single_file_dir, name + ".txt")
+        # remove the outdated result, so a failure is not taken as done
+        if os.path.exists(output_path):
+            os.remove(output_path)
+
+        # renew the lease in the background while the file is processed
+        stop = threading.Event()
+        heartbeat = threading.Thread(target=_renew_lease, args=(queue, name, worker, lease_time, stop), daemon=True)
+        heartbeat.start()
+        t0 = time.time()
+        reset_peak_rss()
+        try:
+            process_single_file(raw_file, params, return_data=False)
+        finally:
+            stop.set()
+            heartbeat.join()
+
+        if os.path.isfile(output_path):
+            finished = queue.finish(name, worker, output_hash=file_hash(output_path), peak_memory=peak_rss())
         else:
-            print("\tProcessing files from " + str(i) + " to " + str(i+to_be_processed))
-        p = multiprocessing.Pool(workers)
-        p.starmap(process_single_file, [(f, None, segment_feature, group_features, evaluate_peak_shape, 
-                                         annotate_ms2, ms2_library_path, single_file_dir) for f in to_be_processed[i:i+batch_size]])
-        p.close()
-        p.join()
+            finished = queue.finish(name, worker, peak_memory=peak_rss(), error="no output (see the log of {})".format(worker))
+        if not finished:
+            print("\tThe lease of {} expired, its result is not recorded.".format(name))
+        print("\t{} is processed in {:.1f} s.".format(name, time.time() - t0))
+        n += 1
+
+    print("Worker {} processed {} jobs. Jobs in the queue: {}.".format(worker, n, _format_counts(queue.counts())))
+    return n
+
+
+def command_line(argv=None):
+    """
+    The masscube command for distributed file processing:
+        masscube enqueue --project DIR
+        masscube worker --project DIR [--lease 300] [--poll 10] [--max-jobs 0]
+        masscube status --project DIR
+    """
+
+    parser = argparse.ArgumentParser(prog="masscube", description="Distributed processing of individual files.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    for command, help_text in [("enqueue", "add the files to be processed to the job queue"),
+                               ("worker", "process the jobs in the job queue"),
+                               ("status", "show the jobs in the job queue")]:
+        sub = subparsers.add_parser(command, help=help_text)
+        sub.add_argument("--project", default=None, help="the project directory, default is the current directory")
+        if command == "worker":
+            sub.add_argument("--lease", type=float, default=300.0, help="seconds before the job of a stopped worker is queued again")
+            sub.add_argument("--poll", type=float, default=10.0, help="seconds to wait for the jobs of other workers")
+            sub.add_argument("--max-jobs", type=int, default=0, help="number of jobs before the worker stops, 0 for no limit")
+    args = parser.parse_args(argv)
+
+    if args.command == "enqueue":
+        enqueue_single_files(args.project)
+    elif args.command == "worker":
+        run_worker(args.project, lease_time=args.lease, poll_interval=args.poll, max_jobs=args.max_jobs)
+    else:
+        project_dir = os.getcwd() if args.project is None else args.project
+        queue_path = os.path.join(project_dir, "project_files", JOB_QUEUE_FILE)
+        if not os.path.exists(queue_path):
+            print("No job queue is found in {}.".format(project_dir))
+            return
+        queue = JobQueue(queue_path)
+        print("Jobs in the queue: {}.".format(_format_counts(queue.counts())))
+        for name, error in queue.failed_jobs():
+            print("\t{} failed: {}".format(name, error))
+
+
+def _prepare_project_params(path):
+    # the parameters of a project as in the workflow
+    params = Params()
+    params.project_dir = os.getcwd() if path is None else path
+    params._untargeted_metabolomics_workflow_preparation()
+    return params
+
+
+def _save_worker_params(params):
+    # replaced at once, so a worker never reads a partly written file
+    path = os.path.join(params.project_file_dir, JOB_PARAMS_FILE)
+    with open(path + ".tmp", "wb") as f:
+        pickle.dump(params, f)
+    os.replace(path + ".tmp", path)
+
+
+def _load_worker_params(project_dir):
+    # the parameters saved by enqueue_single_files, with the directories moved to where this 
+    # computer mounts the project. Nothing in the project is read or written to prepare them.
+    path = os.path.join(project_dir, "project_files", JOB_PARAMS_FILE)
+    if not os.path.exists(path):
+        raise ValueError("No job queue is found in {}. Add the jobs with: masscube enqueue --project DIR".format(project_dir))
+    with open(path, "rb") as f:
+        params = pickle.load(f)
+
+    old_project_dir = params.project_dir
+    params.project_dir = project_dir
+    for attr in ["sample_dir", "single_file_dir", "tmp_file_dir", "ms2_matching_dir", "bpc_dir", "project_file_dir",
+                 "statistics_dir", "normalization_dir"]:
+        value = getattr(params, attr)
+        if value is not None:
+            setattr(params, attr, os.path.join(project_dir, os.path.relpath(value, old_project_dir)))
+    return params
+
+
+def _renew_lease(queue, name, worker, lease_time, stop):
+    # renew the lease three times per lease time until the job is finished or the lease is lost
+    while not stop.wait(lease_time / 3):
+        if not queue.heartbeat(name, worker, lease_time):
+            break
+
+
+def _format_counts(counts):
+    return ", ".join("{} {}".format(v, k) for k, v in counts.items())
 
 
 DEPENDENCIES = ('masscube', 'numpy', 'pandas', 'scipy', 'matplotlib', 'pyteomics', 'scikit-learn', 'ms_entropy', 'lxml')
@@ -0,0 +1,177 @@
+# Author: Huaxu Yu
+
+# Shared synthetic data for the tests
+
+import base64
+import zlib
+import numpy as np
+import pytest
+
+from masscube.params import Params
+from masscube.raw_data_utils import MSData, ScanTable
+
+
+def make_ms_data(scans, times=None, ms1_idx_arr=None):
+    """
+    Build an MSData object from centroided MS1 scans.
+
+    Parameters
+    ----------
+    scans: list
+        Signals of each scan as [[m/z, intensity], ...], sorted by m/z.
+    times: list
+        Scan times in minute. If None, scans are 0.01 min apart.
+    ms1_idx_arr: list
+        Indexes of the MS1 scans used for detection. If None, scans with signals are used.
+
+    Returns
+    -------
+    d: MSData object
+    """
+
+    n = len(scans)
+    times = np.arange(n) * 0.01 if times is None else np.asarray(times, dtype=np.float64)
+    peaks = [np.asarray(s, dtype=np.float32).reshape(-1, 2) for s in scans]
+    offset = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum([len(p) for p in peaks], out=offset[1:])
+
+    d = MSData()
+    d.params = Params()
+    d.scans = ScanTable(level=np.ones(n, dtype=np.int8), time=times,
+                        peaks=np.concatenate(peaks) if n > 0 else np.empty((0, 2), dtype=np.float32), offset=offset)
+    d.index_scans()
+    if ms1_idx_arr is not None:
+        d.ms1_idx_arr = np.asarray(ms1_idx_arr, dtype=np.int64)
+        d.ms1_time_arr = d.scans.time[d.ms1_idx_arr]
+    return d
+
+
+def simulate_ms_data(n_scans=300, n_compounds=60, n_noise=20, seed=0):
+    """
+    Simulate centroided MS1 scans with Gaussian chromatographic peaks, M+1 isotopes and random noise.
+    """
+
+    rng = np.random.default_rng(seed)
+    time_arr = np.linspace(0, 10, n_scans)
+    cmp_mz = rng.uniform(100, 1000, n_compounds)
+    cmp_rt = rng.uniform(0.5, 9.5, n_compounds)
+    cmp_w = rng.uniform(0.03, 0.1, n_compounds)
+    cmp_h = 10 ** rng.uniform(4, 7, n_compounds)
+
+    scans = []
+    for t in time_arr:
+        ints = cmp_h * np.exp(-0.5 * ((t - cmp_rt) / cmp_w) ** 2)
+        v = ints > 1000
+        mz = np.concatenate((cmp_mz[v] + rng.normal(0, 0.001, np.sum(v)), cmp_mz[v] + 1.00336,
+                             rng.uniform(100, 1000, n_noise)))
+        it = np.concatenate((ints[v], ints[v] * 0.3, rng.uniform(1000, 30000, n_noise)))
+        o = np.argsort(mz)
+        scans.append(np.column_stack((mz[o], it[o])))
+
+    return make_ms_data(scans, time_arr)
+
+
+def write_mzml(path, n_ms1=200, n_compounds=40, n_noise=20, seed=0, compress=True, time_unit="minute", indexed=False):
+    """
+    Write a centroided mzML file with simulated MS1 scans and an MS2 scan of the most
+    intense compound after every third MS1 scan. The binary arrays are zlib compressed 
+    if compress is True, and the scan times are written in time_unit ("minute" or "second").
+    If indexed is True, an indexedmzML file with the byte offsets of the spectra is written.
+    """
+
+    def encode(values, dtype):
+        data = np.asarray(values, dtype=dtype).tobytes()
+        return base64.b64encode(zlib.compress(data) if compress else data).decode()
+
+    rng = np.random.default_rng(seed)
+    cmp_mz = rng.uniform(100, 900, n_compounds)
+    cmp_rt = rng.uniform(0.5, 9.5, n_compounds)
+    cmp_w = rng.uniform(0.03, 0.1, n_compounds)
+    cmp_h = 10 ** rng.uniform(4.5, 7, n_compounds)
+
+    spectra = []
+    for k, t in enumerate(np.linspace(0, 10, n_ms1)):
+        ints = cmp_h * np.exp(-0.5 * ((t - cmp_rt) / cmp_w) ** 2)
+        v = ints > 1000
+        mz = np.concatenate((cmp_mz[v] + rng.normal(0, 0.001, np.sum(v)), cmp_mz[v] + 1.00336, rng.uniform(100, 900, n_noise)))
+        it = np.concatenate((ints[v], ints[v] * 0.3, rng.uniform(1000, 80000, n_noise)))
+        o = np.argsort(mz)
+        spectra.append((1, t, mz[o], it[o], None))
+        if k % 3 == 0 and np.any(v):
+            j = np.flatnonzero(v)[np.argmax(ints[v])]
+            spectra.append((2, t + 0.001, np.sort(rng.uniform(50, cmp_mz[j], 20)), rng.uniform(1e3, 1e5, 20), cmp_mz[j]))
+
+    cv = '<cvParam cvRef="MS" accession="{}" name="{}"{}/>'
+    compression = cv.format("MS:1000574", "zlib compression", "") if compress else cv.format("MS:1000576", "no compression", "")
+    lines = ['<?xml version="1.0" encoding="utf-8"?>', '<mzML xmlns="http://psi.hupo.org/ms/mzml" version="1.1.0">',
+             '<fileDescription><fileContent>' + cv.format("MS:1000127", "centroid spectrum", "") + '</fileContent></fileDescription>',
+             '<instrumentConfigurationList count="1"><instrumentConfiguration id="IC">' + cv.format("MS:1001742", "Q Exactive", "") +
+             '</instrumentConfiguration></instrumentConfigurationList>',
+             '<run id="run"><spectrumList count="{}">'.format(len(spectra))]
+    for i, (level, t, mz, it, precursor_mz) in enumerate(spectra):
+        lines.append('<spectrum index="{}" id="scan={}" defaultArrayLength="{}">'.format(i, i + 1, len(mz)))
+        lines.append(cv.format("MS:1000511", "ms level", ' value="{}"'.format(level)))
+        lines.append(cv.format("MS:1000130", "positive scan", ""))
+        time_value = ' value="{}" unitAccession="UO:0000031" unitName="minute"'.format(t) if time_unit == "minute" else \
+                     ' value="{}" unitAccession="UO:0000010" unitName="second"'.format(t * 60)
+        lines.append('<scanList count="1"><scan>' + cv.format("MS:1000016", "scan start time", time_value) + '</scan></scanList>')
+        if precursor_mz is not None:
+            lines.append('<precursorList count="1"><precursor><isolationWindow>' +
+                         cv.format("MS:1000828", "isolation window lower offset", ' value="0.5"') +
+                         cv.format("MS:1000829", "isolation window upper offset", ' value="0.5"') +
+                         '</isolationWindow><selectedIonList count="1"><selectedIon>' +
+                         cv.format("MS:1000744", "selected ion m/z", ' value="{}"'.format(precursor_mz)) +
+                         '</selectedIon></selectedIonList></precursor></precursorList>')
+        lines.append('<binaryDataArrayList count="2">')
+        lines.append('<binaryDataArray encodedLength="0">' + cv.format("MS:1000523", "64-bit float", "") +
+                     compression + cv.format("MS:1000514", "m/z array", "") +
+                     '<binary>{}</binary></binaryDataArray>'.format(encode(mz, "<f8")))
+        lines.append('<binaryDataArray encodedLength="0">' + cv.format("MS:1000521", "32-bit float", "") +
+                     compression + cv.format("MS:1000515", "intensity array", "") +
+                     '<binary>{}</binary></binaryDataArray>'.format(encode(it, "<f4")))
+        lines.append('</binaryDataArrayList></spectrum>')
+    lines.append('</spectrumList></run></mzML>')
+
+    if indexed:
+        lines.insert(1, '<indexedmzML xmlns="http://psi.hupo.org/ms/mzml">')
+        # the file is ASCII, so the character positions are the byte offsets
+        offsets, pos = [], 0
+        for line in lines:
+            if line.startswith("<spectrum "):
+                offsets.append(pos)
+            pos += len(line) + 1
+        lines.append('<indexList count="1"><index name="spectrum">' +
+                     "".join('<offset idRef="scan={}">{}</offset>'.format(i + 1, o) for i, o in enumerate(offsets)) +
+                     '</index></indexList>')
+        lines.append('<indexListOffset>{}</indexListOffset>'.format(pos))
+        lines.append('</indexedmzML>')
+
+    with open(path, "w") as f:
+        f.write("\n".join(lines))
+    return path
+
+
+def assert_same_scan_tables(a, b):
+    """
+    Assert that two ScanTables have the same scans and signals.
+    """
+
+    for key in ["level", "time", "offset", "has_signals"]:
+        assert np.array_equal(getattr(a, key), getattr(b, key)), key
+    for key in ["precursor_mz", "isolation_window"]:
+        assert np.array_equal(getattr(a, key), getattr(b, key), equal_nan=True), key
+    assert a.peaks.dtype == b.peaks.dtype
+    assert np.array_equal(a.peaks, b.peaks)
+
+
+def feature_summary(features):
+    """
+    m/z, RT, height, area and scan indexes of features, to compare two detections.
+    """
+
+    return [(f.mz, f.rt, f.peak_height, f.peak_area, list(f.scan_idx_seq)) for f in features]
+
+
+@pytest.fixture
+def ms_data():
+    return simulate_ms_data()
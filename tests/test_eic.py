@@ -0,0 +1,53 @@
+# Author: Huaxu Yu
+
+# EICs from the m/z index (get_eics, build_mz_index) are the same as from get_eic_data scan by scan
+
+import numpy as np
+import pytest
+
+from conftest import make_ms_data, simulate_ms_data
+
+
+def assert_same_eics(a, b):
+    assert len(a) == len(b)
+    for (t1, s1, i1), (t2, s2, i2) in zip(a, b):
+        assert np.array_equal(t1, t2)
+        assert np.array_equal(s1, s2, equal_nan=True)
+        assert np.array_equal(i1, i2)
+
+
+def targets(d, n=300, seed=0):
+    # m/z of signals, and exactly at or just beyond the tolerance from them, random m/z and RT inside and outside the run
+    rng = np.random.default_rng(seed)
+    mz = d.scans.mz[rng.integers(0, len(d.scans.peaks), n)].astype(np.float64)
+    mz = np.concatenate((mz, mz[:50] + 0.01, mz[50:100] - 0.0100001, rng.uniform(50, 1100, 50)))
+    rt = rng.uniform(-1, 11, len(mz))
+    return mz, rt
+
+
+@pytest.mark.parametrize("seed", [0, 1])
+def test_get_eics_matches_get_eic_data(seed):
+    d = simulate_ms_data(seed=seed)
+    d.params.use_numba = False
+    mz_arr, rt_arr = targets(d, seed=seed)
+    for rt_tol in [0.05, 0.3]:
+        # get_eic_data is scan by scan until the index is built by get_eics
+        d._mz_index = None
+        eics = [d.get_eic_data(mz, rt, mz_tol=0.01, rt_tol=rt_tol) for mz, rt in zip(mz_arr, rt_arr)]
+        assert_same_eics(d.get_eics(mz_arr, rt_arr, mz_tol=0.01, rt_tol=rt_tol), eics)
+        assert d._mz_index is not None
+        assert_same_eics([d.get_eic_data(mz, rt, mz_tol=0.01, rt_tol=rt_tol) for mz, rt in zip(mz_arr, rt_arr)], eics)
+
+    # EICs of the whole run
+    d._mz_index = None
+    eics = [d.get_eic_data(mz, mz_tol=0.01) for mz in mz_arr[:50]]
+    assert_same_eics(d.get_eics(mz_arr[:50], mz_tol=0.01), eics)
+
+
+def test_get_eics_empty_scans():
+    d = make_ms_data([[], [[100.0, 1e4], [100.004, 2e4]], [], [[100.002, 3e4]], []], ms1_idx_arr=np.arange(5))
+    d.params.use_numba = False
+    mz_arr, rt_arr = np.array([100.0, 100.003, 200.0]), np.array([0.02, 0.02, 0.02])
+    eics = [d.get_eic_data(mz, rt, mz_tol=0.005, rt_tol=0.1) for mz, rt in zip(mz_arr, rt_arr)]
+    assert_same_eics(d.get_eics(mz_arr, rt_arr, mz_tol=0.005, rt_tol=0.1), eics)
+    assert_same_eics(d.get_eics(np.empty(0), np.empty(0)), [])
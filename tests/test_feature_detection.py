@@ -0,0 +1,116 @@
+# Author: Huaxu Yu
+
+# The vectorized ROI engine and its slab-parallel tracing give the same features as the classic engine
+
+import numpy as np
+import pytest
+
+from masscube.feature_detection import detect_features, summarize_features, _find_mz_seams
+
+from conftest import make_ms_data, simulate_ms_data, feature_summary
+
+
+def detect(d, engine, n_jobs=1):
+    d.params.roi_engine = engine
+    features = detect_features(d, n_jobs=n_jobs)
+    # areas are not calculated in detection
+    return feature_summary(summarize_features(features, g_score=False, a_score=False))
+
+
+def assert_same_engines(d):
+    classic = detect(d, "classic")
+    vectorized = detect(d, "vectorized")
+    assert classic == vectorized
+    return classic
+
+
+@pytest.mark.parametrize("seed", [0, 1, 2])
+def test_engines_simulated(seed):
+    features = assert_same_engines(simulate_ms_data(seed=seed))
+    assert len(features) > 0
+
+
+def test_engines_with_pruning():
+    d = simulate_ms_data(seed=3)
+    d.params.roi_min_length = 3
+    d.params.roi_min_height = 5000.0
+    assert_same_engines(d)
+
+
+def test_engines_empty_ms1_scans():
+    rng = np.random.default_rng(4)
+    scans = []
+    for i in range(40):
+        if i in (0, 7, 8, 20, 39):
+            scans.append([])
+        else:
+            mz = np.sort(rng.choice([150.0, 150.004, 300.0, 450.0], size=3, replace=False))
+            scans.append(np.column_stack((mz, rng.uniform(1e3, 1e5, 3))))
+    # empty scans are kept in the MS1 scans to be skipped by both engines
+    d = make_ms_data(scans, ms1_idx_arr=np.arange(40))
+    assert len(assert_same_engines(d)) > 0
+
+
+def test_engines_single_ms1_scan():
+    d = make_ms_data([[[100.0, 1e4], [200.0, 2e4], [200.005, 5e3]]])
+    assert len(assert_same_engines(d)) == 3
+
+
+def test_unknown_engine():
+    d = make_ms_data([[[100.0, 1e4]]])
+    with pytest.raises(ValueError, match="ROI engine"):
+        detect(d, "vectorised")
+
+
+def test_engines_tolerance_ties():
+    # values exactly representable in float32: a signal exactly mz_tol from a ROI starts a
+    # new ROI, and a signal halfway between two ROIs is taken by neither
+    scans = [
+        [[100.0, 1e5], [100.5, 1e5], [300.0, 1e4]],
+        [[100.25, 2e5], [300.5, 1e4]],
+        [[100.0, 1e5], [100.5, 3e5], [300.25, 1e4]],
+        [[100.25, 1e5], [100.5, 1e5], [300.25, 2e4]],
+    ]
+    d = make_ms_data(scans)
+    d.params.mz_tol_ms1 = 0.5
+    d.params.feature_gap_tol = 1
+    assert len(assert_same_engines(d)) > 0
+    d.params.mz_tol_ms1 = 0.25
+    assert len(assert_same_engines(d)) > 0
+
+
+# slab-parallel tracing (n_jobs > 1) gives the same features as tracing the whole file
+
+def test_slabs_simulated():
+    d = simulate_ms_data(seed=5)
+    assert detect(d, "vectorized", n_jobs=2) == detect(d, "vectorized")
+
+
+def test_slabs_seam_at_tolerance():
+    # the only gap of at least mz_tol is exactly mz_tol wide (200.0 to 200.5), so the seam is placed there
+    rng = np.random.default_rng(6)
+    scans = []
+    for _ in range(30):
+        ints = rng.uniform(1e3, 1e5, 4)
+        scans.append([[199.75, ints[0]], [200.0, ints[1]], [200.5, ints[2]], [200.75, ints[3]]])
+    d = make_ms_data(scans)
+    d.params.mz_tol_ms1 = 0.5
+    assert 200.5 in _find_mz_seams(d.scans.mz, 0.5, 2)
+    assert detect(d, "vectorized", n_jobs=2) == detect(d, "vectorized")
+
+
+@pytest.mark.parametrize("step", [-1, 0, 1])
+def test_slabs_gaps_near_tolerance(step):
+    # a gap one float32 step below, at or above mz_tol (not exact in float32) between the 
+    # middle signals, so a seam is placed there if the gap is at least mz_tol in float64
+    rng = np.random.default_rng(7)
+    base = np.float32(300.0)
+    gap = np.float32(base + np.float32(0.01))
+    if step != 0:
+        gap = np.nextafter(gap, np.float32(step * 1000))
+    mz = np.array([base - np.float32(0.5), base, gap, gap + np.float32(0.5)], dtype=np.float32)
+    scans = [np.column_stack((mz, rng.uniform(1e3, 1e5, 4))) for _ in range(30)]
+    d = make_ms_data(scans)
+    d.params.mz_tol_ms1 = 0.01
+    assert (gap in _find_mz_seams(d.scans.mz, 0.01, 4)) == (np.float64(gap - base) >= 0.01)
+    assert detect(d, "vectorized", n_jobs=2) == detect(d, "vectorized")
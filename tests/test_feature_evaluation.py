@@ -0,0 +1,65 @@
+# Author: Huaxu Yu
+
+# summarize_features (all features in one pass) gives the same results as Feature.summarize
+
+import copy
+import numpy as np
+
+from masscube.feature_detection import Feature, detect_features, summarize_features
+
+from conftest import simulate_ms_data
+
+
+ATTRIBUTES = ["mz", "rt", "scan_idx", "length", "peak_height", "peak_area", "top_average", "gaussian_similarity",
+              "noise_score", "asymmetry_factor"]
+
+
+def random_features(n, seed=0):
+    # Gaussian peaks with noise, flat and noisy traces, short traces, zeros inside and at both ends, ties at the apex
+    rng = np.random.default_rng(seed)
+    features = []
+    for _ in range(n):
+        k = int(rng.integers(1, 40))
+        rt = np.sort(rng.uniform(0, 10, k))
+        shape = rng.integers(0, 4)
+        if shape == 0:
+            ints = 1e5 * np.exp(-0.5 * ((np.arange(k) - k / 2) / max(k / 6, 0.5)) ** 2) * rng.uniform(0.8, 1.2, k)
+        elif shape == 1:
+            ints = rng.uniform(0, 1e5, k)
+        elif shape == 2:
+            ints = np.full(k, 5e4)
+        else:
+            ints = np.round(rng.uniform(0, 5, k)) * 1e4
+        ints[rng.random(k) < 0.2] = 0
+        f = Feature()
+        f.signals = np.column_stack((rng.uniform(100, 100.01, k), ints)).astype(np.float32)
+        f.rt_seq = rt
+        f.scan_idx_seq = np.arange(k)
+        features.append(f)
+    return features
+
+
+def assert_same_summary(features):
+    single = copy.deepcopy(features)
+    for f in single:
+        if np.any(np.asarray(f.signals)[:, 1] != 0):
+            f.summarize()
+    single = [f for f in single if np.any(f.signals[:, 1] != 0)]
+    batch = summarize_features(features)
+
+    assert len(single) == len(batch) > 0
+    for a, b in zip(single, batch):
+        for key in ATTRIBUTES:
+            va, vb = getattr(a, key), getattr(b, key)
+            assert type(va) is type(vb), key
+            assert va == vb or (va != va and vb != vb), key
+        assert np.array_equal(a.signals, b.signals)
+        assert np.array_equal(a.rt_seq, b.rt_seq)
+
+
+def test_summarize_random_traces():
+    assert_same_summary(random_features(3000))
+
+
+def test_summarize_detected_features():
+    assert_same_summary(detect_features(simulate_ms_data(seed=8)))
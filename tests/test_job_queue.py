@@ -0,0 +1,99 @@
+# Author: Huaxu Yu
+
+# The job queue of distributed single-file processing (see job_queue.py)
+
+import os
+import time
+import sqlite3
+import multiprocessing
+
+from masscube.job_queue import JobQueue, JOB_QUEUE_FILE
+from masscube.stage_cache import StageCache
+from masscube.workflows import enqueue_single_files, run_worker, select_files_to_process, _load_worker_params
+
+from conftest import write_mzml
+
+
+def make_queue(tmp_path, n_jobs=2, max_attempts=2):
+    queue = JobQueue(str(tmp_path / JOB_QUEUE_FILE), max_attempts=max_attempts)
+    queue.add([("S{}".format(i), "data/S{}.mzML".format(i), 100 * i, "key") for i in range(n_jobs)])
+    return queue
+
+
+def test_claim_largest_first(tmp_path):
+    queue = make_queue(tmp_path, n_jobs=3)
+    assert queue.claim("w1", 60)["name"] == "S2"
+    assert queue.claim("w2", 60)["name"] == "S1"
+    assert queue.counts() == {"pending": 1, "running": 2, "done": 0, "failed": 0}
+
+
+def test_expired_lease_is_queued_again(tmp_path):
+    queue = make_queue(tmp_path, n_jobs=1)
+    assert queue.claim("w1", 0.1)["name"] == "S0"
+    assert queue.claim("w2", 60) is None
+    time.sleep(0.2)
+
+    # the expired job is claimed by another worker, and the first worker lost its lease
+    assert queue.claim("w2", 60)["name"] == "S0"
+    assert not queue.heartbeat("S0", "w1", 60)
+    assert not queue.finish("S0", "w1", output_hash="a")
+    assert queue.heartbeat("S0", "w2", 60)
+    assert queue.finish("S0", "w2", output_hash="b")
+    assert queue.done_jobs() == {"S0": ("key", "b")}
+
+
+def test_failed_after_max_attempts(tmp_path):
+    queue = make_queue(tmp_path, n_jobs=1, max_attempts=2)
+    for worker in ["w1", "w2"]:
+        assert queue.claim(worker, 0.1)["name"] == "S0"
+        time.sleep(0.2)
+    assert queue.claim("w3", 60) is None
+    assert queue.counts()["failed"] == 1
+    assert queue.failed_jobs() == [("S0", "lease expired")]
+
+    # a failed job is queued again when it is added again
+    assert queue.add([("S0", "data/S0.mzML", 0, "key")]) == 1
+    assert queue.claim("w3", 60)["name"] == "S0"
+
+
+def test_add_keeps_jobs_with_the_same_key(tmp_path):
+    queue = make_queue(tmp_path, n_jobs=2)
+    assert queue.add([("S0", "data/S0.mzML", 0, "key"), ("S1", "data/S1.mzML", 100, "new key")]) == 1
+    assert queue.counts()["pending"] == 2
+
+
+def test_workers_with_an_expired_lease(tmp_path):
+    project = tmp_path / "project"
+    os.makedirs(project / "data")
+    for i in range(3):
+        write_mzml(str(project / "data" / "S{}.mzML".format(i)), n_ms1=100, seed=i)
+
+    assert enqueue_single_files(str(project)) == 3
+    time_table = project / "project_files" / "sample_table_with_time.csv"
+    mtime = os.stat(time_table).st_mtime_ns
+
+    # a worker that stopped while holding a job
+    queue = JobQueue(str(project / "project_files" / JOB_QUEUE_FILE))
+    lost = queue.claim("stopped-worker", 0.5)["name"]
+
+    workers = [multiprocessing.Process(target=run_worker, args=(str(project),), kwargs={"lease_time": 5.0, "poll_interval": 0.2})
+               for _ in range(2)]
+    for p in workers:
+        p.start()
+    for p in workers:
+        p.join(timeout=300)
+        assert p.exitcode == 0
+
+    assert queue.counts() == {"pending": 0, "running": 0, "done": 3, "failed": 0}
+    with sqlite3.connect(queue.path) as conn:
+        attempts = dict(conn.execute("SELECT name, attempts FROM jobs").fetchall())
+    assert attempts[lost] == 2
+    assert not queue.finish(lost, "stopped-worker", output_hash="x")
+    # the workers did not prepare the project again
+    assert os.stat(time_table).st_mtime_ns == mtime
+
+    # the workflow uses the results of the workers
+    params = _load_worker_params(str(project))
+    cache = StageCache(params.project_file_dir)
+    _, to_be_processed = select_files_to_process(params, cache)
+    assert to_be_processed == []
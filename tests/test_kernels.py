@@ -0,0 +1,85 @@
+# Author: Huaxu Yu
+
+# Parity of the numba kernels (Params.use_numba) with the NumPy code they replace
+
+import numpy as np
+import pytest
+
+pytest.importorskip("numba")
+
+from masscube.kernels import claim_signals
+from masscube.feature_detection import detect_features, _find_closest_index_ordered
+from masscube.feature_grouping import scan_to_scan_cor_intensity
+from masscube.utils_functions import centroid_signals
+
+from conftest import feature_summary
+
+
+def test_claim_signals_matches_closest_index():
+    rng = np.random.default_rng(0)
+    mz_arr = np.sort(rng.uniform(100, 110, 300)).astype(np.float32)
+    # targets near signals, between signals, outside the range and exactly at the tolerance
+    targets = np.concatenate((mz_arr[::3] + 0.002, rng.uniform(99, 111, 200),
+                              [mz_arr[0] - 0.01, mz_arr[-1] + 0.01])).astype(np.float32)
+    claimed = claim_signals(mz_arr, targets, 0.01)
+
+    is_available = np.ones(len(mz_arr), dtype=bool)
+    for i, t in enumerate(targets):
+        j = _find_closest_index_ordered(mz_arr, t, tol=0.01)
+        if j is not None and is_available[j]:
+            assert claimed[i] == j
+            is_available[j] = False
+        else:
+            assert claimed[i] == -1
+
+
+def test_claim_signals_empty_scan():
+    claimed = claim_signals(np.empty(0, dtype=np.float32), np.array([100.0], dtype=np.float32), 0.01)
+    assert claimed.tolist() == [-1]
+
+
+def test_get_eic_data(ms_data):
+    rng = np.random.default_rng(1)
+    mz_arr = ms_data.scans.mz[rng.integers(0, len(ms_data.scans.peaks), 200)]
+    rt_arr = rng.uniform(0, 10, 200)
+
+    ms_data.params.use_numba = False
+    eics_numpy = [ms_data.get_eic_data(mz, rt, mz_tol=0.01, rt_tol=0.5) for mz, rt in zip(mz_arr, rt_arr)]
+    ms_data.params.use_numba = True
+    eics_numba = [ms_data.get_eic_data(mz, rt, mz_tol=0.01, rt_tol=0.5) for mz, rt in zip(mz_arr, rt_arr)]
+
+    for a, b in zip(eics_numpy, eics_numba):
+        assert np.array_equal(a[0], b[0])
+        assert np.array_equal(a[1], b[1], equal_nan=True)
+        assert np.array_equal(a[2], b[2])
+
+
+def test_centroid_signals():
+    rng = np.random.default_rng(2)
+    for _ in range(200):
+        n = rng.integers(2, 300)
+        mz = np.sort(rng.uniform(100, 100 + n * 0.003, n))
+        signals = np.column_stack((mz, rng.uniform(1e3, 1e6, n))).astype(np.float32)
+        assert np.array_equal(centroid_signals(signals, 0.005), centroid_signals(signals, 0.005, use_numba=True))
+
+
+def test_scan_to_scan_cor_intensity():
+    rng = np.random.default_rng(3)
+    for _ in range(500):
+        n = rng.integers(2, 60)
+        a = rng.uniform(0, 1e6, n).astype(np.float32) * (rng.random(n) > 0.2)
+        b = (a * rng.uniform(0.2, 0.4) + rng.normal(0, 1e4, n)).astype(np.float32) * (rng.random(n) > 0.2)
+        np.testing.assert_allclose(scan_to_scan_cor_intensity(a, b), scan_to_scan_cor_intensity(a, b, use_numba=True),
+                                   rtol=1e-12, atol=1e-12, equal_nan=True)
+
+
+@pytest.mark.parametrize("engine", ["classic", "vectorized"])
+def test_detect_features(ms_data, engine):
+    ms_data.params.roi_engine = engine
+    ms_data.params.use_numba = False
+    features_numpy = detect_features(ms_data)
+    ms_data.params.use_numba = True
+    features_numba = detect_features(ms_data)
+
+    assert len(features_numpy) > 0
+    assert feature_summary(features_numpy) == feature_summary(features_numba)
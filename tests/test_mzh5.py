@@ -0,0 +1,108 @@
+# Author: Huaxu Yu
+
+# Reuse of mzh5 caches, window reads and memory-mapped loading with the peak sidecar
+
+import os
+import numpy as np
+import pytest
+
+h5py = pytest.importorskip("h5py")
+
+from masscube.mzh5 import convert_raw_to_mzh5, find_mzh5_cache, mzh5_is_current, read_window
+from masscube.params import Params
+from masscube.raw_data_utils import read_raw_file_to_obj
+
+from conftest import write_mzml
+
+
+def sidecar(path):
+    return os.path.splitext(path)[0] + ".peaks.npy"
+
+
+def test_mmap_read_does_not_write(tmp_path):
+    fn = convert_raw_to_mzh5(write_mzml(str(tmp_path / "S.mzML"), n_ms1=50))
+    d = read_raw_file_to_obj(fn)
+    d_mmap = read_raw_file_to_obj(fn, mmap=True)
+
+    # without a sidecar, the peaks are read from HDF5 and nothing is written
+    assert not os.path.exists(sidecar(fn))
+    assert not isinstance(d_mmap.scans.peaks, np.memmap)
+    assert np.array_equal(d.scans.peaks, d_mmap.scans.peaks)
+
+
+def test_mmap_with_sidecar(tmp_path):
+    raw = write_mzml(str(tmp_path / "S.mzML"), n_ms1=50)
+    fn = convert_raw_to_mzh5(raw, output_path=str(tmp_path / "A.mzh5"), npy_sidecar=True)
+    d = read_raw_file_to_obj(fn, mmap=True)
+    assert isinstance(d.scans.peaks, np.memmap)
+
+    # the sidecar is written on read only when asked
+    fn = convert_raw_to_mzh5(raw, output_path=str(tmp_path / "B.mzh5"))
+    d_written = read_raw_file_to_obj(fn, mmap=True, write_sidecar=True)
+    assert os.path.exists(sidecar(fn))
+    assert isinstance(d_written.scans.peaks, np.memmap)
+    assert np.array_equal(d.scans.peaks, d_written.scans.peaks)
+
+
+def test_cache_with_another_mz_range_is_not_reused(tmp_path):
+    raw = write_mzml(str(tmp_path / "S.mzML"), n_ms1=50)
+    params = Params()
+    params.scan_levels = [1, 2]
+    params.mz_upper_limit = 500.0
+    fn = convert_raw_to_mzh5(raw, params=params)
+    d = read_raw_file_to_obj(fn)
+    assert d.params.mz_upper_limit == 500.0
+    assert np.max(d.scans.mz[np.repeat(d.scans.level, np.diff(d.scans.offset)) == 1]) < 500
+
+    params.mz_upper_limit = 100000.0
+    assert not mzh5_is_current(fn, raw, params)
+    assert find_mzh5_cache(raw, params) == raw
+    params.mz_upper_limit = 500.0
+    assert find_mzh5_cache(raw, params) == fn
+
+
+def test_cache_without_source_is_not_current(tmp_path):
+    raw = write_mzml(str(tmp_path / "S.mzML"), n_ms1=20)
+    params = Params()
+    params.scan_levels = [1, 2]
+    fn = convert_raw_to_mzh5(raw, params=params)
+    assert mzh5_is_current(fn, raw, params)
+
+    with h5py.File(fn, "a") as h5:
+        for key in ["source_size", "source_mtime", "source_hash"]:
+            del h5["meta"].attrs[key]
+    assert not mzh5_is_current(fn, raw, params)
+
+
+def window_from_ms_data(d, rt_range, mz_range, level):
+    # the signals of the window from the fully loaded file, in the order of read_window
+    rows = []
+    for i in np.where(d.scans.level == level)[0]:
+        if rt_range[0] <= d.scans.time[i] <= rt_range[1]:
+            s = d.scans.peaks[d.scans.offset[i]:d.scans.offset[i + 1]]
+            s = s[(s[:, 0] >= mz_range[0]) & (s[:, 0] <= mz_range[1])]
+            rows += [(i, d.scans.time[i], mz, it) for mz, it in s[np.argsort(s[:, 0], kind="stable")]]
+    return rows
+
+
+@pytest.mark.parametrize("mz_bin_width", [None, 1.0])
+def test_read_window(tmp_path, mz_bin_width):
+    raw = write_mzml(str(tmp_path / "S.mzML"), n_ms1=60)
+    fn = convert_raw_to_mzh5(raw, chunk_scans=4, mz_bin_width=mz_bin_width)
+    d = read_raw_file_to_obj(fn)
+
+    # a narrow EIC window around the most intense signal, a window across m/z bins, all MS2 signals in
+    # an RT range and a window without scans
+    top = np.argmax(d.scans.peaks[:, 1])
+    mz, rt = d.scans.peaks[top, 0], d.scans.time[np.searchsorted(d.scans.offset, top, side="right") - 1]
+    windows = [((rt - 0.1, rt + 0.1), (mz - 0.01, mz + 0.01), 1), ((rt - 1, rt + 1), (mz - 2.5, mz + 2.5), 1),
+               ((3.0, 3.5), (0.0, 2000.0), 2), ((20.0, 30.0), (100.0, 900.0), 1)]
+    for rt_range, mz_range, level in windows:
+        scan_idx, scan_time, signals = read_window(fn, rt_range=rt_range, mz_range=mz_range, level=level)
+        rows = [(i, t, m, it) for i, t, (m, it) in zip(scan_idx, scan_time, signals)]
+        assert rows == window_from_ms_data(d, rt_range, mz_range, level)
+        assert (len(rows) > 0) == (rt_range[0] < 10)
+
+    # without a window, all signals of the level are read
+    scan_idx, _, signals = read_window(fn)
+    assert len(signals) == np.sum(np.diff(d.scans.offset)[d.scans.level == 1])
@@ -0,0 +1,54 @@
+# Author: Huaxu Yu
+
+# The fast lxml mzML reader gives the same spectra as pyteomics, also when reading in parallel
+
+import numpy as np
+import pytest
+
+from masscube.mzml_reader import iter_mzml_spectra
+from masscube.raw_data_utils import read_raw_file_to_obj, read_mzml_scans_parallel
+
+from conftest import write_mzml, assert_same_scan_tables
+
+
+def assert_same_spectra(a, b):
+    assert len(a) == len(b) > 0
+    for s, t in zip(a, b):
+        assert (s.index, s.level, s.precursor_mz, s.isolation_window) == (t.index, t.level, t.precursor_mz, t.isolation_window)
+        assert s.scan_time == t.scan_time
+        assert np.array_equal(s.signals, t.signals)
+
+
+@pytest.mark.parametrize("compress, time_unit", [(True, "minute"), (False, "minute"), (True, "second")])
+def test_fast_reader_matches_pyteomics(tmp_path, compress, time_unit):
+    path = write_mzml(str(tmp_path / "S.mzML"), n_ms1=60, compress=compress, time_unit=time_unit)
+    fast = list(iter_mzml_spectra(path, fast=True))
+    assert_same_spectra(fast, list(iter_mzml_spectra(path, fast=False)))
+    assert {s.level for s in fast} == {1, 2}
+    assert fast[-1].scan_time == pytest.approx(10.0)
+
+
+# an indexed mzML file read by several workers gives the same scans as reading it in one pass
+
+def test_parallel_reading(tmp_path):
+    path = write_mzml(str(tmp_path / "S.mzML"), n_ms1=120, indexed=True)
+    d = read_raw_file_to_obj(path)
+    d_parallel = read_raw_file_to_obj(path, n_jobs=2)
+
+    assert_same_scan_tables(d.scans, d_parallel.scans)
+    assert np.array_equal(d.ms1_idx_arr, d_parallel.ms1_idx_arr)
+    assert np.array_equal(d.ms2_idx_arr, d_parallel.ms2_idx_arr)
+    assert np.array_equal(d.base_peak_arr, d_parallel.base_peak_arr)
+
+    # the chunks of the workers are preprocessed both ways with the same results
+    table = read_mzml_scans_parallel(path, d.params, n_jobs=2)
+    assert_same_scan_tables(d.scans, table)
+    d.params.vectorized_preprocessing = False
+    assert_same_scan_tables(d.scans, read_mzml_scans_parallel(path, d.params, n_jobs=2))
+
+
+def test_parallel_reading_not_indexed(tmp_path):
+    path = write_mzml(str(tmp_path / "S.mzML"), n_ms1=30)
+    d = read_raw_file_to_obj(path)
+    assert read_mzml_scans_parallel(path, d.params, n_jobs=2) is None
+    assert_same_scan_tables(d.scans, read_raw_file_to_obj(path, n_jobs=2).scans)
@@ -0,0 +1,39 @@
+# Author: Huaxu Yu
+
+# Reloading the mzpkl intermediate files, in memory or memory-mapped
+
+import numpy as np
+
+from masscube.mzpkl import convert_MSData_to_mzpkl
+from masscube.raw_data_utils import read_raw_file_to_obj
+
+from conftest import make_ms_data
+
+
+def test_mmap_mzpkl(ms_data, tmp_path):
+    path = str(tmp_path / "S.mzpkl")
+    convert_MSData_to_mzpkl(ms_data, path)
+    d = read_raw_file_to_obj(path)
+    d_mmap = read_raw_file_to_obj(path, mmap=True)
+
+    assert not isinstance(d.scans.peaks, np.memmap)
+    assert isinstance(d_mmap.scans.peaks, np.memmap)
+    assert np.array_equal(d_mmap.scans.peaks, ms_data.scans.peaks)
+    assert np.array_equal(d_mmap.scans.offset, ms_data.scans.offset)
+    assert np.array_equal(d_mmap.ms1_idx_arr, ms_data.ms1_idx_arr)
+
+    # EICs of the mapped file are the same as of the loaded file
+    rng = np.random.default_rng(0)
+    mz_arr = ms_data.scans.mz[rng.integers(0, len(ms_data.scans.peaks), 50)]
+    rt_arr = rng.uniform(0, 10, 50)
+    for a, b in zip(d.get_eics(mz_arr, rt_arr, 0.01, 0.3), d_mmap.get_eics(mz_arr, rt_arr, 0.01, 0.3)):
+        assert np.array_equal(a[0], b[0])
+        assert np.array_equal(a[1], b[1], equal_nan=True)
+        assert np.array_equal(a[2], b[2])
+
+
+def test_mmap_empty_mzpkl(tmp_path):
+    path = str(tmp_path / "S.mzpkl")
+    convert_MSData_to_mzpkl(make_ms_data([[], []], ms1_idx_arr=[]), path)
+    d = read_raw_file_to_obj(path, mmap=True)
+    assert d.scans.peaks.shape == (0, 2)
@@ -0,0 +1,68 @@
+# Author: Huaxu Yu
+
+# Reading and checking the parameters of a project
+
+import os
+import pytest
+import pandas as pd
+
+from masscube.params import Params
+
+from conftest import write_mzml
+
+
+def test_batch_size_is_deprecated(tmp_path, capsys):
+    path = tmp_path / "parameters.csv"
+    pd.DataFrame({"name": ["batch_size", "mz_tol_ms1"], "value": ["10", "0.005"]}).to_csv(path, index=False)
+    params = Params()
+    params.read_parameters_from_csv(str(path))
+
+    # batch_size does not change the number of files a worker processes before it is restarted
+    assert "batch_size is deprecated" in capsys.readouterr().out
+    assert params.batch_size is None
+    assert params.max_tasks_per_worker == 100
+    assert params.mz_tol_ms1 == 0.005
+
+
+def test_max_tasks_per_worker(tmp_path):
+    path = tmp_path / "parameters.csv"
+    pd.DataFrame({"name": ["max_tasks_per_worker"], "value": ["20"]}).to_csv(path, index=False)
+    params = Params()
+    params.read_parameters_from_csv(str(path))
+    assert params.max_tasks_per_worker == 20
+    assert isinstance(params.max_tasks_per_worker, int)
+
+
+def test_roi_engine(tmp_path):
+    path = tmp_path / "parameters.csv"
+    pd.DataFrame({"name": ["roi_engine"], "value": [" Classic"]}).to_csv(path, index=False)
+    params = Params()
+    params.read_parameters_from_csv(str(path))
+    assert params.roi_engine == "classic"
+
+    # a misspelled engine is not silently replaced by another one
+    pd.DataFrame({"name": ["roi_engine"], "value": ["vectorised"]}).to_csv(path, index=False)
+    with pytest.raises(ValueError, match="roi_engine"):
+        Params().read_parameters_from_csv(str(path))
+
+
+def prepare_project(tmp_path, parameters):
+    os.makedirs(tmp_path / "data")
+    write_mzml(str(tmp_path / "data" / "S0.mzML"), n_ms1=20)
+    pd.DataFrame({"name": list(parameters), "value": list(parameters.values())}).to_csv(tmp_path / "parameters.csv", index=False)
+    params = Params()
+    params.project_dir = str(tmp_path)
+    params._untargeted_metabolomics_workflow_preparation()
+    return params
+
+
+def test_streaming_is_turned_off_for_gap_filling(tmp_path, capsys):
+    params = prepare_project(tmp_path, {"streaming_detection": "True"})
+    assert "streaming_detection is turned off" in capsys.readouterr().out
+    assert params.streaming_detection is False
+
+
+def test_streaming_without_reloading(tmp_path):
+    params = prepare_project(tmp_path, {"streaming_detection": "True", "fill_gaps": "False",
+                                        "group_features_after_alignment": "False"})
+    assert params.streaming_detection
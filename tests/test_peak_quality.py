@@ -0,0 +1,48 @@
+# Author: Huaxu Yu
+
+# Peak quality scores of the bundled model and their column in the single-file output
+
+import numpy as np
+import pandas as pd
+
+from masscube.feature_detection import Feature, detect_features, summarize_features
+from masscube.peak_quality import predict_peak_quality, load_peak_quality_model
+
+
+def make_feature(intensities):
+    f = Feature()
+    f.signals = np.column_stack((np.full(len(intensities), 200.0), intensities))
+    return f
+
+
+def test_scores_of_known_shapes():
+    x = np.arange(30)
+    gaussian = make_feature(1e5 * np.exp(-0.5 * ((x - 15) / 3) ** 2))
+    noise = make_feature(np.random.default_rng(0).uniform(0, 1e5, 30))
+    flat = make_feature(np.zeros(5))
+    features = [gaussian, noise, flat]
+
+    scores = predict_peak_quality(features, model=load_peak_quality_model())
+    assert np.all((scores >= 0) & (scores <= 1))
+    assert scores[0] > 0.9
+    assert scores[1] < 0.1
+    assert [f.peak_quality for f in features] == [float(s) for s in scores]
+
+    # scoring in batches gives the same scores
+    assert np.array_equal(predict_peak_quality(features, batch_size=2), scores)
+
+
+def test_peak_quality_column(ms_data, tmp_path):
+    ms_data.features = summarize_features(detect_features(ms_data), g_score=False, a_score=False)
+    path = str(tmp_path / "sample.txt")
+
+    # the column is only written when the scores were predicted, after the other columns
+    ms_data.output_single_file(path)
+    columns = list(pd.read_csv(path, sep="\t").columns)
+    assert "peak_quality" not in columns
+
+    predict_peak_quality(ms_data.features)
+    ms_data.output_single_file(path)
+    df = pd.read_csv(path, sep="\t")
+    assert list(df.columns) == columns + ["peak_quality"]
+    assert df["peak_quality"].between(0, 1).all()
@@ -0,0 +1,71 @@
+# Author: Huaxu Yu
+
+# Preprocessing all spectra at once (preprocess_spectra) gives the same scans as scan by scan
+
+import numpy as np
+import pytest
+
+from masscube.mzml_reader import Spectrum, iter_mzml_spectra
+from masscube.params import Params
+from masscube.raw_data_utils import ScanTable, preprocess_spectra, _spectrum_to_scan
+
+from conftest import write_mzml, assert_same_scan_tables
+
+
+def random_spectra(n=300, seed=0):
+    # clusters of signals closer than the centroid tolerance, intensities around the thresholds,
+    # m/z around the m/z range, MS2 with and without precursor, empty spectra and MS3 spectra
+    rng = np.random.default_rng(seed)
+    spectra = []
+    for i in range(n):
+        level = int(rng.choice([1, 1, 2, 3]))
+        k = int(rng.integers(0, 60))
+        centers = rng.uniform(40, 1100, max(k // 3, 1))
+        mz = np.sort(rng.choice(centers, k) + rng.normal(0, 0.003, k)) if k > 0 else np.empty(0)
+        intensity = 10 ** rng.uniform(2, 6, k)
+        intensity[rng.random(k) < 0.1] = 1000.0
+        precursor_mz, isolation_window = None, None
+        if level == 2 and rng.random() < 0.8:
+            precursor_mz = float(rng.uniform(100, 1000))
+            isolation_window = (0.5, 0.5) if rng.random() < 0.5 else None
+        spectra.append(Spectrum(index=i, level=level, scan_time=i * 0.05, precursor_mz=precursor_mz,
+                                isolation_window=isolation_window, mz=mz, intensity=intensity.astype(np.float32)))
+    return spectra
+
+
+def make_params(**kwargs):
+    params = Params()
+    params.scan_levels = [1, 2]
+    params.centroid_mz_tol = 0.005
+    params.ms1_abs_int_tol = 1000
+    params.ms2_abs_int_tol = 500
+    params.ms2_rel_int_tol = 0.01
+    params.precursor_mz_offset = 2
+    for key, value in kwargs.items():
+        setattr(params, key, value)
+    return params
+
+
+def scan_by_scan(spectra, params):
+    return ScanTable.from_scans([_spectrum_to_scan(spec, params) for spec in spectra])
+
+
+@pytest.mark.parametrize("kwargs", [{}, {"centroid_mz_tol": None}, {"precursor_mz_offset": None},
+                                    {"mz_lower_limit": 100.0, "mz_upper_limit": 1000.0, "rt_lower_limit": 2.0, "rt_upper_limit": 12.0},
+                                    {"ms2_rel_int_tol": 0.2, "centroid_mz_tol": 0.02}])
+def test_preprocess_random_spectra(kwargs):
+    spectra = random_spectra()
+    params = make_params(**kwargs)
+    assert_same_scan_tables(preprocess_spectra(spectra, params), scan_by_scan(spectra, params))
+
+
+def test_preprocess_mzml_spectra(tmp_path):
+    spectra = list(iter_mzml_spectra(write_mzml(str(tmp_path / "S.mzML"), n_ms1=60)))
+    params = make_params()
+    table = preprocess_spectra(spectra, params)
+    assert len(table.peaks) > 0
+    assert_same_scan_tables(table, scan_by_scan(spectra, params))
+
+
+def test_preprocess_no_spectra():
+    assert_same_scan_tables(preprocess_spectra([], make_params()), scan_by_scan([], make_params()))
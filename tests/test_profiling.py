@@ -0,0 +1,64 @@
+# Author: Huaxu Yu
+
+# Stage profiles (see profiling.py)
+
+import os
+import pandas as pd
+
+from masscube.profiling import StageProfiler, summarize_stage_profile
+
+
+def test_stage_profiler(tmp_path):
+    path = str(tmp_path / "stage_profiles" / "run.jsonl")
+    for name in ["S1", "S2"]:
+        profiler = StageProfiler(name, path)
+        profiler.start("read")
+        profiler.start("detect")
+        profiler.stop(rois=10, features=None)
+        profiler.save()
+
+    df = pd.read_json(path, lines=True)
+    assert list(df["file"]) == ["S1", "S1", "S2", "S2"]
+    assert list(df["stage"]) == ["read", "detect", "read", "detect"]
+    assert df["rois"].isna().tolist() == [True, False, True, False]
+    assert "features" not in df.columns
+
+
+def test_summarize_stage_profile(tmp_path):
+    path = str(tmp_path / "run.jsonl")
+    records = [
+        {"file": "S1", "stage": "read", "wall_time": 1.0, "cpu_time": 0.5, "peak_rss": 100.0, "scans": 10},
+        {"file": "S1", "stage": "detect", "wall_time": 2.0, "cpu_time": 1.5, "peak_rss": 150.0, "features": 5},
+        {"file": "S2", "stage": "read", "wall_time": 3.0, "cpu_time": 1.0, "peak_rss": 120.0, "scans": 20},
+        {"file": "S2", "stage": "detect", "wall_time": 4.0, "cpu_time": 2.5, "peak_rss": 130.0, "features": 7},
+        {"file": "S3", "stage": "read", "wall_time": 8.0, "cpu_time": 4.0, "peak_rss": None, "scans": 30},
+        {"file": "project", "stage": "alignment", "wall_time": 0.1234, "cpu_time": 0.1, "peak_rss": 200.0},
+    ]
+    pd.DataFrame(records).to_json(path, orient="records", lines=True)
+
+    summary = summarize_stage_profile(path).set_index("stage")
+
+    # stages are kept in the order of processing
+    assert list(summary.index) == ["read", "detect", "alignment"]
+    assert summary["files"].tolist() == [3, 2, 1]
+    assert summary["wall_time"].tolist() == [12.0, 6.0, 0.123]
+    assert summary["median_wall_time"].tolist() == [3.0, 3.0, 0.123]
+    assert summary["max_wall_time"].tolist() == [8.0, 4.0, 0.123]
+    assert summary["cpu_time"].tolist() == [5.5, 4.0, 0.1]
+    assert summary["max_peak_rss"].tolist() == [120.0, 150.0, 200.0]
+
+    # counts are summed per stage and missing where a stage has none
+    assert str(summary["scans"].dtype) == "Int64"
+    assert summary.loc["read", "scans"] == 60
+    assert summary["scans"].isna().tolist() == [False, True, True]
+    assert summary["features"].isna().tolist() == [True, False, True]
+    assert summary.loc["detect", "features"] == 12
+
+    # the table is saved next to the JSON lines file
+    saved = pd.read_csv(str(tmp_path / "run_summary.txt"), sep="\t")
+    assert saved["stage"].tolist() == ["read", "detect", "alignment"]
+    assert saved["wall_time"].tolist() == [12.0, 6.0, 0.123]
+
+    output_path = str(tmp_path / "summary.txt")
+    summarize_stage_profile(path, output_path)
+    assert os.path.exists(output_path)
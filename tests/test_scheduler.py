@@ -0,0 +1,109 @@
+# Author: Huaxu Yu
+
+# Parallel file processing with long-lived workers (see scheduler.py)
+
+import os
+import time
+import numpy as np
+
+from masscube.scheduler import run_tasks, MemoryEstimator, MIN_CALIBRATION_FILES, DEFAULT_MEMORY_BASE, DEFAULT_MEMORY_RATIO
+
+
+# task functions are defined at the top level to be sent to the workers
+
+def square(x):
+    return x * x
+
+
+def fail_or_die(x):
+    if x == 2:
+        raise ValueError("bad file")
+    if x == 4:
+        os._exit(1)
+    return x * x
+
+
+def worker_pid(x):
+    return os.getpid()
+
+
+def sleep_interval(x):
+    start = time.time()
+    time.sleep(0.3)
+    return start, time.time()
+
+
+def run_all(func, tasks, n_workers, **kwargs):
+    results = {}
+    for i, result, _ in run_tasks(func, [((t,), {}) for t in tasks], n_workers, **kwargs):
+        assert i not in results
+        results[i] = result
+    return results
+
+
+def test_all_tasks_are_run():
+    assert run_all(square, range(20), 3) == {i: i * i for i in range(20)}
+
+
+def test_failed_and_dead_workers():
+    # a task that raises or whose worker dies fails alone, the other tasks are run
+    results = run_all(fail_or_die, range(8), 2)
+    assert results == {i: None if i in (2, 4) else i * i for i in range(8)}
+
+
+def test_workers_are_restarted_after_max_tasks():
+    pids = run_all(worker_pid, range(6), 1, max_tasks=2)
+    assert len(pids) == 6
+    assert len(set(pids.values())) == 3
+    assert pids[0] == pids[1] and pids[2] == pids[3] and pids[4] == pids[5]
+
+
+# tasks are started only while their estimated memory fits in the budget
+
+def overlap(a, b):
+    return a[0] < b[1] and b[0] < a[1]
+
+
+def test_memory_budget():
+    intervals = run_all(sleep_interval, range(4), 4, memory=[60, 60, 60, 60], memory_budget=100)
+    assert not any(overlap(intervals[i], intervals[j]) for i in range(4) for j in range(i))
+
+
+def test_task_larger_than_budget_runs_alone():
+    intervals = run_all(sleep_interval, range(4), 4, memory=[150, 40, 40, 40], memory_budget=100)
+    assert not any(overlap(intervals[0], intervals[i]) for i in range(1, 4))
+    # two small tasks fit in the budget together
+    assert any(overlap(intervals[i], intervals[j]) for i in range(1, 4) for j in range(1, i))
+
+
+def test_memory_estimator_calibration(tmp_path):
+    files = []
+    for i in range(MIN_CALIBRATION_FILES + 1):
+        path = tmp_path / "S{}.mzML".format(i)
+        path.write_bytes(b"0" * (1000 * (i + 1)))
+        files.append(str(path))
+    other = tmp_path / "S.mzXML"
+    other.write_bytes(b"0" * 1000)
+
+    estimator = MemoryEstimator(str(tmp_path / "file_memory_usage.csv"))
+    default = DEFAULT_MEMORY_BASE + DEFAULT_MEMORY_RATIO * 1000
+    assert estimator.estimate([files[0]])[0] == default
+
+    # peak memory of 1e6 + 100 per byte, with one file 5000 bytes above the line
+    peaks = [1e6 + 100 * os.path.getsize(f) for f in files]
+    peaks[2] += 5000
+    for f, peak in zip(files[:MIN_CALIBRATION_FILES - 1], peaks):
+        estimator.record(f, peak)
+    assert estimator.estimate([files[0]])[0] == default
+    for f, peak in zip(files[MIN_CALIBRATION_FILES - 1:], peaks[MIN_CALIBRATION_FILES - 1:]):
+        estimator.record(f, peak)
+
+    # no observed file is underestimated, and other formats keep the defaults
+    memory = estimator.estimate(files)
+    assert np.all(memory >= np.array(peaks) - 1e-6)
+    assert np.max(memory - peaks) < 10000
+    assert estimator.estimate([str(other)])[0] == default
+
+    # the observations are saved for the next run
+    estimator.save()
+    assert np.array_equal(MemoryEstimator(str(tmp_path / "file_memory_usage.csv")).estimate(files), memory)
@@ -0,0 +1,84 @@
+# Author: Huaxu Yu
+
+# Stages are skipped only while their inputs, parameters and outputs are unchanged
+
+import os
+import shutil
+
+from masscube.params import Params
+from masscube.stage_cache import StageCache
+
+
+def make_project(path):
+    os.makedirs(path / "project_files")
+    os.makedirs(path / "data")
+    (path / "data" / "S0.mzML").write_text("raw data")
+    (path / "single_files").mkdir()
+    (path / "single_files" / "S0.txt").write_text("features")
+    return str(path / "data" / "S0.mzML"), str(path / "single_files" / "S0.txt")
+
+
+def test_stage_is_current(tmp_path):
+    raw, output = make_project(tmp_path)
+    params = Params()
+    cache = StageCache(str(tmp_path / "project_files"))
+    key = cache.key("detection", params, files=[raw])
+    assert not cache.is_current("detection", key, name="S0")
+
+    cache.record("detection", key, [output], name="S0")
+    cache.save()
+    cache = StageCache(str(tmp_path / "project_files"))
+    assert cache.is_current("detection", key, name="S0")
+    assert not cache.is_current("detection", key, name="S1")
+
+
+def test_key_of_parameters_and_inputs(tmp_path):
+    raw, _ = make_project(tmp_path)
+    params = Params()
+    cache = StageCache(str(tmp_path / "project_files"))
+    key = cache.key("detection", params, files=[raw])
+
+    # parameters that change the results change the key, numbers read as floats do not
+    params.mz_tol_ms1 = 0.005
+    assert cache.key("detection", params, files=[raw]) != key
+    params.mz_tol_ms1 = 0.01
+    params.feature_gap_tol = 10.0
+    assert cache.key("detection", params, files=[raw]) == key
+
+    # parameters that only change the speed and parameters of other stages do not
+    params.roi_engine = "classic"
+    params.use_numba = True
+    params.fill_gaps = False
+    assert cache.key("detection", params, files=[raw]) == key
+
+    # an edited input file changes the key
+    with open(raw, "a") as f:
+        f.write(" edited")
+    assert cache.key("detection", params, files=[raw]) != key
+    assert cache.key("detection", params, files=[raw], extra="upstream") != cache.key("detection", params, files=[raw])
+
+
+def test_edited_or_deleted_output(tmp_path):
+    raw, output = make_project(tmp_path)
+    params = Params()
+    cache = StageCache(str(tmp_path / "project_files"))
+    key = cache.key("detection", params, files=[raw])
+    cache.record("detection", key, [output], name="S0")
+
+    with open(output, "a") as f:
+        f.write(" edited")
+    assert not cache.is_current("detection", key, name="S0")
+
+    cache.record("detection", key, [output], name="S0")
+    assert cache.is_current("detection", key, name="S0")
+    os.remove(output)
+    assert not cache.is_current("detection", key, name="S0")
+
+
+def test_moved_project(tmp_path):
+    raw, _ = make_project(tmp_path / "a")
+    params = Params()
+    key = StageCache(str(tmp_path / "a" / "project_files")).key("detection", params, files=[raw])
+    shutil.move(str(tmp_path / "a"), str(tmp_path / "b"))
+    cache = StageCache(str(tmp_path / "b" / "project_files"))
+    assert cache.key("detection", params, files=[str(tmp_path / "b" / "data" / "S0.mzML")]) == key
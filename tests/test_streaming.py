@@ -0,0 +1,47 @@
+# Author: Huaxu Yu
+
+# Streaming feature detection (Params.streaming_detection) gives the same features as read-then-detect
+
+import numpy as np
+import pytest
+
+from masscube.params import Params
+from masscube.raw_data_utils import MSData, read_raw_file_to_obj
+
+from conftest import write_mzml, feature_summary
+
+
+def ms2_summary(features):
+    # the scans and the precursor ion fraction of the MS2 spectra assigned to each feature
+    res = []
+    for f in features:
+        seq = [(s.time, float(s.precursor_mz), s.signals.tolist()) for s in f.ms2_seq]
+        best = None if f.ms2 is None else (f.ms2.time, f.ms2.signals.tolist(), f.ms2.precursor_ion_fraction)
+        res.append((seq, best))
+    return res
+
+
+@pytest.mark.parametrize("seed", [0, 1])
+def test_streaming_same_as_read_then_detect(tmp_path, seed):
+    file_name = write_mzml(str(tmp_path / "sample.mzML"), seed=seed)
+    params = Params()
+    params.set_default("orbitrap", "positive")
+    params.roi_engine = "vectorized"
+
+    d = read_raw_file_to_obj(file_name, params=params)
+    d.detect_features()
+    d.summarize_features()
+
+    s = MSData()
+    s.stream_features(file_name, params=params, batch_size=37)
+    s.summarize_features()
+
+    assert len(d.features) > 0
+    assert feature_summary(d.features) == feature_summary(s.features)
+    assert np.array_equal(d.ms1_idx_arr, s.ms1_idx_arr)
+    assert np.array_equal(d.ms2_idx_arr, s.ms2_idx_arr)
+    assert np.array_equal(d.base_peak_arr, s.base_peak_arr)
+
+    ms2_read, ms2_streamed = ms2_summary(d.features), ms2_summary(s.features)
+    assert sum(len(m[0]) for m in ms2_read) > 0
+    assert ms2_read == ms2_streamed